@@ -0,0 +1,413 @@
+"""
+An asyncio version of the Roomba driver.
+
+Roomba blocks: the mode commands sleep for a second and the sensor queries wait for
+the answer. That is fine in a script, but it freezes everything else running on an
+event loop (like the tornado web server).
+
+AsyncRoomba has the same commands and sensor calls as Roomba, but they are
+coroutines. The serial port is non-blocking and is serviced by the event loop. There
+is no input thread.
+
+  roomba = await AsyncRoomba.open('/dev/ttyUSB0')
+  await roomba.set_drive_straight(200)
+
+  p = sensor_packets.Angle()
+  await roomba.get_sensor_packet(p)
+
+  async for packets in roomba.stream([sensor_groups.Group_100()]):
+      print(packets[0].bumpsAndWheelDrops)
+
+Linux only (the port is serviced with the event loop's add_reader/add_writer).
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+
+import serial
+
+import sensor_packets
+from roomba import (BAUD_RATES, PROBE_RATES, QUERY_TIMEOUT, Roomba, _BAUD_CHANGE_DELAY,
+                    _DRIVE_OPCODES, _STOP_COMMAND, _probe_answered)
+
+
+class _AsyncCore(Roomba):
+    """The Roomba command and decode code running on an event loop's I/O callbacks."""
+
+    def __init__(self, port_name, baud, loop):
+        self._setup(None)
+        self._loop = loop
+        # Writes waiting for room in the port, oldest first, and how much of the
+        # first one is already out
+        self._out = deque()
+        self._out_sent = 0
+        self._drained = None
+        self.roomba = serial.Serial(port_name, baud, timeout=0)
+        self._fd = self.roomba.fileno()
+        loop.add_reader(self._fd, self._on_readable)
+
+    def close_port(self):
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self.roomba.close()
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        if data:
+            self._process_input(data)
+
+    def _write(self, data):
+        self.num_bytes_out += len(data)
+        if self._out:
+            # Already waiting for room. Keep the order.
+            self._out.append(bytes(data))
+            return
+        latency = self.latency
+        start = time.monotonic() if latency is not None else 0
+        try:
+            n = os.write(self._fd, data)
+        except BlockingIOError:
+            n = 0
+        if latency is not None:
+            latency.write.add(time.monotonic()-start)
+        if n < len(data):
+            self._out.append(bytes(data))
+            self._out_sent = n
+            self._loop.add_writer(self._fd, self._on_writable)
+
+    def _on_writable(self):
+        while self._out:
+            chunk = self._out[0]
+            latency = self.latency
+            start = time.monotonic() if latency is not None else 0
+            try:
+                n = os.write(self._fd, chunk[self._out_sent:])
+            except BlockingIOError:
+                return
+            if latency is not None:
+                latency.write.add(time.monotonic()-start)
+            self._out_sent += n
+            if self._out_sent < len(chunk):
+                return
+            self._out.popleft()
+            self._out_sent = 0
+        self._loop.remove_writer(self._fd)
+        if self._drained is not None:
+            self._drained.set_result(None)
+            self._drained = None
+
+    def emergency_stop(self):
+        # Everything runs on the loop, so there is no lock. The stop goes ahead of
+        # the writes waiting for room (after the one partly out). Drive commands
+        # waiting are dropped, and a stop follows any batches still waiting.
+        self._drive_lockout = True
+        if not self._out:
+            self._write_command(_STOP_COMMAND)
+            return
+        head = [self._out.popleft()] if self._out_sent else []
+        rest = [c for c in self._out if not (len(c) == 5 and c[0] in _DRIVE_OPCODES)]
+        if rest:
+            rest.append(_STOP_COMMAND)
+            self.command_counts[_STOP_COMMAND[0]] += 1
+            self.num_bytes_out += len(_STOP_COMMAND)
+        self._out = deque(head + [_STOP_COMMAND] + rest)
+        self.command_counts[_STOP_COMMAND[0]] += 1
+        self.num_bytes_out += len(_STOP_COMMAND)
+
+    async def drain(self):
+        # Wait for the OS to take everything we have written
+        if not self._out:
+            return
+        if self._drained is None:
+            self._drained = self._loop.create_future()
+        await asyncio.shield(self._drained)
+
+
+class AsyncRoomba(object):
+
+    def __init__(self, port_name='/dev/ttyUSB0', baud=115200, loop=None):
+        """Open the port. Use "await AsyncRoomba.open()" to also wake up the OI.
+
+        Args:
+            port_name: name of the port. Defaults to "/dev/ttyUSB0"
+            baud: baud rate of the interface. Defaults to 115200 (Create2 default)
+            loop: event loop to run on. Defaults to the running loop (so without
+                one, call this from a coroutine).
+        """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self._core = _AsyncCore(port_name, baud, loop)
+
+    @classmethod
+    async def open(cls, port_name='/dev/ttyUSB0', baud=115200):
+        """Open the port and put the OI in "safe" mode (like Roomba's constructor).
+
+        A baud of None finds the rate with find_baud.
+        """
+        ret = cls(port_name, baud or PROBE_RATES[0], asyncio.get_running_loop())
+        if baud is None:
+            await ret.find_baud()
+        await ret.set_mode_passive()
+        await ret.set_mode_safe()
+        return ret
+
+    async def close(self):
+        """Put OI in "passive" then "off" mode and close the port.
+
+        Like Roomba.close, this waits a second in "passive" before "off".
+        """
+        await self.set_mode_passive()
+        await asyncio.sleep(1)
+        await self.set_mode_stop()
+        self._core.close_port()
+
+    @property
+    def nowait(self):
+        """The Roomba underneath. Its commands are queued on the port without waiting.
+
+        For code called by the stream on the event loop (a MotionExecutor, say) that
+        needs plain functions instead of coroutines.
+        """
+        return self._core
+
+    async def _sent(self):
+        await self._core.drain()
+
+    def batch(self, drive_latest_wins=False):
+        """Collect commands and write them at once. See Roomba.batch."""
+        return self._core.batch(drive_latest_wins)
+
+    ##### Mode Commands
+
+    async def set_mode_passive(self):
+        self._core._send(b'\x80')
+        # Give it a second to wake up if it is in "off" mode.
+        await asyncio.sleep(1)
+
+    async def set_mode_reset(self):
+        self._core.set_mode_reset()
+        await self._sent()
+
+    async def set_mode_stop(self):
+        self._core.set_mode_stop()
+        await self._sent()
+
+    async def set_baud(self, code):
+        """Opcode 129: Change the baud rate and switch the port. See Roomba.set_baud."""
+        rate = BAUD_RATES[code]
+        self._core._write_command(bytes([0x81, code]))
+        await self._sent()
+        await asyncio.sleep(_BAUD_CHANGE_DELAY)
+        self._core.roomba.baudrate = rate
+
+    async def change_baud(self, rate, timeout=0.5):
+        """Move the robot and the port to a new rate. See Roomba.change_baud."""
+        if rate not in BAUD_RATES:
+            raise ValueError('The OI can not do '+str(rate)+' baud')
+        await self.set_baud(BAUD_RATES.index(rate))
+        if not await self._probe(timeout):
+            raise TimeoutError('The robot did not answer at '+str(rate)+' baud')
+
+    async def find_baud(self, rates=PROBE_RATES, timeout=0.3):
+        """Find the robot's rate and set the port to it. See Roomba.find_baud."""
+        for rate in rates:
+            self._core.roomba.baudrate = rate
+            self._core._write_command(b'\x80')
+            await asyncio.sleep(_BAUD_CHANGE_DELAY)
+            if await self._probe(timeout):
+                return rate
+        raise TimeoutError('The robot did not answer at any of '+str(list(rates)))
+
+    async def _probe(self, timeout):
+        modes = [sensor_packets.OIMode(), sensor_packets.OIMode()]
+        watching = self._core._begin_probe()
+        try:
+            future = self._core.query_async(modes)
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except asyncio.TimeoutError:
+                self._core._forget_query(future)
+                return False
+            return _probe_answered(modes)
+        finally:
+            self._core._end_probe(watching)
+
+    async def set_mode_safe(self):
+        self._core._send(b'\x83')
+        await asyncio.sleep(1)
+
+    async def set_mode_full(self):
+        self._core._send(b'\x84')
+        await asyncio.sleep(1)
+
+    async def set_power_down(self):
+        self._core._send(b'\x85')
+        await asyncio.sleep(1)
+
+    ##### Cleaning Algorithms
+
+    async def set_clean_spot(self):
+        self._core.set_clean_spot()
+        await self._sent()
+
+    async def set_clean_clean(self):
+        self._core.set_clean_clean()
+        await self._sent()
+
+    async def set_clean_max_clean(self):
+        self._core.set_clean_max_clean()
+        await self._sent()
+
+    ##### Drive
+
+    async def set_drive(self, velocity_mms, radius_mm):
+        self._core.set_drive(velocity_mms, radius_mm)
+        await self._sent()
+
+    async def set_drive_stop(self):
+        self._core.set_drive_stop()
+        await self._sent()
+
+    def emergency_stop(self):
+        """Stop now and ignore drive commands until release_drive. See Roomba.emergency_stop."""
+        self._core.emergency_stop()
+
+    def release_drive(self):
+        self._core.release_drive()
+
+    async def set_drive_straight(self, velocity_mms):
+        self._core.set_drive_straight(velocity_mms)
+        await self._sent()
+
+    async def set_drive_spin_cw(self, velocity_mms):
+        self._core.set_drive_spin_cw(velocity_mms)
+        await self._sent()
+
+    async def set_drive_spin_ccw(self, velocity_mms):
+        self._core.set_drive_spin_ccw(velocity_mms)
+        await self._sent()
+
+    async def set_drive_direct(self, left_mms, right_mms):
+        self._core.set_drive_direct(left_mms, right_mms)
+        await self._sent()
+
+    async def set_drive_pwm(self, left_pwm, right_pwm):
+        self._core.set_drive_pwm(left_pwm, right_pwm)
+        await self._sent()
+
+    async def set_seek_dock(self):
+        self._core.set_seek_dock()
+        await self._sent()
+
+    ##### Cleaning Motors
+
+    async def set_cleaning_motors(self, main_brush_on, main_brush_outward, side_brush_on, side_brush_cw, vacuum_on):
+        self._core.set_cleaning_motors(main_brush_on, main_brush_outward, side_brush_on, side_brush_cw, vacuum_on)
+        await self._sent()
+
+    ##### LED Control
+
+    async def set_leds(self, check, dock, spot, debris, power_color, power_intensity):
+        self._core.set_leds(check, dock, spot, debris, power_color, power_intensity)
+        await self._sent()
+
+    ##### Music Control
+
+    async def set_song(self, number, notes):
+        self._core.set_song(number, notes)
+        await self._sent()
+
+    async def play_song(self, number):
+        self._core.play_song(number)
+        await self._sent()
+
+    ##### Sensor Control
+
+    async def query(self, sensor_objects, timeout=QUERY_TIMEOUT):
+        """Opcode 142/149: Read a list of packets. Returns the list of objects.
+
+        Raises:
+            TimeoutError if the robot doesn't answer in "timeout" seconds
+        """
+        future = self._core.query_async(sensor_objects)
+        start = time.monotonic()
+        try:
+            ret = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self._core._forget_query(future)
+            raise TimeoutError('The robot did not answer the sensor query in '+str(timeout)+' seconds')
+        latency = self._core.latency
+        if latency is not None:
+            latency.wait_for_input.add(time.monotonic()-start)
+        return ret
+
+    async def get_sensor_packet(self, sensor_object, timeout=QUERY_TIMEOUT):
+        await self.query([sensor_object], timeout)
+
+    async def get_sensor_multi_packets(self, sensor_objects, timeout=QUERY_TIMEOUT):
+        await self.query(sensor_objects, timeout)
+
+    async def start_packet_stream(self, sensor_objects, recorder=None, log=None, lazy=False):
+        """Opcode 148: Start streaming to the stream consumers. See Roomba.start_packet_stream.
+
+        Use "stream" instead to loop over the frames yourself.
+        """
+        self._core.start_packet_stream(sensor_objects, recorder, log, lazy)
+        await self._sent()
+
+    async def pause_packet_stream(self):
+        self._core.pause_packet_stream()
+        await self._sent()
+
+    async def resume_packet_stream(self):
+        self._core.resume_packet_stream()
+        await self._sent()
+
+    def get_stream_counters(self):
+        return self._core.get_stream_counters()
+
+    def enable_latency_metrics(self, bounds=None):
+        """Start timing the driver. See Roomba.enable_latency_metrics."""
+        if bounds is None:
+            return self._core.enable_latency_metrics()
+        return self._core.enable_latency_metrics(bounds)
+
+    def add_stream_consumer(self, consumer):
+        """Feed every stream frame to an object. See Roomba.add_stream_consumer."""
+        self._core.add_stream_consumer(consumer)
+
+    def remove_stream_consumer(self, consumer):
+        self._core.remove_stream_consumer(consumer)
+
+    async def stream(self, sensor_objects, recorder=None, log=None, lazy=False):
+        """Opcode 148: Stream packets as an async iterator.
+
+        Every iteration gives you the list of sensor objects with the newest values.
+        The objects are decoded in place, so if you are slower than 15ms you skip
+        frames (you always see the latest). The stream is paused when you leave the
+        loop.
+
+        Args:
+            sensor_objects: list of sensor packet and sensor group objects
+            recorder: optional TelemetryRecorder to keep a history of every frame
+            log: optional TelemetryLogWriter to save every raw frame to disk
+            lazy: True to decode each field only when it is read
+        """
+        core = self._core
+        new_frame = asyncio.Event()
+        core._stream_update_cb = lambda packets: new_frame.set()
+        core.start_packet_stream(sensor_objects, recorder, log, lazy)
+        try:
+            while True:
+                await new_frame.wait()
+                new_frame.clear()
+                yield core._stream_packets
+        finally:
+            core._watch_for_stream = False
+            core._stream_update_cb = None
+            core.pause_packet_stream()
@@ -0,0 +1,89 @@
+"""
+Compare the hand-written packet decoders with the compiled decoders.
+
+  python bench_decoders.py
+
+Prints decodes/sec for every sensor group, a few single packets, and a typical
+stream list (with the ID bytes). The last line compares the compiled decoder with
+the lazy one reading three fields.
+"""
+
+import os
+import time
+
+import sensor_groups
+import sensor_packets
+from compiled_decoder import CompiledDecoder
+
+SECONDS = 0.5
+
+
+def rate(fn, data):
+    count = 0
+    start = time.perf_counter()
+    end = start + SECONDS
+    while True:
+        for _ in range(1000):
+            fn(data, 0)
+        count += 1000
+        now = time.perf_counter()
+        if now >= end:
+            return count / (now-start)
+
+
+def hand_stream_decode(packets):
+    # The per-packet loop Roomba used before the compiled decoders
+    def decode(data, ofs):
+        pos = ofs
+        for p in packets:
+            if p.ID != data[pos]:
+                return None
+            p.decode(data, pos+1)
+            pos += p.SIZE + 1
+        return True
+    return decode
+
+
+def compare(name, hand, compiled, data, labels=('hand', 'compiled')):
+    a = rate(hand, data)
+    b = rate(compiled, data)
+    print('%-28s %s:%10.0f/s  %s:%10.0f/s  %5.1fx' % (name, labels[0], a, labels[1], b, b/a))
+
+
+if __name__ == '__main__':
+
+    for cls in [sensor_packets.Buttons, sensor_packets.Distance, sensor_packets.ChargingState,
+                sensor_groups.Group_0, sensor_groups.Group_1, sensor_groups.Group_2,
+                sensor_groups.Group_3, sensor_groups.Group_4, sensor_groups.Group_5,
+                sensor_groups.Group_6, sensor_groups.Group_100, sensor_groups.Group_101,
+                sensor_groups.Group_106, sensor_groups.Group_107]:
+        obj = cls()
+        data = os.urandom(cls.SIZE)
+        compare(cls.__name__, obj.decode, CompiledDecoder([obj]).decode, data)
+
+    packets = [sensor_packets.BumpsAndWheelDrops(), sensor_packets.LeftEncoderCounts(),
+               sensor_packets.RightEncoderCounts(), sensor_groups.Group_3()]
+    data = bytearray()
+    for p in packets:
+        data.append(p.ID)
+        data += os.urandom(p.SIZE)
+    compare('stream [7,43,44,group 3]', hand_stream_decode(packets),
+            CompiledDecoder(packets, stream=True).decode, data)
+
+    packets = [sensor_groups.Group_100()]
+    data = bytes([100]) + os.urandom(sensor_groups.Group_100.SIZE)
+    compare('stream [group 100]', hand_stream_decode(packets),
+            CompiledDecoder(packets, stream=True).decode, data)
+
+    # Lazy: unpack only, then read the bumpers and the OI mode like a control loop would
+    group = sensor_groups.Group_100()
+    lazy = CompiledDecoder([group], stream=True, lazy=True).decode
+
+    def lazy_and_read(data, ofs):
+        lazy(data, ofs)
+        group.bumpsAndWheelDrops.bump_left
+        group.bumpsAndWheelDrops.bump_right
+        group.oIMode.mode
+
+    compare('stream [group 100] lazy', CompiledDecoder(packets, stream=True).decode,
+            lazy_and_read, data, ('compiled', 'lazy'))
@@ -0,0 +1,75 @@
+"""
+Stream Group_100 from many simulated robots and measure the driver's CPU.
+
+  python bench_fleet.py [num_robots] [seconds]
+
+The simulated robots run in a separate process (sim_robot.py as a TCP server) so the
+CPU measured here is only the driver's. We run the robots once as plain Roombas (an
+input thread each) and once in a Fleet (one thread for all of them).
+
+Linux only.
+"""
+
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sensor_groups
+from fleet import Fleet
+from roomba import Roomba
+from sim_robot import STREAM_PERIOD
+from transports import SocketTransport
+
+SIM_PORT = 9321
+
+
+def connect(num_robots):
+    # Retry until the server is listening
+    for _ in range(50):
+        try:
+            return [SocketTransport('127.0.0.1', SIM_PORT) for _ in range(num_robots)]
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise RuntimeError('The simulator did not start')
+
+
+def measure(name, robots, seconds, counters):
+    for robot in robots:
+        robot.start_packet_stream([sensor_groups.Group_100()])
+    time.sleep(0.5)
+    start = counters()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    frames = counters() - start
+    for robot in robots:
+        robot.pause_packet_stream()
+    print('%-8s robots:%3d  frames:%6d (%.1f/s per robot, expected %.1f)  CPU:%5.1f%%' % (
+        name, len(robots), frames, frames/wall/len(robots), 1/STREAM_PERIOD, 100.0*cpu/wall))
+
+
+if __name__ == '__main__':
+
+    num_robots = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    sim = subprocess.Popen([sys.executable, 'sim_robot.py', str(SIM_PORT)], stdout=subprocess.DEVNULL)
+    try:
+        # The constructor sleeps two seconds for the mode changes. Do them all at once.
+        with ThreadPoolExecutor(num_robots) as pool:
+            robots = list(pool.map(lambda t: Roomba(transport=t), connect(num_robots)))
+        measure('threads', robots, seconds,
+                lambda: sum(r.get_stream_counters()['packets'] for r in robots))
+        for robot in robots:
+            robot.roomba.close()
+
+        fleet = Fleet()
+        robots = [fleet.add(transport=t, name=str(i), wake=False) for i, t in enumerate(connect(num_robots))]
+        measure('fleet', robots, seconds, lambda: fleet.get_counters()['total']['packets'])
+        print(fleet.get_counters()['total'], 'wakeups:', fleet.get_counters()['wakeups'])
+        fleet.close()
+    finally:
+        sim.kill()
@@ -0,0 +1,92 @@
+"""
+Measure get_sensor_packet round trips against the simulated robot.
+
+  python bench_query_latency.py [num_queries] [pty|memory]
+
+The simulated robot (sim_robot.py) answers sensor queries after about 2ms, like the
+real thing. With "pty" (the default) the Roomba driver opens the pty's slave side
+just like a USB serial port. We time the same queries with the old 0.25s sleep-poll
+wait and with the condition variable the input thread signals now. Then we keep
+several queries in flight with query_async.
+
+The "pipelined" rate is not what pipelining saves on a real robot. SimulatedCreate
+handles one query at a time and sleeps response_delay before every answer, so
+queries in flight still wait their turn and the rate comes out about the same as
+"condition". The line only shows that pipelined queries work.
+
+"pty" needs pyserial. Linux only.
+"""
+
+import sys
+import time
+
+import sensor_packets
+from roomba import Roomba
+from sim_robot import SimulatedCreate
+
+ROBOT_RESPONSE_SECS = 0.002
+
+
+def simulated_robot(link):
+    # Returns the keyword arguments for Roomba
+    if link == 'memory':
+        sim, transport = SimulatedCreate.on_memory()
+        kwargs = {'transport': transport}
+    else:
+        sim, port_name = SimulatedCreate.on_pty()
+        kwargs = {'port_name': port_name}
+    sim.response_delay = ROBOT_RESPONSE_SECS
+    return kwargs
+
+
+class SleepPollRoomba(Roomba):
+    """The driver's original query: clear, write, then sleep-poll in 0.25s steps."""
+
+    def get_sensor_packet(self, sensor_object):
+        self._clear_input_buffer()
+        self.roomba.write(bytes([0x8E, sensor_object.ID]))
+        while len(self._buffer)<sensor_object.SIZE:
+            time.sleep(0.25)
+        sensor_object.decode(bytes(self._buffer[:sensor_object.SIZE]),0)
+        self._clear_input_buffer()
+
+
+def measure(name, roomba, num_queries):
+    packet = sensor_packets.Angle()
+    times = []
+    for _ in range(num_queries):
+        start = time.perf_counter()
+        roomba.get_sensor_packet(packet)
+        times.append(time.perf_counter()-start)
+    times.sort()
+    print('%-12s queries:%5d  p50:%8.2fms  p99:%8.2fms  max:%8.2fms  rate:%7.1f/s' % (
+        name, num_queries, 1000*times[len(times)//2], 1000*times[int(len(times)*0.99)],
+        1000*times[-1], num_queries/sum(times)))
+
+
+def measure_pipelined(name, roomba, num_queries, depth):
+    # Keep "depth" queries in flight, each with its own packet object. (The
+    # simulator answers them one at a time, so expect no gain here.)
+    packets = [sensor_packets.Angle() for _ in range(depth)]
+    in_flight = []
+    start = time.perf_counter()
+    for i in range(num_queries):
+        if len(in_flight) == depth:
+            in_flight.pop(0).result()
+        in_flight.append(roomba.query_async([packets[i%depth]]))
+    for future in in_flight:
+        future.result()
+    secs = time.perf_counter()-start
+    print('%-12s queries:%5d  depth:%2d  rate:%7.1f/s' % (name, num_queries, depth, num_queries/secs))
+
+
+if __name__ == '__main__':
+
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    link = sys.argv[2] if len(sys.argv) > 2 else 'pty'
+
+    # One simulated robot per driver. Each driver's input thread owns its port.
+    measure('sleep-poll', SleepPollRoomba(**simulated_robot(link)), max(num_queries//20, 10))
+    roomba = Roomba(**simulated_robot(link))
+    measure('condition', roomba, num_queries)
+    measure_pipelined('pipelined', roomba, num_queries, 4)
@@ -0,0 +1,50 @@
+"""
+Stream from the simulated robot and measure the driver's side of it.
+
+  python bench_sim_stream.py [seconds] [pty|memory] [baud]
+
+The simulated robot sends a Group_100 frame every 15ms paced to the baud rate. We
+count the frames that make it to the stream callback, the framing counters, and the
+CPU the process uses to keep up.
+
+"pty" needs pyserial. Linux only.
+"""
+
+import sys
+import time
+
+import sensor_groups
+from roomba import Roomba
+from sim_robot import SimulatedCreate, STREAM_PERIOD
+
+
+if __name__ == '__main__':
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    link = sys.argv[2] if len(sys.argv) > 2 else 'pty'
+    baud = int(sys.argv[3]) if len(sys.argv) > 3 else 115200
+
+    if link == 'memory':
+        sim, transport = SimulatedCreate.on_memory(baud)
+        kwargs = {'transport': transport}
+    else:
+        sim, port_name = SimulatedCreate.on_pty(baud)
+        kwargs = {'port_name': port_name, 'baud': baud}
+
+    frames = [0]
+    def got_stream_update(packets):
+        frames[0] += 1
+
+    roomba = Roomba(stream_update_cb=got_stream_update, **kwargs)
+    roomba.start_packet_stream([sensor_groups.Group_100()])
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+
+    # The process time includes the simulator's threads
+    print('link:%s baud:%d  frames:%d (%.1f/s, expected %.1f/s)  CPU (driver+simulator):%.1f%%' % (
+        link, baud, frames[0], frames[0]/wall, 1/STREAM_PERIOD, 100.0*cpu/wall))
+    print(roomba.get_stream_counters())
@@ -0,0 +1,153 @@
+"""
+Benchmark the stream reader against the old byte-at-a-time reader.
+
+This does not need a robot. It builds a recorded Group_100 byte stream (or loads one
+from a file) and plays it through a fake serial port into both readers.
+
+  python bench_stream_reader.py [recorded_stream.bin]
+
+"CPU at 15ms" is the share of one core the reader needs to keep up with a real
+stream (one frame every 15ms).
+"""
+
+import array
+import fcntl
+import os
+import sys
+import termios
+import threading
+import time
+
+import sensor_groups
+from compiled_decoder import CompiledDecoder
+from stream_decoder import StreamDecoder
+
+FRAME_PERIOD = 0.015
+
+
+class RecordedPort:
+    """Just enough of a serial.Serial to feed recorded bytes to a reader.
+
+    The bytes come through an OS pipe so every read is a real system call, like
+    reading from the serial port.
+    """
+
+    def __init__(self, data):
+        self._rd, wr = os.pipe()
+        self.num_reads = 0
+        def feeder():
+            os.write(wr, data)
+            os.close(wr)
+        th = threading.Thread(target=feeder)
+        th.daemon = True
+        th.start()
+
+    @property
+    def in_waiting(self):
+        buf = array.array('i', [0])
+        fcntl.ioctl(self._rd, termios.FIONREAD, buf)
+        return buf[0]
+
+    def read(self, size=1):
+        ret = b''
+        while len(ret) < size:
+            self.num_reads += 1
+            d = os.read(self._rd, size-len(ret))
+            if not d:
+                break
+            ret += d
+        return ret
+
+    def close(self):
+        os.close(self._rd)
+
+
+def make_frame(packet_id, payload):
+    frame = bytes([19, len(payload)+1, packet_id]) + payload
+    checksum = (256 - (sum(frame) & 255)) & 255
+    return frame + bytes([checksum])
+
+
+def make_recording(num_frames):
+    # Vary the encoder and signal bytes a little so every frame is different
+    frames = []
+    for i in range(num_frames):
+        payload = bytearray(sensor_groups.Group_100.SIZE)
+        payload[36] = (i>>8) & 255
+        payload[37] = i & 255
+        payload[38] = (i*3>>8) & 255
+        payload[39] = (i*3) & 255
+        payload[41] = i & 15
+        frames.append(make_frame(100, bytes(payload)))
+    return b''.join(frames)
+
+
+def legacy_reader(port, packets, cb, num_frames):
+    # The original Roomba._input_thread stream loop
+    count = 0
+    while count < num_frames:
+        while True:
+            d = port.read(1)
+            if d[0] == 19:
+                break
+        size = port.read(1)[0]
+        data = port.read(size)
+        _ = port.read(1)[0]
+        count += 1
+        pos = 0
+        ok = True
+        for p in packets:
+            if pos+p.SIZE+1 > size or p.ID != data[pos]:
+                ok = False
+                break
+            p.decode(data,pos+1)
+            pos += p.SIZE + 1
+        if ok:
+            cb(packets)
+
+
+def bulk_reader(port, packets, cb, num_frames):
+    # The StreamDecoder path used by Roomba._input_thread
+    decoder = CompiledDecoder(packets, stream=True)
+    def frame(data, ofs, size):
+        if decoder.decode(data, ofs) is not None:
+            cb(packets)
+    framer = StreamDecoder(frame, sum(p.SIZE+1 for p in packets))
+    while framer.num_frames < num_frames:
+        data = port.read(1)
+        waiting = port.in_waiting
+        if waiting:
+            data += port.read(waiting)
+        framer.feed(data)
+
+
+def run(name, reader, recording, num_frames):
+    port = RecordedPort(recording)
+    packets = [sensor_groups.Group_100()]
+    seen = [0]
+    def cb(p):
+        seen[0] += 1
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    reader(port, packets, cb, num_frames)
+    port.close()
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    rate = num_frames / wall
+    print('%-8s frames/sec:%10.0f  reads/frame:%6.2f  CPU:%5.0f%%  CPU at 15ms:%6.2f%%  decoded:%d' % (
+        name, rate, port.num_reads/num_frames, 100.0*cpu/wall,
+        100.0*cpu/num_frames/FRAME_PERIOD, seen[0]))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            recording = f.read()
+        num_frames = recording.count(bytes([19, sensor_groups.Group_100.SIZE+1, 100]))
+    else:
+        num_frames = 20000
+        recording = make_recording(num_frames)
+
+    run('legacy', legacy_reader, recording, num_frames)
+    run('bulk', bulk_reader, recording, num_frames)
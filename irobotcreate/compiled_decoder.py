@@ -0,0 +1,226 @@
+"""
+Fast decoders built from the packet layouts in "sensor_packets.py".
+
+The packet classes decode themselves one field at a time, and a group calls the
+decode of every packet in it. That is a lot of python method calls for every stream
+frame (Group_100 is 80 bytes of 45 packets).
+
+A CompiledDecoder looks at a list of packet/group objects once and writes a single
+python function that unpacks all of the data with one struct.unpack_from and then
+sets every attribute directly. The objects are the same ones you passed in, so your
+code reads the values just like before.
+
+  p1 = sensor_packets.Buttons()
+  p2 = sensor_groups.Group_100()
+  dec = CompiledDecoder([p1, p2])
+  dec.decode(data, 0)
+  print(p2.bumpsAndWheelDrops.bump_left)
+
+For the packet stream (opcode 148) every packet is preceded by its ID. Pass
+stream=True and the decoder checks the IDs too. It returns None if they don't match.
+
+Pass lazy=True and the decoder only unpacks. Each field is worked out from the raw
+value when it is read (every time it is read: copy it to a local if you need it twice).
+The packet objects become lazy versions of their classes (same name, same
+attributes, isinstance still works). Code that reads a few fields of a big group
+pays for just those fields.
+"""
+
+import struct
+
+import sensor_groups
+import sensor_packets
+
+
+def _make_packet_classes():
+    ret = {}
+    for mod in (sensor_packets, sensor_groups):
+        for cls in vars(mod).values():
+            if isinstance(cls, type) and hasattr(cls, 'SIZE'):
+                ret[cls.ID] = cls
+    return ret
+
+# Packet/group ID -> sensor packet or sensor group class
+PACKET_CLASSES = _make_packet_classes()
+
+
+def flatten_packets(sensor_objects):
+    """Break groups down into the packets they hold.
+
+    Args:
+        sensor_objects: list of sensor packet and sensor group objects
+
+    Returns:
+        list of (top-level object, packet object or None, size) in data order. The
+        packet is None for the unused bytes inside a group.
+    """
+    ret = []
+    for obj in sensor_objects:
+        if hasattr(obj, 'FORMAT'):
+            ret.append((obj, obj, obj.SIZE))
+            continue
+        # A group: the packets are attributes listed in ID order
+        total = 0
+        next_id = None
+        for p in vars(obj).values():
+            if not hasattr(p, 'FORMAT'):
+                continue
+            while next_id is not None and next_id < p.ID:
+                size = sensor_packets.UNUSED_PACKET_SIZES[next_id]
+                ret.append((obj, None, size))
+                total += size
+                next_id += 1
+            ret.append((obj, p, p.SIZE))
+            total += p.SIZE
+            next_id = p.ID + 1
+        while total < obj.SIZE and next_id in sensor_packets.UNUSED_PACKET_SIZES:
+            size = sensor_packets.UNUSED_PACKET_SIZES[next_id]
+            ret.append((obj, None, size))
+            total += size
+            next_id += 1
+        if total != obj.SIZE:
+            raise ValueError('Group '+str(obj.ID)+' layout is '+str(total)+' bytes, expected '+str(obj.SIZE))
+    return ret
+
+
+class _Frame:
+    # The values of the newest frame, shared by all the packets of a lazy decoder
+    __slots__ = ('values', 'touched')
+
+    def __init__(self):
+        self.values = None
+        # (instance dict, field name) of every field set by hand since the last frame
+        self.touched = []
+
+    def forget(self):
+        for d, name in self.touched:
+            d.pop(name, None)
+        del self.touched[:]
+
+
+# A field worked out from the frame's raw value every time it is read
+_LAZY_FIELD = '''
+class LazyField:
+    __slots__ = ()
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        frame = obj._frame
+        if frame is None or frame.values is None:
+            return None
+        x = frame.values[obj._index]
+        return %s
+'''
+
+
+def _lazy_setattr(self, name, value):
+    # A field set by the packet's own decode (or an eager decoder) hides the lazy
+    # field until the next frame
+    d = self.__dict__
+    if name not in d and name in self._field_names and self._frame is not None:
+        self._frame.touched.append((d, name))
+    d[name] = value
+
+
+_lazy_classes = {}
+
+
+def _lazy_class(cls):
+    # A subclass of a packet class with a lazy field for every field
+    if '_field_names' in vars(cls):
+        # Already lazy
+        return cls
+    ret = _lazy_classes.get(cls)
+    if ret is None:
+        attrs = {'_frame': None, '_index': None, '__setattr__': _lazy_setattr,
+                 '_field_names': frozenset(attr for attr, _ in cls.FIELDS)}
+        for attr, expr in cls.FIELDS:
+            names = dict(vars(sensor_packets))
+            exec(_LAZY_FIELD % expr, names)
+            attrs[attr] = names['LazyField']()
+        # Same name: the stream consumers find packets by class name
+        ret = type(cls.__name__, (cls,), attrs)
+        ret.__qualname__ = cls.__qualname__
+        ret.__module__ = cls.__module__
+        _lazy_classes[cls] = ret
+    return ret
+
+
+class CompiledDecoder:
+
+    def __init__(self, sensor_objects, stream=False, lazy=False):
+        """Build a decoder for a list of packets/groups.
+
+        Args:
+            sensor_objects: list of sensor packet and sensor group objects
+            stream: True if every top level object is preceded by its ID byte
+            lazy: True to work out each field only when it is read
+        """
+        self.sensor_objects = sensor_objects
+        self.stream = stream
+        self.lazy = lazy
+        frame = _Frame() if lazy else None
+
+        fmt = '>'
+        # One name per unpacked value: the packet class name, or None for an ID byte
+        self.value_names = []
+        self.value_formats = []
+        lines = ['def decode(buf, ofs):', '    v = unpack_from(buf, ofs)']
+        apply_lines = ['def apply(v):']
+        id_checks = []
+        names = dict(vars(sensor_packets))
+
+        last_top = None
+        for top, p, size in flatten_packets(sensor_objects):
+            if stream and top is not last_top:
+                id_checks.append('v['+str(len(self.value_names))+']!='+str(top.ID))
+                fmt += 'B'
+                self.value_names.append(None)
+                self.value_formats.append('B')
+            last_top = top
+            if p is None:
+                fmt += str(size)+'x'
+                continue
+            if lazy:
+                cls = _lazy_class(type(p))
+                if type(p) is not cls:
+                    p.__class__ = cls
+                    for attr, _ in p.FIELDS:
+                        p.__dict__.pop(attr, None)
+                p._frame = frame
+                p._index = len(self.value_names)
+            else:
+                obj_name = 'o'+str(len(self.value_names))
+                names[obj_name] = p
+                field_lines = ['    x = v['+str(len(self.value_names))+']']
+                for attr, expr in p.FIELDS:
+                    field_lines.append('    '+obj_name+'.'+attr+' = '+expr)
+                lines += field_lines
+                apply_lines += field_lines
+            fmt += p.FORMAT
+            self.value_names.append(type(p).__name__)
+            self.value_formats.append(p.FORMAT)
+
+        if lazy:
+            # A new frame: forget the fields worked out from the last one
+            names['frame'] = frame
+            names['touched'] = frame.touched
+            for body in (lines, apply_lines):
+                body += ['    if touched: frame.forget()', '    frame.values = v']
+        if id_checks:
+            lines.insert(2, '    if '+' or '.join(id_checks)+': return None')
+        lines.append('    return v')
+        apply_lines.append('    return v')
+
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        names['unpack_from'] = self.struct.unpack_from
+        exec('\n'.join(lines), names)
+        exec('\n'.join(apply_lines), names)
+        # decode(buf, ofs) fills in the packet objects from buf[ofs:]. It returns the
+        # tuple of raw values (or None if the stream IDs do not match).
+        self.decode = names['decode']
+        # apply(values) fills in the packet objects from a tuple of values returned by
+        # another decoder with the same layout.
+        self.apply = names['apply']
@@ -1,24 +1,55 @@
 from sensor_packets import Angle
 from sensor_packets import Distance
 
+import math
 import time
 
 class Drive:
+    """Wait for the robot to get somewhere. You start the wheels.
+
+    Without an odometry these poll the Distance and Angle packets. With one (fed by
+    the packet stream) they wake up on every stream frame instead. For moves that
+    also run the wheels see the MotionExecutor in "motion.py".
+
+    With an odometry, a wait raises TimeoutError if no frame comes in for
+    update_timeout seconds (the stream is paused or stopped, or the link is dead).
+    """
     
-    def __init__(self,robot):
+    def __init__(self,robot,odometry=None,update_timeout=1.0):
         self._robot = robot
+        self._odometry = odometry
+        self._update_timeout = update_timeout
         # We can reuse these
         self._angle_packet = Angle()
         self._distance_packet = Distance()
                 
+    def _wait_for_pose(self, done):
+        start = self._odometry.pose
+        pose = start
+        while not done(start, pose):
+            pose = self._odometry.wait_for_update(pose.seq, self._update_timeout)
+            if pose is None:
+                raise TimeoutError('No odometry update in '+str(self._update_timeout)+
+                                   ' seconds. Is the packet stream running?')
+            
+    # The Distance and Angle packets are reset every time they are read. Read once
+    # to start from zero, then keep a running total.
+    
     def turn_ccw_to_angle(self,angle_deg):        
+        if self._odometry:
+            return self._wait_for_pose(lambda s,p: math.degrees(p.heading-s.heading)>=angle_deg)
+        self._robot.get_sensor_packet(self._angle_packet)  
+        total = 0
         while True:
             self._robot.get_sensor_packet(self._angle_packet)
-            if self._angle_packet.since_last_deg>=angle_deg:
+            total += self._angle_packet.since_last_deg 
+            if total>=angle_deg:
                 return
             time.sleep(.01)
             
     def turn_cw_to_angle(self,angle_deg): 
+        if self._odometry:
+            return self._wait_for_pose(lambda s,p: math.degrees(p.heading-s.heading)<=angle_deg)
         self._robot.get_sensor_packet(self._angle_packet)  
         total = 0
         time.sleep(0.05)
@@ -30,51 +61,59 @@ class Drive:
             time.sleep(.1)
     
     def drive_forward_to_distance(self, distance_mm):
+        if self._odometry:
+            return self._wait_for_pose(lambda s,p: p.distance_mm-s.distance_mm>=distance_mm)
+        self._robot.get_sensor_packet(self._distance_packet)  
+        total = 0
         while True:
             self._robot.get_sensor_packet(self._distance_packet)
-            if self._distance_packet.since_last_mm>=distance_mm:
+            total += self._distance_packet.since_last_mm
+            if total>=distance_mm:
                 return
             time.sleep(.01)
             
     def drive_backward_to_distance(self, distance_mm):
+        if self._odometry:
+            return self._wait_for_pose(lambda s,p: p.distance_mm-s.distance_mm<=distance_mm)
+        self._robot.get_sensor_packet(self._distance_packet)  
+        total = 0
         while True:
             self._robot.get_sensor_packet(self._distance_packet)
-            if self._distance_packet.since_last_mm<=distance_mm:
+            total += self._distance_packet.since_last_mm
+            if total<=distance_mm:
                 return
             time.sleep(.01)        
 
-import time
-from IRobotCreate import irobot_create
-from IRobotCreate import sensor_packets
-
-robot = irobot_create.Roomba('/dev/ttyUSB0')
-robot_util = Drive(robot)
+if __name__ == '__main__':
 
-robot.set_mode_safe()
+    from roomba import Roomba
+    import sensor_packets
 
-left = sensor_packets.LeftEncoderCounts()
-right = sensor_packets.RightEncoderCounts()
+    robot = Roomba('/dev/ttyUSB0')
+    robot_util = Drive(robot)
 
+    robot.set_mode_safe()
 
-#robot.get_sensor_packet(left)
-#robot.get_sensor_packet(right)
+    left = sensor_packets.LeftEncoderCounts()
+    right = sensor_packets.RightEncoderCounts()
 
-#lb = left.count
-#rb = right.count
 
-robot.set_drive_spin_cw(200)
-time.sleep(0.90)
+    #robot.get_sensor_packet(left)
+    #robot.get_sensor_packet(right)
 
-# 200 for 11.44 is 3 turns
-# 200 for 0.9 is 45degrees
+    #lb = left.count
+    #rb = right.count
 
-#
+    robot.set_drive_spin_cw(200)
+    time.sleep(0.90)
 
-robot.set_drive_stop()
+    # 200 for 11.44 is 3 turns
+    # 200 for 0.9 is 45degrees
 
+    #
 
-robot.set_mode_passive()
-robot.set_mode_stop()
+    robot.set_drive_stop()
 
 
-        
\ No newline at end of file
+    robot.set_mode_passive()
+    robot.set_mode_stop()
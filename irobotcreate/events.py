@@ -0,0 +1,159 @@
+"""
+Events for the sensor fields that change, instead of every field every 15ms.
+
+Most of a stream frame sits still for seconds at a time: the bumpers, cliffs,
+buttons, charging state, OI mode. The EventEngine is a stream consumer that compares
+each frame's raw values for the packets it watches with the last frame's. When
+nothing moved (almost always) that is one comparison and it is done. Only a packet
+whose value changed is decoded, and every field of it that changed becomes a
+SensorEvent.
+
+  def on_event(event):
+      print(event)     # BumpsAndWheelDrops.bump_left False -> True
+
+  events = EventEngine()
+  events.add_listener(on_event)
+  roomba.add_stream_consumer(events)
+  roomba.start_packet_stream([sensor_groups.Group_100()])
+
+Listeners run on the input thread. Keep them short (hand off to a StreamHub or a
+queue for anything slow).
+
+The first frame of a stream sets the starting values without any events. Use get
+for the value of a field at any time.
+"""
+
+import operator
+import time
+from collections import namedtuple
+
+import sensor_packets
+
+
+class SensorEvent(namedtuple('SensorEvent', 'packet field old new timestamp')):
+    """A field changed.
+
+    Attributes:
+        packet: the packet class name, like "BumpsAndWheelDrops"
+        field: the field name, like "bump_left"
+        old: the value in the frame before
+        new: the value now
+        timestamp: time.monotonic() the frame arrived
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        return self.packet+'.'+self.field+' '+str(self.old)+' -> '+str(self.new)
+
+
+# The packets that are quiet most of the time
+DEFAULT_PACKETS = (
+    sensor_packets.BumpsAndWheelDrops, sensor_packets.Wall, sensor_packets.CliffLeft,
+    sensor_packets.CliffFrontLeft, sensor_packets.CliffFrontRight, sensor_packets.CliffRight,
+    sensor_packets.VirtualWall, sensor_packets.WheelOvercurrents, sensor_packets.Buttons,
+    sensor_packets.ChargingState, sensor_packets.ChargingSourcesAvailable, sensor_packets.OIMode,
+    sensor_packets.SongPlaying, sensor_packets.LightBumper, sensor_packets.Stasis,
+)
+
+
+def _field_function(cls):
+    # function(x) -> tuple of the field values, from the packet's FIELDS
+    names = dict(vars(sensor_packets))
+    exprs = ', '.join(expr for _, expr in cls.FIELDS)
+    exec('def fields(x): return ('+exprs+',)', names)
+    return names['fields']
+
+
+class EventEngine:
+
+    def __init__(self, packets=DEFAULT_PACKETS):
+        """Create an engine.
+
+        Args:
+            packets: the packet classes to watch. Packets in the stream that aren't
+                in this list are ignored.
+        """
+        self.packets = tuple(packets)
+        self._listeners = []
+        self._watched = []
+        self._take = None
+        self._last = None
+        self.num_frames = 0
+        self.num_changed_frames = 0
+        self.num_events = 0
+
+    def add_listener(self, listener):
+        """Call function(event) on the input thread for every SensorEvent."""
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        listeners = list(self._listeners)
+        listeners.remove(listener)
+        self._listeners = listeners
+
+    def bind(self, decoder):
+        """Find the watched packets in a new stream. Roomba calls this for you."""
+        watched = []
+        indexes = []
+        names = {cls.__name__: cls for cls in self.packets}
+        for index, name in enumerate(decoder.value_names):
+            cls = names.get(name)
+            if cls is None:
+                continue
+            # [packet name, field names, fields function, current field values]
+            watched.append([name, [f for f, _ in cls.FIELDS], _field_function(cls), None])
+            indexes.append(index)
+        self._watched = watched
+        if not indexes:
+            self._take = lambda values: ()
+        elif len(indexes) == 1:
+            index = indexes[0]
+            self._take = lambda values: (values[index],)
+        else:
+            self._take = operator.itemgetter(*indexes)
+        self._last = None
+
+    def record(self, values, timestamp=None):
+        """Roomba calls this from the input thread for every frame."""
+        self.num_frames += 1
+        raw = self._take(values)
+        last = self._last
+        if raw == last:
+            return
+        self._last = raw
+        if last is None:
+            # The first frame: just the starting values
+            for ent, x in zip(self._watched, raw):
+                ent[3] = ent[2](x)
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.num_changed_frames += 1
+        listeners = self._listeners
+        for ent, x, old_x in zip(self._watched, raw, last):
+            if x == old_x:
+                continue
+            name, fields, func, old = ent
+            new = func(x)
+            ent[3] = new
+            for field, a, b in zip(fields, old, new):
+                if a != b:
+                    self.num_events += 1
+                    event = SensorEvent(name, field, a, b, timestamp)
+                    for listener in listeners:
+                        listener(event)
+
+    def get(self, packet, field):
+        """The latest value of a field (or None if it isn't watched in this stream).
+
+        Args:
+            packet: the packet class or its name
+            field: the field name
+        """
+        if isinstance(packet, type):
+            packet = packet.__name__
+        for name, fields, _, current in self._watched:
+            if name == packet and current is not None and field in fields:
+                return current[fields.index(field)]
+        return None
@@ -0,0 +1,200 @@
+"""
+Drive many robots from one process with one input thread.
+
+Every Roomba has an input thread of its own. That's fine for one robot, but a box
+with a dozen USB dongles ends up with a dozen threads fighting over the GIL, each
+waking up for every little chunk of serial data. The Fleet services all the ports
+from a single thread with the OS's selector (epoll on Linux): it sleeps until any
+port has data, reads everything that port has in one os.read, and runs it through
+that robot's decode path.
+
+  fleet = Fleet()
+  bots = fleet.open(['/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2'])
+  for bot in bots:
+      bot.start_packet_stream([sensor_groups.Group_100()])
+  ...
+  print(fleet.get_counters())
+
+The handles are Roomba objects (everything but the input thread is the same) so
+commands, queries, streams, and stream consumers work the same way. Commands are
+written from the calling thread just like Roomba.
+
+Any transport with a fileno works: serial ports, sockets, FdTransport. Not the
+MemoryTransport.
+"""
+
+import os
+import selectors
+import threading
+import time
+
+import transports
+from roomba import Roomba
+
+_READ_SIZE = 4096
+
+
+class FleetRoomba(Roomba):
+    """One robot in a Fleet. Use Fleet.add or Fleet.open to make these."""
+
+    def __init__(self, fleet, name, transport, stream_update_cb=None):
+        self._setup(stream_update_cb)
+        self.name = name
+        self.roomba = transport
+        self._fleet = fleet
+        self.num_reads = 0
+
+    def _on_readable(self, fd):
+        # On the fleet's thread
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except BlockingIOError:
+            return True
+        except OSError:
+            # A pty reports EIO when the other side goes away
+            data = b''
+        if not data:
+            return False
+        self.num_reads += 1
+        self._process_input(data)
+        return True
+
+    def close(self):
+        """Put OI in "passive" then "off" mode and take it out of the fleet."""
+        Roomba.close(self)
+        self._fleet.remove(self)
+
+
+class Fleet:
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self.robots = []
+        # Changes to the selector are made on the fleet's thread. Other threads queue
+        # them up and poke the wakeup pipe.
+        self._changes = []
+        self._changes_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._running = True
+        self.num_wakeups = 0
+        th = threading.Thread(target=self._io_thread)
+        th.daemon = True
+        self._thread = th
+        th.start()
+
+    def add(self, port_name='/dev/ttyUSB0', baud=115200, stream_update_cb=None, transport=None,
+            name=None, wake=True):
+        """Add a robot.
+
+        Args:
+            port_name: name of the port e.g. "/dev/ttyUSB0"
+            baud: baud rate of the interface
+            stream_update_cb: function(packets) called for every packet stream frame
+            transport: talk over this instead of opening port_name
+            name: name for the counters. Defaults to the port name.
+            wake: put the OI in "passive" then "safe" mode (takes two seconds)
+
+        Returns:
+            the robot's FleetRoomba
+        """
+        if transport is None:
+            transport = transports.open_serial(port_name, baud)
+        robot = FleetRoomba(self, name or port_name, transport, stream_update_cb)
+        self._change(self._selector.register, robot.roomba.fileno(), selectors.EVENT_READ, robot)
+        self.robots.append(robot)
+        if wake:
+            robot.set_mode_passive()
+            robot.set_mode_safe()
+        return robot
+
+    def open(self, port_names, baud=115200, stream_update_cb=None):
+        """Add a robot for every port and wake them all up together.
+
+        Returns:
+            list of FleetRoomba in the same order as the ports
+        """
+        robots = [self.add(p, baud, stream_update_cb, wake=False) for p in port_names]
+        # The mode commands sleep a second each. Send them to everyone, then sleep once.
+        for robot in robots:
+            robot._send(b'\x80')
+        time.sleep(1)
+        for robot in robots:
+            robot._send(b'\x83')
+        time.sleep(1)
+        return robots
+
+    def remove(self, robot):
+        """Stop reading a robot's port (the port is left open)."""
+        if robot in self.robots:
+            self.robots.remove(robot)
+            self._change(self._unregister, robot)
+
+    def close(self):
+        """Stop the fleet's thread and close every port."""
+        if not self._running:
+            return
+        self._running = False
+        os.write(self._wakeup_w, b'\x00')
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        # The thread is gone. Take the ports out of the selector, then close them.
+        for robot in list(self.robots):
+            self.robots.remove(robot)
+            self._unregister(robot)
+            robot.roomba.close()
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def get_counters(self):
+        """Stream counters for every robot and the fleet as a whole.
+
+        Returns:
+            dict with:
+              robots: {name: the robot's get_stream_counters() plus bytes_in and reads}
+              total: the sum of each counter over all the robots
+              wakeups: number of times the fleet's thread woke up
+        """
+        robots = {}
+        total = {}
+        for robot in list(self.robots):
+            c = robot.get_stream_counters()
+            c['bytes_in'] = robot.num_bytes_in
+            c['reads'] = robot.num_reads
+            robots[robot.name] = c
+            for k, v in c.items():
+                total[k] = total.get(k, 0) + v
+        return {'robots': robots, 'total': total, 'wakeups': self.num_wakeups}
+
+    def _change(self, func, *args):
+        with self._changes_lock:
+            self._changes.append((func, args))
+        os.write(self._wakeup_w, b'\x00')
+
+    def _unregister(self, robot):
+        try:
+            self._selector.unregister(robot.roomba.fileno())
+        except (KeyError, ValueError, OSError):
+            # Already gone (the port closed)
+            pass
+
+    def _io_thread(self):
+        selector = self._selector
+        while self._running:
+            events = selector.select()
+            self.num_wakeups += 1
+            for key, _ in events:
+                robot = key.data
+                if robot is None:
+                    # Wakeup pipe
+                    os.read(self._wakeup_r, 512)
+                    with self._changes_lock:
+                        changes = self._changes
+                        self._changes = []
+                    for func, args in changes:
+                        func(*args)
+                    continue
+                if not robot._on_readable(key.fd):
+                    # The port closed
+                    self._unregister(robot)
@@ -0,0 +1,179 @@
+"""
+Fixed-bucket latency histograms.
+
+A LatencyHistogram counts samples into buckets with fixed upper bounds. Adding a
+sample is a bisect and an increment, so it is cheap enough for the input thread.
+There is no lock: each histogram should have one writer (the thread taking the
+measurements). Any thread can read it.
+
+  h = LatencyHistogram()
+  h.add(0.0021)
+  print(h.get())   # count, mean, max, p50/p90/p99, and the buckets
+
+PrometheusText renders counters, gauges, and histograms as a Prometheus scrape page.
+"""
+
+from bisect import bisect_left
+
+# Upper bounds in seconds: 100us to 1s. Anything slower lands in the last bucket.
+DEFAULT_BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class LatencyHistogram:
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        """Create an empty histogram.
+
+        Args:
+            bounds: increasing bucket upper bounds in seconds. One more bucket
+                counts everything above the last.
+        """
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """The upper bound of the bucket holding the p-th percentile (0-100).
+
+        Returns:
+            seconds, the max for the overflow bucket, or None if there are no samples
+        """
+        if not self.count:
+            return None
+        rank = self.count*p/100.0
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def get(self):
+        """A snapshot.
+
+        Returns:
+            dict with:
+              count: number of samples
+              mean: average seconds
+              max: worst seconds
+              p50, p90, p99: percentiles (bucket upper bounds)
+              buckets: list of (upper bound, count). The last bound is None (overflow).
+        """
+        return {
+            'count': self.count,
+            'mean': self.total/self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.bounds+(None,), self.counts)),
+        }
+
+
+class LatencyMetrics:
+    """The driver's timings. Roomba.enable_latency_metrics makes one.
+
+    Attributes (all LatencyHistograms):
+        frame_to_callback: bytes of a stream frame read from the port to the
+            stream_update_cb being called
+        consumers: time in the stream consumers for a frame
+        callback: time in the stream_update_cb for a frame
+        write: time in the port's write
+        query: a sensor query sent to its answer decoded
+        wait_for_input: time get_sensor_packet/get_sensor_multi_packets (or
+            AsyncRoomba.query) wait for the answer
+        drive_echo: set_drive/set_drive_direct sent to the stream showing the robot
+            took it (RequestedVelocity/RequestedRadius or RequestedRightVelocity/
+            RequestedLeftVelocity, packets 39-42, must be in the stream)
+    """
+
+    NAMES = ('frame_to_callback', 'consumers', 'callback', 'write', 'query', 'wait_for_input', 'drive_echo')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        for name in self.NAMES:
+            setattr(self, name, LatencyHistogram(bounds))
+
+    def reset(self):
+        for name in self.NAMES:
+            getattr(self, name).reset()
+
+    def get(self):
+        """{name: LatencyHistogram.get()} for every histogram."""
+        return {name: getattr(self, name).get() for name in self.NAMES}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for k, v in sorted(labels.items()):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(k+'="'+v+'"')
+    return '{'+','.join(parts)+'}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class PrometheusText:
+    """Builds a page in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lines = []
+
+    def add(self, name, kind, help_text, samples):
+        """Add a counter or gauge.
+
+        Args:
+            name: metric name
+            kind: "counter" or "gauge"
+            help_text: one line of description
+            samples: a number, or a list of (labels dict, number)
+        """
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        self._lines.append('# HELP '+name+' '+help_text)
+        self._lines.append('# TYPE '+name+' '+kind)
+        for labels, value in samples:
+            self._lines.append(name+_format_labels(labels)+' '+_format_number(value))
+
+    def add_histogram(self, name, help_text, histograms):
+        """Add LatencyHistograms as a Prometheus histogram (in seconds).
+
+        Args:
+            name: metric name
+            help_text: one line of description
+            histograms: a LatencyHistogram, or a list of (labels dict, LatencyHistogram)
+        """
+        if not isinstance(histograms, list):
+            histograms = [({}, histograms)]
+        self._lines.append('# HELP '+name+' '+help_text)
+        self._lines.append('# TYPE '+name+' histogram')
+        for labels, hist in histograms:
+            counts = list(hist.counts)
+            seen = 0
+            for bound, n in zip(hist.bounds+(float('inf'),), counts):
+                seen += n
+                le = dict(labels)
+                le['le'] = _format_number(float(bound))
+                self._lines.append(name+'_bucket'+_format_labels(le)+' '+str(seen))
+            self._lines.append(name+'_sum'+_format_labels(labels)+' '+repr(hist.total))
+            self._lines.append(name+'_count'+_format_labels(labels)+' '+str(seen))
+
+    def render(self):
+        return '\n'.join(self._lines)+'\n'
@@ -0,0 +1,253 @@
+"""
+Closed-loop moves driven by the packet stream.
+
+The Drive helpers in "drive_util.py" start the wheels and then poll the robot until
+the move is done. The MotionExecutor runs on the stream instead: every 15ms frame
+updates the Odometry, and the executor picks the wheel speeds for the next 15ms
+(set_drive_direct) from a trapezoidal speed profile. It speeds up at a fixed rate,
+cruises, and slows down so the robot creeps over the finish line.
+
+  odo = Odometry()
+  roomba.add_stream_consumer(odo)
+  roomba.start_packet_stream([sensor_groups.Group_101()])
+  motion = MotionExecutor(roomba, odo)
+
+  motion.drive_distance(500)          # Queue moves. Each one returns a Future.
+  motion.turn_angle(90)
+  last = motion.drive_distance(250)
+  last.result()                       # Wait for the whole path
+
+Moves run back to back in the order they were queued. When a drive is followed by
+another drive in the same direction the robot doesn't slow down in between. Moves
+are measured from where the last one was supposed to end (not from where it actually
+stopped), so small errors don't add up along a path. Straight drives also steer to
+hold the heading.
+
+A move's future stays pending until the move is done, so future.cancel() works at any
+point. A cancelled move stops (or hands over to the next queued move) on the next
+frame. cancel_all() stops the robot right away.
+
+The executor does its work on the input thread. The robot must be in "safe" or
+"full" mode and streaming the encoder counts.
+"""
+
+import math
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from odometry import FRAME_PERIOD
+
+
+class MoveStalled(RuntimeError):
+    """The wheels are turned on but the robot isn't getting anywhere."""
+
+
+class _Move:
+
+    def __init__(self, turn, target, speed):
+        self.turn = turn                # True for a spin in place
+        self.target = target            # mm or radians (signed)
+        self.speed = abs(speed)         # cruise speed of the wheels (mm/s)
+        self.direction = 1 if target >= 0 else -1
+        self.future = Future()
+        self.start = None               # distance or heading the move is measured from
+
+
+class MotionExecutor:
+
+    def __init__(self, roomba, odometry, accel_mms2=500.0, min_speed_mms=20.0,
+                 heading_gain=2.0, stall_secs=1.0):
+        """Create an executor.
+
+        Args:
+            roomba: the robot to drive (set_drive_direct)
+            odometry: the Odometry being fed by the robot's stream
+            accel_mms2: how fast the wheel speed changes (mm/s per second)
+            min_speed_mms: slowest the wheels go before the move is done
+            heading_gain: how hard straight drives steer back to their heading (1/s)
+            stall_secs: fail a move that makes no progress for this long
+        """
+        self._roomba = roomba
+        self._odometry = odometry
+        self.accel_mms2 = accel_mms2
+        self.min_speed_mms = min_speed_mms
+        self.heading_gain = heading_gain
+        self.stall_secs = stall_secs
+        self._lock = threading.Lock()
+        self._moves = deque()
+        self._active = None
+        # Wheel speed from the profile (always positive -- the move has the direction)
+        self._speed = 0.0
+        self._sent = None
+        # Where the last move was supposed to end
+        self._distance_goal = None
+        self._heading_goal = None
+        self._best_remaining = None
+        self._stall_frames = 0
+        odometry.add_listener(self._on_pose)
+
+    def close(self):
+        """Cancel everything and stop listening to the odometry."""
+        self.cancel_all()
+        self._odometry.remove_listener(self._on_pose)
+
+    def drive_distance(self, distance_mm, speed_mms=200):
+        """Queue a straight drive.
+
+        Args:
+            distance_mm: how far (negative to back up)
+            speed_mms: cruise speed
+
+        Returns:
+            a Future. Its result is the Pose at the end of the move.
+        """
+        return self._queue(_Move(False, distance_mm, speed_mms))
+
+    def turn_angle(self, angle_deg, speed_mms=100):
+        """Queue a spin in place.
+
+        Args:
+            angle_deg: how far to turn (positive is counter-clockwise)
+            speed_mms: cruise speed of the wheels
+
+        Returns:
+            a Future. Its result is the Pose at the end of the move.
+        """
+        return self._queue(_Move(True, math.radians(angle_deg), speed_mms))
+
+    def cancel_all(self):
+        """Cancel the running move and all queued moves, and stop the wheels."""
+        with self._lock:
+            moves = list(self._moves)
+            self._moves.clear()
+            if self._active is not None:
+                moves.append(self._active)
+                self._active = None
+            self._speed = 0.0
+            self._stop()
+        for move in moves:
+            move.future.cancel()
+
+    def _queue(self, move):
+        with self._lock:
+            self._moves.append(move)
+        return move.future
+
+    def _drive(self, left, right):
+        left = int(round(left))
+        right = int(round(right))
+        if (left, right) != self._sent:
+            self._sent = (left, right)
+            self._roomba.set_drive_direct(left, right)
+
+    def _stop(self):
+        # Always sent: something else (or emergency_stop) may have driven the
+        # wheels since our last command
+        self._sent = (0, 0)
+        self._roomba.set_drive_direct(0, 0)
+
+    def _progress(self, move, pose):
+        # How far the wheels have rolled along the move (mm)
+        if move.turn:
+            return (pose.heading - move.start) * self._odometry.wheel_base_mm / 2
+        return pose.distance_mm - move.start
+
+    def _length(self, move):
+        if move.turn:
+            return abs(move.target) * self._odometry.wheel_base_mm / 2
+        return abs(move.target)
+
+    def _begin(self, move, pose, previous):
+        if previous is None or self._distance_goal is None:
+            # Starting from a stop. Measure from here.
+            self._distance_goal = pose.distance_mm
+            self._heading_goal = pose.heading
+        if move.turn:
+            move.start = self._heading_goal
+            self._heading_goal += move.target
+        else:
+            move.start = self._distance_goal
+            self._distance_goal += move.target
+        if previous is None or previous.turn != move.turn or previous.direction != move.direction:
+            self._speed = 0.0
+        self._best_remaining = None
+        self._stall_frames = 0
+        # Don't trust what we sent last: the first command of a move always goes out
+        self._sent = None
+
+    def _exit_speed(self, move):
+        # Keep rolling into the next move if it goes the same way
+        if self._moves:
+            nxt = self._moves[0]
+            if not nxt.turn and not move.turn and nxt.direction == move.direction:
+                return min(nxt.speed, move.speed)
+        return 0.0
+
+    def _on_pose(self, pose):
+        finished = []
+        failed = []
+        with self._lock:
+            move = self._active
+            previous = move
+            was_moving = move is not None
+            while True:
+                if move is None:
+                    if not self._moves:
+                        break
+                    move = self._moves.popleft()
+                    if move.future.cancelled():
+                        move = None
+                        continue
+                    self._begin(move, pose, previous)
+                elif move.future.cancelled():
+                    previous = None
+                    move = None
+                    continue
+                remaining = self._length(move) - move.direction*self._progress(move, pose)
+                if remaining <= self._speed*FRAME_PERIOD/2:
+                    # We would be past the end before the next frame
+                    finished.append(move.future)
+                    previous = move
+                    move = None
+                    continue
+                # Stalled? (Stuck on something, or safe mode shut the motors off.)
+                if self._best_remaining is None or remaining < self._best_remaining - 1:
+                    self._best_remaining = remaining
+                    self._stall_frames = 0
+                else:
+                    self._stall_frames += 1
+                    if self._stall_frames*FRAME_PERIOD > self.stall_secs:
+                        failed.append(move.future)
+                        previous = None
+                        move = None
+                        continue
+                break
+            self._active = move
+            if move is None:
+                self._speed = 0.0
+                self._distance_goal = self._heading_goal = None
+                if was_moving or finished or failed:
+                    self._stop()
+            else:
+                # Trapezoid: no faster than cruise, than we can stop from, or than
+                # we can get to from the last frame
+                exit_speed = self._exit_speed(move)
+                brake = math.sqrt(exit_speed*exit_speed + 2*self.accel_mms2*remaining)
+                speed = min(move.speed, brake, self._speed + self.accel_mms2*FRAME_PERIOD)
+                speed = max(speed, self.min_speed_mms)
+                self._speed = speed
+                speed *= move.direction
+                if move.turn:
+                    self._drive(-speed, speed)
+                else:
+                    steer = (self.heading_gain * (self._heading_goal - pose.heading) *
+                             self._odometry.wheel_base_mm / 2)
+                    self._drive(speed - steer, speed + steer)
+        # Outside the lock: these run the futures' callbacks
+        for future in finished:
+            if future.set_running_or_notify_cancel():
+                future.set_result(pose)
+        for future in failed:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(MoveStalled('No progress for '+str(self.stall_secs)+' seconds'))
@@ -0,0 +1,180 @@
+"""
+Dead reckoning from the wheel encoders.
+
+The Distance and Angle packets are whole mm and whole degrees since the last time
+you asked, so every read throws away a fraction. The encoder counts (packets 43 and
+44) are raw running totals that never reset. They roll over at 16 bits, but at 66
+frames a second a wheel can't turn anywhere near 32768 counts between frames, so the
+difference between two frames (taken mod 65536) is always the true movement.
+
+Odometry is a stream consumer. Add it to the robot and stream anything with the
+encoder counts in it (Group_100, Group_101, or the two packets):
+
+  odo = Odometry()
+  roomba.add_stream_consumer(odo)
+  roomba.start_packet_stream([sensor_groups.Group_101()])
+  ...
+  pose = odo.pose
+  print(pose.x_mm, pose.y_mm, math.degrees(pose.heading))
+
+The input thread does the math for every frame (a few microseconds) and publishes the
+result as a new immutable Pose. Reading "pose" never waits on the input thread, and
+the input thread never waits on a reader. Use wait_for_update to sleep until the next
+frame's pose. Code that must run on every pose (like the MotionExecutor) can add a
+listener instead -- it runs on the input thread, so keep it short.
+
+The starting pose is x=0, y=0, heading=0 (pointing along +x). Positive headings are
+counter-clockwise. The heading is not wrapped: two full turns to the left is 4*pi.
+"""
+
+import math
+import threading
+import time
+from collections import namedtuple
+
+# Create 2 geometry (from the OI spec)
+WHEEL_BASE_MM = 235.0
+COUNTS_PER_MM = 508.8 / (72.0 * math.pi)
+
+# The robot sends a stream frame every 15ms
+FRAME_PERIOD = 0.015
+
+Pose = namedtuple('Pose', [
+    'x_mm', 'y_mm',
+    'heading',        # radians counter-clockwise (not wrapped)
+    'distance_mm',    # total distance driven (backing up counts against it)
+    'velocity_mms',   # forward speed
+    'turn_rate',      # radians/sec counter-clockwise
+    'timestamp',      # time.monotonic() of the frame
+    'seq',            # number of frames in this pose
+])
+
+
+def _count_delta(new, old):
+    # The change in a 16-bit counter that may have rolled over
+    return (new - old + 32768) % 65536 - 32768
+
+
+class Odometry:
+
+    def __init__(self, wheel_base_mm=WHEEL_BASE_MM, counts_per_mm=COUNTS_PER_MM):
+        """Create a pose estimator.
+
+        Args:
+            wheel_base_mm: distance between the wheels
+            counts_per_mm: encoder counts per mm of wheel travel
+        """
+        self.wheel_base_mm = wheel_base_mm
+        self.counts_per_mm = counts_per_mm
+        self._updated = threading.Condition()
+        self._left_index = None
+        self._right_index = None
+        self._listeners = []
+        self._seq = 0
+        self.reset()
+
+    def reset(self, x_mm=0.0, y_mm=0.0, heading=0.0):
+        """Start over at the given pose."""
+        self._last_counts = None
+        self._x = x_mm
+        self._y = y_mm
+        self._heading = heading
+        self._distance = 0.0
+        # The seq keeps counting so wait_for_update works across a reset
+        self.pose = Pose(x_mm, y_mm, heading, 0.0, 0.0, 0.0, time.monotonic(), self._seq)
+
+    def bind(self, decoder):
+        """Find the encoder counts in a stream's values. Roomba calls this for you.
+
+        If the stream has no encoder counts the frames are ignored.
+
+        Args:
+            decoder: the stream's CompiledDecoder
+        """
+        names = decoder.value_names
+        if 'LeftEncoderCounts' in names and 'RightEncoderCounts' in names:
+            self._left_index = names.index('LeftEncoderCounts')
+            self._right_index = names.index('RightEncoderCounts')
+        else:
+            self._left_index = self._right_index = None
+        # The old counts may be from a different stream
+        self._last_counts = None
+
+    def record(self, values, timestamp=None):
+        """Take one stream frame. Roomba calls this for you from the input thread.
+
+        Args:
+            values: the tuple returned by CompiledDecoder.decode
+            timestamp: time.monotonic() of the frame (defaults to now)
+        """
+        if self._left_index is None:
+            return
+        self.update(values[self._left_index], values[self._right_index], timestamp)
+
+    def update(self, left_count, right_count, timestamp=None):
+        """Move the pose by new encoder readings.
+
+        The first reading after a reset (or a new stream) only sets the starting counts.
+
+        Args:
+            left_count: LeftEncoderCounts (signed or unsigned, it doesn't matter)
+            right_count: RightEncoderCounts
+            timestamp: time.monotonic() of the reading (defaults to now)
+
+        Returns:
+            the new Pose
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        last = self._last_counts
+        self._last_counts = (left_count, right_count, timestamp)
+        if last is None:
+            return self.pose
+        left = _count_delta(left_count, last[0]) / self.counts_per_mm
+        right = _count_delta(right_count, last[1]) / self.counts_per_mm
+        dist = (left + right) / 2
+        turn = (right - left) / self.wheel_base_mm
+        # Move along the average heading over the step
+        mid = self._heading + turn/2
+        self._x += dist * math.cos(mid)
+        self._y += dist * math.sin(mid)
+        self._heading += turn
+        self._distance += dist
+        self._seq += 1
+        # The robot measures every 15ms. The frames don't always arrive that evenly
+        # (and one can be lost to a bad checksum) so count how many periods went by.
+        dt = max(1, round((timestamp - last[2]) / FRAME_PERIOD)) * FRAME_PERIOD
+        pose = Pose(self._x, self._y, self._heading, self._distance,
+                    dist/dt, turn/dt, timestamp, self._seq)
+        self.pose = pose
+        with self._updated:
+            self._updated.notify_all()
+        for listener in self._listeners:
+            listener(pose)
+        return pose
+
+    def add_listener(self, listener):
+        """Call function(pose) on the input thread for every new pose."""
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        listeners = list(self._listeners)
+        listeners.remove(listener)
+        self._listeners = listeners
+
+    def wait_for_update(self, seq=None, timeout=None):
+        """Wait for a pose newer than "seq".
+
+        Args:
+            seq: the seq of the last pose you saw (defaults to the current one)
+            timeout: seconds to wait or None to wait forever
+
+        Returns:
+            the new Pose, or None if the timeout ran out
+        """
+        if seq is None:
+            seq = self.pose.seq
+        with self._updated:
+            if not self._updated.wait_for(lambda: self.pose.seq > seq, timeout):
+                return None
+            return self.pose
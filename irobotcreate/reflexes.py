@@ -0,0 +1,119 @@
+"""
+Stop the robot on a cliff or a wheel drop from inside the driver.
+
+In "full" mode the OI does not stop for cliffs or wheel drops. Left to a
+stream_update_cb or a polling loop, the robot can roll for a long time before
+anybody notices. SafetyReflexes is a stream consumer: it looks at the hazard bits
+of every frame on the input thread, as soon as the frame is decoded, and calls
+Roomba.emergency_stop. The stop goes straight out ahead of any batch, and drive
+commands are ignored until the hazard is gone and you call release.
+
+  reflexes = SafetyReflexes(roomba)
+  roomba.add_stream_consumer(reflexes)
+  roomba.start_packet_stream([sensor_groups.Group_100()])
+  ...
+  if reflexes.tripped:
+      print('Stopped for', reflexes.tripped)
+      back_away_by_hand()
+      reflexes.release()
+
+The stream needs the packets being watched (Group_100 or Group_0 has them all).
+
+Every trip measures the time from the frame's bytes arriving to the stop command
+being written (see stop_latency).
+"""
+
+import time
+
+from metrics import LatencyHistogram
+
+CLIFF = 'cliff'
+WHEEL_DROP = 'wheel drop'
+BUMP = 'bump'
+
+_CLIFFS = ('CliffLeft', 'CliffFrontLeft', 'CliffFrontRight', 'CliffRight')
+
+
+class SafetyReflexes:
+
+    def __init__(self, roomba, cliff=True, wheel_drop=True, bump=False, latch=True):
+        """Create the reflexes.
+
+        Args:
+            roomba: the Roomba to stop (the "nowait" one of an AsyncRoomba)
+            cliff: stop for any of the four cliff sensors
+            wheel_drop: stop for either wheel dropping
+            bump: stop for either bumper
+            latch: if True, drive commands stay blocked until release. If False
+                they are allowed again as soon as the hazard is gone.
+        """
+        self.roomba = roomba
+        self.latch = latch
+        self._drop_mask = (0x0C if wheel_drop else 0) | (0x03 if bump else 0)
+        self._check_cliffs = cliff
+        self._drop_index = None
+        self._cliff_indexes = ()
+        self._listeners = []
+        self.tripped = None
+        self._present = False
+        self.num_trips = 0
+        self.stop_latency = LatencyHistogram()
+
+    def add_listener(self, listener):
+        """Call function(reason) on the input thread when a reflex stops the robot."""
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        listeners = list(self._listeners)
+        listeners.remove(listener)
+        self._listeners = listeners
+
+    def bind(self, decoder):
+        """Find the hazard packets in a new stream. Roomba calls this for you."""
+        names = decoder.value_names
+        self._drop_index = names.index('BumpsAndWheelDrops') if 'BumpsAndWheelDrops' in names else None
+        self._cliff_indexes = tuple(names.index(n) for n in _CLIFFS if n in names) if self._check_cliffs else ()
+
+    def _hazard(self, values):
+        i = self._drop_index
+        if i is not None:
+            bits = values[i] & self._drop_mask
+            if bits & 0x0C:
+                return WHEEL_DROP
+            if bits:
+                return BUMP
+        for i in self._cliff_indexes:
+            if values[i] & 1:
+                return CLIFF
+        return None
+
+    def record(self, values, timestamp=None):
+        """Roomba calls this from the input thread for every frame."""
+        hazard = self._hazard(values)
+        self._present = hazard is not None
+        if hazard is None:
+            if self.tripped is not None and not self.latch:
+                self.release()
+            return
+        if self.tripped is not None:
+            return
+        self.tripped = hazard
+        self.roomba.emergency_stop()
+        arrived = self.roomba.last_input_time
+        if arrived is not None:
+            self.stop_latency.add(time.monotonic()-arrived)
+        self.num_trips += 1
+        for listener in self._listeners:
+            listener(hazard)
+
+    def release(self):
+        """Let drive commands through again. Does nothing while the hazard is still there.
+
+        Returns:
+            True if released
+        """
+        if self._present:
+            return False
+        self.tripped = None
+        self.roomba.release_drive()
+        return True
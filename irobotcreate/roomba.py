@@ -1,8 +1,66 @@
-import serial
+import struct
 import time
 import sys
 
 import threading
+from collections import deque
+import concurrent.futures
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import sensor_packets
+import stream_planner
+import transports
+from compiled_decoder import CompiledDecoder, flatten_packets
+from metrics import DEFAULT_BOUNDS, LatencyMetrics
+from stream_decoder import StreamDecoder
+
+# set_drive, set_drive_direct, and set_drive_pwm (all 5 bytes long)
+_DRIVE_OPCODES = (0x89, 0x91, 0x92)
+
+# set_drive(0, 0)
+_STOP_COMMAND = b'\x89\x00\x00\x00\x00'
+
+
+def _is_stop(cmd):
+    # A drive command that stops the wheels
+    if cmd[0] == 0x89:
+        return cmd[1:3] == b'\x00\x00'
+    return cmd[1:5] == b'\x00\x00\x00\x00'
+
+# Opcode 129 baud codes: BAUD_RATES[code] is the rate
+BAUD_RATES = (300, 600, 1200, 2400, 4800, 9600, 14400, 19200, 28800, 38400, 57600, 115200)
+
+# The order find_baud tries them: the Create2 default, the Create1 default, the
+# Create2's "hold Clean for 10 seconds" rate, then the rest fastest first
+PROBE_RATES = (115200, 57600, 19200) + tuple(r for r in reversed(BAUD_RATES) if r not in (115200, 57600, 19200))
+
+# Seconds get_sensor_packet/get_sensor_multi_packets wait for an answer. Group 100
+# (80 bytes) takes 42ms at 19200 baud.
+QUERY_TIMEOUT = 0.5
+
+# The OI wants this long after opcode 129 before it hears anything at the new rate
+_BAUD_CHANGE_DELAY = 0.1
+
+
+def _probe_answered(modes):
+    # Two OIMode packets from one 149 query. At the wrong rate the robot doesn't
+    # answer or the bytes come back as junk. After "start" the OI can't be "off".
+    a, b = modes
+    return a.mode == b.mode and a.mode[0] in (1, 2, 3)
+
+class _BatchState(threading.local):
+    # The commands one thread is collecting in Roomba.batch
+
+    def __init__(self):
+        self.depth = 0
+        self.out = bytearray()
+        # Opcode of every command in out
+        self.opcodes = []
+        self.latest_wins = False
+        # Where the drive command is in out and in opcodes (latest_wins)
+        self.drive_pos = -1
+        self.drive_index = -1
 
 class Roomba(object):
 
@@ -19,71 +77,176 @@ class Roomba(object):
     
     """
     
-    def __init__(self, port_name='/dev/ttyUSB0', baud=115200, stream_update_cb=None):
+    def __init__(self, port_name='/dev/ttyUSB0', baud=115200, stream_update_cb=None, transport=None):
         """Create a new robot driver object.
 
         The older Create1 defaults to baud 57600. The Create2 defaults to 115200.
 
         Args:
             port_name: name of the port e.g. "COM4". Defaults to "/dev/ttyUSB0"
-            baud: baud rate of the interface. Defaults to 115200 (Create2 default)
+            baud: baud rate of the interface. Defaults to 115200 (Create2 default).
+                None to find it with find_baud.
+            stream_update_cb: function(packets) called for every packet stream frame
+            transport: talk over this instead of opening port_name (see "transports.py")
         """                
 
-        self._buffer = b''
-        self._stream_update_cb=stream_update_cb
-        self._watch_for_stream = False
-        self._num_stream_packets = 0
+        self._setup(stream_update_cb)
 
-        self.roomba = serial.Serial(port_name,115200)        
-        self.set_mode_passive()  
-        self.set_mode_safe()
+        if transport is None:
+            transport = transports.open_serial(port_name, baud or PROBE_RATES[0])
+        self.roomba = transport
 
         th = threading.Thread(target=self._input_thread)
         th.daemon = True
         th.start()
 
-    def _clear_input_buffer(self):
-        self._buffer = b''
+        if baud is None:
+            self.find_baud()
+        self.set_mode_passive()  
+        self.set_mode_safe()
 
-    def _wait_for_input(self, num_bytes, sleep_secs=0.25):
-        while len(self._buffer)<num_bytes:
-            time.sleep(sleep_secs)
-        ret = self._buffer[:num_bytes]
-        self._buffer = self._buffer[num_bytes:]
-        return ret
+    def _setup(self, stream_update_cb):
+        # Everything but the port and the input thread
+        self._buffer = bytearray()
+        # The input thread notifies this when new bytes land in _buffer
+        self._input_ready = threading.Condition()
+        # Sensor queries waiting for their responses, oldest first. The robot answers
+        # in the order it was asked.
+        self._queries = deque()
+        self._query_lock = threading.Lock()
+        self._stream_update_cb=stream_update_cb
+        self._watch_for_stream = False
+        self._num_stream_packets = 0
+        self._stream_decoder = StreamDecoder(self._decode_stream_frame)
+        self._stream_packet_decoder = None
+        # (stop event, thread) of start_packet_poll
+        self._poll = None
+        # time.monotonic() the last bytes came in from the robot
+        self.last_input_time = None
+        self.num_bytes_in = 0
+        self.num_bytes_out = 0
+        # Commands sent, by opcode
+        self.command_counts = [0]*256
+        # Set by emergency_stop: drop drive commands that aren't stops
+        self._drive_lockout = False
+        # Held around every write to the port, and around the lockout check and the
+        # write of a drive command
+        self._write_lock = threading.RLock()
+        # See enable_latency_metrics
+        self.latency = None
+        # Drive opcode -> indexes of the stream values that echo its two arguments
+        self._echo_indexes = {}
+        # (opcode, the arguments, time.monotonic() sent) of the last drive command
+        self._drive_echo = None
+        self._decoders = {}
+        self._stream_recorder = None
+        # Objects that take every frame's values (see add_stream_consumer)
+        self._stream_consumers = []
+        self._stream_consumer_list = []
+        self._stream_log = None
+        # Commands collected by "batch", per thread
+        self._batch = _BatchState()
+
+    def _clear_input_buffer(self):
+        with self._input_ready:
+            del self._buffer[:]
 
     def _input_thread(self):        
         try:            
             while True:
-                if self._watch_for_stream:
-                    # Get in sync ... wait for a 19
-                    while True:
-                        d = self.roomba.read(1)
-                        if d[0] == 19:
-                            break                                   
-                    size = self.roomba.read(1)[0]
-                    data = self.roomba.read(size)
-                    _ = self.roomba.read(1)[0] # TODO check this. For now, don't waste the time
-                    self._num_stream_packets += 1
-                    pos = 0
-                    ok = True
-                    for p in self._stream_packets:
-                        if pos+p.SIZE+1 > size or p.ID != data[pos]:
-                            ok = False
-                            # This might be a left over spew from a previous run
-                            # Just ignore this packet and wait for next                          
-                            break
-                        p.decode(data,pos+1)
-                        pos += p.SIZE + 1
-                    if ok:
-                        self._stream_update_cb(self._stream_packets)
-                else:
-                    # Might be watching for the spew after a reset
-                    d = self.roomba.read(1)
-                    self._buffer += d
-        finally:
+                # Block for at least one byte, then take everything else that has
+                # arrived with it in a single read.
+                data = self.roomba.read(1)
+                if not data:
+                    # The port was closed
+                    break
+                waiting = self.roomba.in_waiting
+                if waiting:
+                    data += self.roomba.read(waiting)
+                self._process_input(data)
+        except Exception:
+            # Closing the port ends the thread quietly. Anything else is a bug.
             print('The input reader thread should not exit')
-            
+            raise
+
+    def _process_input(self, data):
+        self.last_input_time = time.monotonic()
+        self.num_bytes_in += len(data)
+        if self._watch_for_stream:
+            self._stream_decoder.feed(data)
+        else:
+            # Might be watching for the spew after a reset
+            done = []
+            with self._input_ready:
+                self._buffer += data
+                while self._queries and len(self._buffer) >= self._queries[0][2]:
+                    future, decoder, size = self._queries.popleft()
+                    future.values = decoder.decode(self._buffer, 0)
+                    del self._buffer[:size]
+                    done.append(future)
+                self._input_ready.notify_all()
+            # Outside the lock: this runs any callbacks added to the futures
+            for future in done:
+                future.set_result(future.sensor_objects)
+
+    def _decode_stream_frame(self, data, ofs, size):
+        # The framer has already checked the size against the packet list
+        if self._stream_log is not None:
+            # The whole frame as it came off the wire
+            self._stream_log.write_frame(data[ofs-2:ofs+size+1])
+        values = self._stream_packet_decoder.decode(data, ofs)
+        if values is None:
+            # This might be a left over spew from a previous run
+            # Just ignore this packet and wait for next
+            return
+        self._deliver_stream_values(values)
+
+    def _deliver_stream_values(self, values):
+        if self.latency is not None:
+            self._deliver_timed(values, self.latency)
+            return
+        for consumer in self._stream_consumer_list:
+            consumer.record(values)
+        self._num_stream_packets += 1
+        if self._stream_update_cb is not None:
+            self._stream_update_cb(self._stream_packets)
+
+    def _deliver_timed(self, values, latency):
+        # _deliver_stream_values with the timings
+        start = time.monotonic()
+        for consumer in self._stream_consumer_list:
+            consumer.record(values)
+        self._num_stream_packets += 1
+        now = time.monotonic()
+        latency.consumers.add(now-start)
+        echo = self._drive_echo
+        if echo is not None:
+            indexes = self._echo_indexes.get(echo[0])
+            if indexes is not None and (values[indexes[0]], values[indexes[1]]) == echo[1]:
+                self._drive_echo = None
+                latency.drive_echo.add(self.last_input_time-echo[2])
+        if self._stream_update_cb is not None:
+            latency.frame_to_callback.add(now-self.last_input_time)
+            self._stream_update_cb(self._stream_packets)
+            latency.callback.add(time.monotonic()-now)
+
+    def enable_latency_metrics(self, bounds=DEFAULT_BOUNDS):
+        """Start timing the input path, the writes, the queries, and the drive commands.
+
+        It costs a few time.monotonic() calls per frame and per command.
+
+        Args:
+            bounds: bucket upper bounds in seconds (see "metrics.py")
+
+        Returns:
+            the LatencyMetrics (also in self.latency). Read it any time with get().
+        """
+        self.latency = LatencyMetrics(bounds)
+        return self.latency
+
+    def disable_latency_metrics(self):
+        self.latency = None
+        self._drive_echo = None
         
     def close(self):
         """Put OI in "passive" then "off" mode.
@@ -97,6 +260,109 @@ class Roomba(object):
         time.sleep(1)
         self.set_mode_stop()      
         
+    def _get_decoder(self, sensor_objects):
+        # Building a decoder is slow. Keep the ones for the objects we see often.
+        key = tuple(id(s) for s in sensor_objects)
+        ent = self._decoders.get(key)
+        if ent is None:
+            if len(self._decoders) > 32:
+                self._decoders.clear()
+            # Hold on to the objects so their ids are not reused
+            ent = (sensor_objects, CompiledDecoder(sensor_objects))
+            self._decoders[key] = ent
+        return ent[1]
+
+    @contextmanager
+    def batch(self, drive_latest_wins=False):
+        """Collect the commands sent in a "with" block and write them all at once.
+
+        Use one batch per control tick:
+
+          with roomba.batch(drive_latest_wins=True):
+              roomba.set_leds(...)
+              roomba.set_drive_direct(...)
+
+        Batches can be nested. The commands go out when the outermost one ends.
+        Sensor queries are not held -- they go out right away. Don't change modes
+        in a batch: the mode commands sleep before the batch is written.
+
+        Args:
+            drive_latest_wins: if True only the last drive command (set_drive,
+                set_drive_direct, or set_drive_pwm) in the batch is sent. It goes
+                out in the place of the first one.
+
+        A batch only holds the commands sent by the thread that opened it. Commands
+        from the input thread (like a SafetyReflexes stop) go out on their own.
+        """
+        state = self._batch
+        if not state.depth:
+            state.latest_wins = drive_latest_wins
+            state.drive_pos = -1
+        state.depth += 1
+        try:
+            yield self
+        finally:
+            state.depth -= 1
+            if not state.depth and state.out:
+                data = bytes(state.out)
+                opcodes = state.opcodes
+                del state.out[:]
+                state.opcodes = []
+                with self._write_lock:
+                    if self._drive_lockout:
+                        # The batch might hold a drive from before the stop
+                        data += _STOP_COMMAND
+                        opcodes.append(_STOP_COMMAND[0])
+                    self._write(data)
+                    for opcode in opcodes:
+                        self.command_counts[opcode] += 1
+
+    def _send(self, cmd):
+        # Every command goes out through here
+        if self._drive_lockout and cmd[0] in _DRIVE_OPCODES and not _is_stop(cmd):
+            return
+        if self.latency is not None and cmd[0] in (0x89, 0x91):
+            # Watch the stream for the robot to report these speeds
+            self._drive_echo = (cmd[0], struct.unpack('>hh', cmd[1:5]), time.monotonic())
+        state = self._batch
+        if state.depth:
+            out = state.out
+            if state.latest_wins and cmd[0] in _DRIVE_OPCODES:
+                if state.drive_pos >= 0:
+                    # Replace the drive command already in the batch
+                    out[state.drive_pos:state.drive_pos+5] = cmd
+                    state.opcodes[state.drive_index] = cmd[0]
+                    return
+                state.drive_pos = len(out)
+                state.drive_index = len(state.opcodes)
+            out += cmd
+            state.opcodes.append(cmd[0])
+            return
+        if cmd[0] in _DRIVE_OPCODES:
+            with self._write_lock:
+                # emergency_stop may have come in since the check above
+                if self._drive_lockout and not _is_stop(cmd):
+                    return
+                self._write_command(cmd)
+            return
+        self._write_command(cmd)
+
+    def _write_command(self, cmd):
+        # One command straight to the port, counted by opcode as it goes out
+        self._write(cmd)
+        self.command_counts[cmd[0]] += 1
+
+    def _write(self, data):
+        with self._write_lock:
+            self.num_bytes_out += len(data)
+            latency = self.latency
+            if latency is None:
+                self.roomba.write(data)
+                return
+            start = time.monotonic()
+            self.roomba.write(data)
+            latency.write.add(time.monotonic()-start)
+
     def _signed_word_to_bytes(self,value):
         # The OI uses 16 bit signed words, MSB first
         if value<0:
@@ -114,7 +380,7 @@ class Roomba(object):
         OI out of "Off" mode. In all other mode, it places the OI in "passive" mode. Thus we
         just call it set_mode_passive.        
         """
-        self.roomba.write(b'\x80')
+        self._send(b'\x80')
         # Give it a second to wake up if it is in "off" mode.
         time.sleep(1)
 
@@ -124,7 +390,7 @@ class Roomba(object):
         This resets the robot as if you had removed and reinserted the battery. The default
         baud rate is reset, and the OI enters mode "Off".
         """
-        self.roomba.write(b'\x07')
+        self._send(b'\x07')
         
     def set_mode_stop(self):
         """Opcode 173: Set the mode to off.
@@ -134,7 +400,7 @@ class Roomba(object):
         This does not seem to work unless the OI is in "passive" mode. Use the "close" method
         instead.
         """
-        self.roomba.write(b'\xAD')
+        self._send(b'\xAD')
 
     def set_baud(self, code):
         """Opcode 129: Change the baud rate.
@@ -156,44 +422,138 @@ class Roomba(object):
           10     57600
           11     115200
 
+        The command goes out at the old rate. The OI wants 100ms before it hears
+        anything at the new one, so this waits that long and then switches the port.
+        It is not held by a batch. Pause any stream first.
+
         Args:
             code: an int value from the left side of the table above
         
         """
-        
+        rate = BAUD_RATES[code]
+        self._write_command(bytes([0x81, code]))
+        flush = getattr(self.roomba, 'flush', None)
+        if flush is not None:
+            # Wait for the command to be on the wire before the port changes speed
+            flush()
+        time.sleep(_BAUD_CHANGE_DELAY)
+        self.roomba.baudrate = rate
+
+    def change_baud(self, rate, timeout=0.5):
+        """Move the robot and the port to a new baud rate and make sure they still talk.
+
+        A stream frame has to fit in 15ms, so faster rates carry bigger streams.
+        Pause any stream first.
+
+        Args:
+            rate: one of the rates in BAUD_RATES
+            timeout: seconds to wait for the robot to answer at the new rate
+
+        Raises:
+            ValueError if the OI has no such rate
+            TimeoutError if the robot doesn't answer at the new rate (try find_baud)
+        """
+        if rate not in BAUD_RATES:
+            raise ValueError('The OI can not do '+str(rate)+' baud')
+        self.set_baud(BAUD_RATES.index(rate))
+        modes = [sensor_packets.OIMode(), sensor_packets.OIMode()]
+        if not self._probe(modes, timeout):
+            raise TimeoutError('The robot did not answer at '+str(rate)+' baud')
+
+    def find_baud(self, rates=PROBE_RATES, timeout=0.3):
+        """Find the rate the robot is talking at and set the port to it.
+
+        For each rate: set the port, send "start" (opcode 128), and ask for OIMode
+        twice. The robot is found when both answers come back and agree. Junk sent at
+        the wrong rates can look like commands to the robot, so do this before
+        driving. The OI is left in "passive" mode.
+
+        Args:
+            rates: the rates to try, in order
+            timeout: seconds to wait for an answer at each rate
+
+        Returns:
+            the baud rate
+
+        Raises:
+            TimeoutError if the robot didn't answer at any of them
+        """
+        for rate in rates:
+            self.roomba.baudrate = rate
+            self._write_command(b'\x80')
+            time.sleep(_BAUD_CHANGE_DELAY)
+            if self._probe([sensor_packets.OIMode(), sensor_packets.OIMode()], timeout):
+                return rate
+        raise TimeoutError('The robot did not answer at any of '+str(list(rates)))
+
+    def _probe(self, modes, timeout):
+        watching = self._begin_probe()
+        try:
+            future = self.query_async(modes)
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                self._forget_query(future)
+                return False
+            return _probe_answered(modes)
+        finally:
+            self._end_probe(watching)
+
+    def _begin_probe(self):
+        # A paused stream still gets all the input. Take it back for the probe.
+        watching = self._watch_for_stream
+        self._watch_for_stream = False
+        self._clear_input_buffer()
+        return watching
+
+    def _end_probe(self, watching):
+        if watching:
+            # Any partial frame came at the old rate
+            self._stream_decoder.discard()
+            self._watch_for_stream = True
+
+    def _forget_query(self, future):
+        # Give up on a query the robot never answered
+        with self._input_ready:
+            for ent in self._queries:
+                if ent[0] is future:
+                    self._queries.remove(ent)
+                    break
+            del self._buffer[:]
+
     def set_mode_safe(self):
         """Opcode 131: Enter safe mode.
 
         Opcode 130 does the same thing.        
         """
-        self.roomba.write(b'\x83')
+        self._send(b'\x83')
         time.sleep(1)
     
     def set_mode_full(self):
         """Opcode 132: Enter full mode.
         """        
-        self.roomba.write(b'\x84')
+        self._send(b'\x84')
         time.sleep(1)
     
     def set_power_down(self):
         """Opcode 133: Power down and enter passive mode.
         """
-        self.roomba.write(b'\x85')
+        self._send(b'\x85')
         time.sleep(1)
     
     ##### Cleaning Algorithms
     
     def set_clean_spot(self):
         # 134
-        self.roomba.write(b'\x86')
+        self._send(b'\x86')
     
     def set_clean_clean(self):
         # 135
-        self.roomba.write(b'\x87')
+        self._send(b'\x87')
     
     def set_clean_max_clean(self):
         # 136
-        self.roomba.write(b'\x88')
+        self._send(b'\x88')
         
     ##### Drive
     
@@ -204,10 +564,26 @@ class Roomba(object):
         # spin CW = radius -1
         # spin CCW = radius 1
         cmd = b'\x89'+self._signed_word_to_bytes(velocity_mms)+self._signed_word_to_bytes(radius_mm)
-        self.roomba.write(cmd)
+        self._send(cmd)
         
     def set_drive_stop(self):
         self.set_drive(0,0)
+
+    def emergency_stop(self):
+        """Stop the wheels now and ignore drive commands until release_drive.
+
+        The stop goes straight to the port, ahead of any batch being collected. Drive
+        commands other than stops are dropped, and a batch that ends gets a stop added
+        to the end. SafetyReflexes calls this from the input thread.
+        """
+        with self._write_lock:
+            # No drive command can be between its lockout check and its write
+            self._drive_lockout = True
+            self._write_command(_STOP_COMMAND)
+
+    def release_drive(self):
+        """Accept drive commands again after emergency_stop."""
+        self._drive_lockout = False
     
     def set_drive_straight(self,velocity_mms):
         self.set_drive(velocity_mms,32767)
@@ -223,19 +599,19 @@ class Roomba(object):
         # mm/s 
         # The manual says range is -500 to +500, but my roomba goes higher
         cmd = b'\x91'+ self._signed_word_to_bytes(right_mms)+self._signed_word_to_bytes(left_mms)
-        self.roomba.write(cmd)
+        self._send(cmd)
     
     def set_drive_pwm(self,left_pwm,right_pwm):
         # 146
         # pwm 
         # The manual says range is -255 to +255, but my roomba goes higher
         cmd = b'\x92'+ self._signed_word_to_bytes(right_pwm)+self._signed_word_to_bytes(left_pwm)
-        self.roomba.write(cmd)
+        self._send(cmd)
         
     def set_seek_dock(self):
         # 143
         cmd = b'\x8F'
-        self.roomba.write(cmd)
+        self._send(cmd)
         
     ##### Cleaning Motors
     
@@ -261,7 +637,7 @@ class Roomba(object):
         if side_brush_on:
             value |= 1
 
-        self.roomba.write(bytes[0x8A, value])
+        self._send(bytes([0x8A, value]))
     
     def set_cleaning_motors_pwm(self,main_brush_pwm,side_brush_pwm,vacuum_pwm):
         # 90 144
@@ -284,7 +660,7 @@ class Roomba(object):
         if debris:
             ind = ind | 1        
         cmd = bytes([0x8B,ind,power_color,power_intensity])        
-        self.roomba.write(cmd)
+        self._send(cmd)
         
     ##### Music Control
     
@@ -301,65 +677,278 @@ class Roomba(object):
         # Experimentation shows that each song can be at most 16 notes. If you pass in more
         # than 16 then the notes spill into the next song. This allows you to use song 0
         # as one big 16*4 note song.
-        cmd = b'\x8C' + bytes([number,len(notes)])
+        cmd = bytearray([0x8C,number,len(notes)])
         for note in notes:
-            cmd = cmd + bytes([note[0],note[1]])
-        self.roomba.write(cmd)          
+            cmd.append(note[0])
+            cmd.append(note[1])
+        self._send(cmd)          
     
     def play_song(self,number):
         # 141
         # number: 0,1,2, or 3
         cmd = b'\x8D' + bytes([number])
-        self.roomba.write(cmd)    
+        self._send(cmd)    
     
     ##### Sensor Control
     
-    def get_sensor_packet(self, sensor_object):
-        # 142
-        self._clear_input_buffer()
-        cmd = b'\x8E' + bytes([sensor_object.ID])
-        self.roomba.write(cmd)
-        #
-        data = self._wait_for_input(sensor_object.SIZE)
-        sensor_object.decode(data,0)
+    def query_async(self, sensor_objects):
+        """Opcode 142/149: Ask for sensor packets without waiting for the answer.
+
+        You can have several queries in flight at once. The robot answers them in
+        order, and the input thread decodes each answer into its packet objects as
+        it arrives. Don't touch the objects (or pass them to another query) until
+        the future is done.
+
+        Queries are not answered while a packet stream is running.
+
+        Args:
+            sensor_objects: list of sensor packet and sensor group objects
+
+        Returns:
+            a concurrent.futures.Future. Its result is the list of sensor objects.
+            Once it is done its "values" is the tuple of raw values.
+        """
+        sensor_objects = list(sensor_objects)
+        if len(sensor_objects) == 1:
+            # 142
+            cmd = bytes([0x8E, sensor_objects[0].ID])
+        else:
+            # 149
+            cmd = bytes([0x95, len(sensor_objects)] + [s.ID for s in sensor_objects])
+        decoder = self._get_decoder(tuple(sensor_objects))
+        future = Future()
+        future.sensor_objects = sensor_objects
+        future.set_running_or_notify_cancel()
+        latency = self.latency
+        if latency is not None:
+            sent = time.monotonic()
+            future.add_done_callback(lambda f: latency.query.add(time.monotonic()-sent))
+        with self._query_lock:
+            with self._input_ready:
+                if not self._queries:
+                    # Nothing is expected. Anything in the buffer is left over.
+                    del self._buffer[:]
+                self._queries.append((future, decoder, decoder.size))
+            # Not held by a batch. The caller may be waiting on the answer.
+            self._write_command(cmd)
+        return future
+
+    def add_stream_consumer(self, consumer):
+        """Feed the values of every stream frame to an object (like an Odometry).
+
+        The consumer needs two methods:
+          bind(decoder)   called with the CompiledDecoder when a stream starts
+          record(values)  called from the input thread with the decoder's values
+                          for every frame. Keep it short.
+
+        Consumers stay attached across streams.
+        """
+        with self._input_ready:
+            self._stream_consumers.append(consumer)
+            if self._stream_packet_decoder is not None:
+                consumer.bind(self._stream_packet_decoder)
+            self._rebuild_stream_consumers()
+
+    def remove_stream_consumer(self, consumer):
+        with self._input_ready:
+            self._stream_consumers.remove(consumer)
+            self._rebuild_stream_consumers()
+
+    def _rebuild_stream_consumers(self):
+        # The input thread walks this list. Swap in a new one instead of changing it.
+        consumers = list(self._stream_consumers)
+        if self._stream_recorder is not None:
+            consumers.append(self._stream_recorder)
+        self._stream_consumer_list = consumers
+
+    def get_sensor_packet(self, sensor_object, timeout=QUERY_TIMEOUT):
+        """Opcode 142: Read one packet/group into the object.
+
+        Raises:
+            TimeoutError if the robot doesn't answer in "timeout" seconds
+        """
+        self._wait_for_answer(self.query_async([sensor_object]), timeout)
     
-    def get_sensor_multi_packets(self, sensor_objects):
-        # 149
-        self._clear_input_buffer()
-        data = [0x95, len(sensor_objects)]
-        total_to_read = 0
-        for s in sensor_objects:
-            total_to_read += s.SIZE
-            data.append(s.ID)
-        self.roomba.write(bytes(data))
-        #
-        data = self._wait_for_input(total_to_read)
-        pos = 0
-        for sensor_object in sensor_objects:
-            sensor_object.decode(data,pos)
-            pos += sensor_object.SIZE
-
-    def start_packet_stream(self, sensor_objects):
-        # 148
+    def get_sensor_multi_packets(self, sensor_objects, timeout=QUERY_TIMEOUT):
+        """Opcode 149: Read a list of packets/groups into the objects.
+
+        Raises:
+            TimeoutError if the robot doesn't answer in "timeout" seconds
+        """
+        self._wait_for_answer(self.query_async(sensor_objects), timeout)
+
+    def _wait_for_answer(self, future, timeout):
+        # Block the caller until the input thread has decoded the answer
+        start = time.monotonic()
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Lost bytes, the wrong baud rate, or a stream running. Don't leave the
+            # query in line to take the next answer.
+            self._forget_query(future)
+            raise TimeoutError('The robot did not answer the sensor query in '+str(timeout)+' seconds')
+        latency = self.latency
+        if latency is not None:
+            latency.wait_for_input.add(time.monotonic()-start)
+
+    def start_packet_stream(self, sensor_objects, recorder=None, log=None, lazy=False):
+        """Opcode 148: Start streaming packet data every 15ms.
+
+        The objects are decoded in place and passed to the stream_update_cb for
+        every frame.
+
+        Args:
+            sensor_objects: list of sensor packet and sensor group objects
+            recorder: optional TelemetryRecorder to keep a history of every frame
+            log: optional TelemetryLogWriter to save every raw frame to disk
+            lazy: True to decode each field only when it is read (see
+                "compiled_decoder.py"). Faster when you read a few fields of a big group.
+
+        Raises:
+            ValueError if a frame of these packets doesn't fit in 15ms at the port's
+            baud rate (see "stream_planner.py")
+        """
+        port = getattr(self, 'roomba', None)
+        baud = getattr(port, 'baudrate', None)
+        if baud and stream_planner.frame_bytes(sensor_objects) > stream_planner.slot_capacity(baud):
+            raise ValueError(
+                'A frame of these packets is '+str(stream_planner.frame_bytes(sensor_objects))+
+                ' bytes. Only '+str(int(stream_planner.slot_capacity(baud)))+' fit in 15ms at '+
+                str(baud)+' baud. Try stream_planner.plan_stream.')
+        if log is not None:
+            # Raises ValueError for a log of other packets. Check before anything changes.
+            log.begin([s.ID for s in sensor_objects])
+        self.stop_packet_poll()
         self._clear_input_buffer()
+        # Every frame carries an ID byte plus the data for each packet
+        self._stream_decoder.reset(sum(s.SIZE+1 for s in sensor_objects))
+        self._bind_stream(sensor_objects, recorder, lazy)
+        self._stream_log = log
         self._watch_for_stream = True
-        # We need this in the decode
-        self._stream_packets = sensor_objects
         data = [0x94, len(sensor_objects)]
         for s in sensor_objects:            
             data.append(s.ID)
-        self.roomba.write(bytes(data))
+        self._send(bytes(data))
         # data starts flowing in now ... one chunk every 15ms
 
+    def _bind_stream(self, sensor_objects, recorder, lazy=False):
+        self._num_stream_packets = 0
+        # We need this in the decode
+        self._stream_packets = sensor_objects
+        self._stream_packet_decoder = CompiledDecoder(sensor_objects, stream=True, lazy=lazy)
+        names = self._stream_packet_decoder.value_names
+        self._echo_indexes = {}
+        for opcode, pair in ((0x89, ('RequestedVelocity', 'RequestedRadius')),
+                             (0x91, ('RequestedRightVelocity', 'RequestedLeftVelocity'))):
+            if pair[0] in names and pair[1] in names:
+                self._echo_indexes[opcode] = (names.index(pair[0]), names.index(pair[1]))
+        if recorder is not None:
+            recorder.bind(self._stream_packet_decoder)
+        self._stream_recorder = recorder
+        with self._input_ready:
+            for consumer in self._stream_consumers:
+                consumer.bind(self._stream_packet_decoder)
+            self._rebuild_stream_consumers()
+
+    def start_packet_poll(self, sensor_objects, rate_hz=1/0.015, recorder=None):
+        """Opcode 149: Query packets over and over and hand the answers out like a stream.
+
+        For packets that don't fit in a stream frame at the link's baud rate (see
+        "stream_planner.py"). The answer to a query is only the data, so more fits
+        in the same time. Every answer goes to the stream consumers and the
+        stream_update_cb just like a stream frame, but from a polling thread instead
+        of the input thread. Any stream is paused.
+
+        Args:
+            sensor_objects: list of sensor packet and sensor group objects
+            rate_hz: queries per second at most (the robot updates every 15ms)
+            recorder: optional TelemetryRecorder to keep a history of every answer
+        """
+        self.stop_packet_poll()
+        if self._watch_for_stream:
+            # Queries are not answered while a stream runs
+            self._watch_for_stream = False
+            self.pause_packet_stream()
+            # Let the last frame land, then throw it away
+            time.sleep(0.03)
+            self._clear_input_buffer()
+        sensor_objects = list(sensor_objects)
+        self._bind_stream(sensor_objects, recorder)
+        # The consumers expect stream frames. Put the ID bytes back in.
+        layout = []
+        for top, p, _ in flatten_packets(sensor_objects):
+            if not layout or layout[-1][0] is not top:
+                layout.append([top, 0])
+            if p is not None:
+                layout[-1][1] += 1
+        layout = [(top.ID, count) for top, count in layout]
+        stop = threading.Event()
+        th = threading.Thread(target=self._poll_thread, args=(sensor_objects, layout, 1.0/rate_hz, stop))
+        th.daemon = True
+        self._poll = (stop, th)
+        th.start()
+
+    def stop_packet_poll(self):
+        """Stop start_packet_poll. Returns once the polling thread has delivered its last answer."""
+        if self._poll is not None:
+            stop, th = self._poll
+            self._poll = None
+            stop.set()
+            if th is not threading.current_thread():
+                # Before anything rebinds the consumers to a new layout
+                th.join()
+
+    def _poll_thread(self, sensor_objects, layout, period, stop):
+        next_time = time.monotonic()
+        while not stop.is_set():
+            future = self.query_async(sensor_objects)
+            try:
+                future.result(1.0)
+            except concurrent.futures.TimeoutError:
+                self._forget_query(future)
+                continue
+            if stop.is_set():
+                return
+            answer = future.values
+            values = []
+            pos = 0
+            for pid, count in layout:
+                values.append(pid)
+                values.extend(answer[pos:pos+count])
+                pos += count
+            self._deliver_stream_values(tuple(values))
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                stop.wait(delay)
+            else:
+                # Falling behind. Don't try to catch up.
+                next_time = time.monotonic()
+
+    def get_stream_counters(self):
+        """Health counters for the current packet stream.
+
+        Returns:
+            dict with:
+              packets: frames decoded and passed to the stream callback
+              frames: frames with a good length and checksum
+              bad_checksums: frames thrown away because of a bad checksum
+              resyncs: number of times the reader lost sync and had to hunt for a header
+              dropped_bytes: bytes thrown away while hunting
+        """
+        ret = self._stream_decoder.get_counters()
+        ret['packets'] = self._num_stream_packets
+        return ret
+
     def pause_packet_stream(self):
         # 150
         cmd = b'\x96\x00'
-        self.roomba.write(cmd)
+        self._send(cmd)
 
     def resume_packet_stream(self):
         # 150
         cmd = b'\x96\x01'
-        self.roomba.write(cmd)
+        self._send(cmd)
 
 # Handler for stream updates
 def got_stream_update(packets):
@@ -189,7 +189,8 @@ class Group_4:
         self.cliffFrontRightSignal.decode(packet,ofs);      ofs+=2
         self.cliffRightSignal.decode(packet,ofs);           ofs+=2
         ofs+=2
-        ofs+=1        
+        ofs+=1
+        self.chargingSourcesAvailable.decode(packet,ofs);   ofs+=1
 
     def __repr__(self):
         return(            
@@ -197,7 +198,8 @@ class Group_4:
             self.cliffLeftSignal.__repr__()            +'\n'+
             self.cliffFrontLeftSignal.__repr__()       +'\n'+
             self.cliffFrontRightSignal.__repr__()      +'\n'+
-            self.cliffRightSignal.__repr__()            
+            self.cliffRightSignal.__repr__()           +'\n'+
+            self.chargingSourcesAvailable.__repr__()
             )   
         
 class Group_5:
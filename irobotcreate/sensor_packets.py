@@ -15,8 +15,42 @@ The library will fill out the data values in all the sensor packets you pass.
 
 You can use sensor group objects in place of individual sensor packets in the "get_sensor"
 calls.
+
+Every packet class also describes its own layout. FORMAT is the "struct" format of
+the data (all packets are a single value, MSB first). FIELDS lists the public
+attributes and a python expression that computes each one from the value "x". The
+"compiled_decoder" module uses these to build fast decoders.
 """
 
+# These IDs are skipped over in the groups. They are still in the group data.
+UNUSED_PACKET_SIZES = {16: 1, 32: 2, 33: 1}
+
+_CHARGING_STATES = (
+    (0,'Not charging'),
+    (1,'Reconditioning Charging'),
+    (2,'Full Charging'),
+    (3,'Trickle Charging'),
+    (4,'Waiting'),
+    (5,'Charging Fault Condition'),
+)
+
+_OI_MODES = (
+    (0,'Off'),
+    (1,'Passive'),
+    (2,'Safe'),
+    (3,'Full'),
+)
+
+def _charging_state(value):
+    if value < len(_CHARGING_STATES):
+        return _CHARGING_STATES[value]
+    return (value,'UNKNOWN VALUE')
+
+def _oi_mode(value):
+    if value < len(_OI_MODES):
+        return _OI_MODES[value]
+    return (value,'UNKNOWN VALUE')
+
 def _signed_word_from_bytes(value,ofs):
         value = (value[ofs]<<8) | value[ofs+1]
         if value>32767:
@@ -30,6 +64,13 @@ def _unsigned_word_from_bytes(value,ofs):
 class BumpsAndWheelDrops:    
     ID = 7  # Reference the spec
     SIZE = 1  # In bytes
+    FORMAT = 'B'  # struct format of the data
+    FIELDS = (
+        ('bump_right', '(x&1)>0'),
+        ('bump_left',  '(x&2)>0'),
+        ('drop_right', '(x&4)>0'),
+        ('drop_left',  '(x&8)>0'),
+    )
 
     def __init__(self):
         self.bump_right = None # boolean bumper pushed in on right side
@@ -52,6 +93,8 @@ class Wall:
     # The docs recommend using "45:Light Bumper" instead
     ID = 8
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('is_wall', '(x&1)>0'),)
 
     def __init__(self):
         self.is_wall = None # boolean right side of bumper
@@ -66,6 +109,8 @@ class CliffLeft:
     # This is a boolean version of "28: Cliff Left Signal"
     ID = 9
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('is_cliff', '(x&1)>0'),)
     
     def __init__(self):
         self.is_cliff = None # boolean 
@@ -80,6 +125,8 @@ class CliffFrontLeft:
     # This is a boolean version of "29: Cliff Front Left Signal"
     ID = 10
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('is_cliff', '(x&1)>0'),)
     
     def __init__(self):
         self.is_cliff = None # boolean 
@@ -94,6 +141,8 @@ class CliffFrontRight:
     # This is a boolean version of "30: Cliff Front Right Signal"
     ID = 11
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('is_cliff', '(x&1)>0'),)
     
     def __init__(self):
         self.is_cliff = None # boolean 
@@ -108,6 +157,8 @@ class CliffRight:
     # This is a boolean version of "31: Cliff Right Signal"
     ID = 12
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('is_cliff', '(x&1)>0'),)
     
     def __init__(self):
         self.is_cliff = None # boolean 
@@ -121,6 +172,8 @@ class CliffRight:
 class VirtualWall:
     ID = 13
     SIZE = 1   
+    FORMAT = 'B'
+    FIELDS = (('is_vwall', '(x&1)>0'),)
     def __init__(self):
         self.is_vwall = None
     def decode(self,packet,ofs):
@@ -131,6 +184,13 @@ class VirtualWall:
 class WheelOvercurrents:
     ID = 14
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (
+        ('is_left_wheel',  '(x&16)>0'),
+        ('is_right_wheel', '(x&8)>0'),
+        ('is_main_brush',  '(x&4)>0'),
+        ('is_side_brush',  '(x&1)>0'),
+    )
 
     def __init__(self):
         self.is_left_wheel = None  # boolean
@@ -152,6 +212,8 @@ class WheelOvercurrents:
 class DirtDetect:
     ID = 15
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('dirt', 'x'),)
 
     def __init__(self):
         self.dirt = None  # int 0-255
@@ -165,6 +227,8 @@ class DirtDetect:
 class InfraredCharacterOmni:
     ID = 17
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('character', 'x'),)
 
     def __init__(self):
         self.character = None # int 0-255
@@ -178,6 +242,17 @@ class InfraredCharacterOmni:
 class Buttons:
     ID = 18
     SIZE = 1    
+    FORMAT = 'B'
+    FIELDS = (
+        ('is_clock',    '(x&128)>0'),
+        ('is_schedule', '(x&64)>0'),
+        ('is_day',      '(x&32)>0'),
+        ('is_hour',     '(x&16)>0'),
+        ('is_minute',   '(x&8)>0'),
+        ('is_dock',     '(x&4)>0'),
+        ('is_spot',     '(x&2)>0'),
+        ('is_clean',    '(x&1)>0'),
+    )
     
     def __init__(self):
         self.is_clock    = None  # boolean
@@ -207,6 +282,8 @@ class Buttons:
 class Distance:
     ID = 19
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('since_last_mm', 'x'),)
     
     def __init__(self):
         self.since_last_mm = None  # int mm -32768 to 32767
@@ -220,6 +297,8 @@ class Distance:
 class Angle:
     ID = 20
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('since_last_deg', 'x'),)
     
     def __init__(self):
         self.since_last_deg = None  # int deg -32768 to 32767
@@ -241,25 +320,14 @@ class ChargingState:
     """
     ID = 21
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('state', '_charging_state(x)'),)
     
     def __init__(self):
         self.state = None  # int enum value from the table above
         
     def decode(self,packet,ofs):
-        if packet[ofs]==0:
-            self.state = (0,'Not charging')
-        elif packet[ofs]==1:
-            self.state = (1,'Reconditioning Charging')
-        elif packet[ofs]==2:
-            self.state = (2,'Full Charging')
-        elif packet[ofs]==3:
-            self.state = (3,'Trickle Charging')
-        elif packet[ofs]==4:
-            self.state = (4,'Waiting')
-        elif packet[ofs]==5:
-            self.state = (5,'Charging Fault Condition')
-        else:
-            self.state = (packet[ofs],'UNKNOWN VALUE')
+        self.state = _charging_state(packet[ofs])
             
     def __repr__(self):
         return 'ChargingState state:'+str(self.state)
@@ -267,6 +335,8 @@ class ChargingState:
 class BatteryVoltage:
     ID = 22
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('voltage', 'x/1000.0'),)
     
     def __init__(self):
         self.voltage = None  # int mV 0 to 65535
@@ -280,6 +350,8 @@ class BatteryVoltage:
 class BatteryCurrent:
     ID = 23
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('current', 'x/1000.0'),)
     
     def __init__(self):
         self.current = None  # int mA -32768 to 32767
@@ -293,6 +365,8 @@ class BatteryCurrent:
 class BatteryTemperature:
     ID = 24
     SIZE = 1
+    FORMAT = 'b'
+    FIELDS = (('temperature_c', 'x'),)
     
     def __init__(self):
         self.temperature_c = None  # int Celsius -128 to 127
@@ -308,6 +382,8 @@ class BatteryTemperature:
 class BatteryCharge:
     ID = 25
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('charge_mah', 'x'),)
     
     def __init__(self):
         self.charge_mah = None  # int mAh 0 to 65535
@@ -321,6 +397,8 @@ class BatteryCharge:
 class BatteryCapacity:
     ID = 26
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('capacity_mah', 'x'),)
     
     def __init__(self):
         self.capacity_mah = None  # int mAh 0 to 65535
@@ -335,6 +413,8 @@ class WallSignal:
     # The docs recommend using "51:Light Bump Right" instead
     ID = 27
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 1023
@@ -348,6 +428,8 @@ class WallSignal:
 class CliffLeftSignal:
     ID = 28
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
     def __init__(self):
         self.signal = None  # int 0 to 1023
     def decode(self,packet,ofs):
@@ -358,6 +440,8 @@ class CliffLeftSignal:
 class CliffFrontLeftSignal:
     ID = 29
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -371,6 +455,8 @@ class CliffFrontLeftSignal:
 class CliffFrontRightSignal:
     ID = 30
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -384,6 +470,8 @@ class CliffFrontRightSignal:
 class CliffRightSignal:
     ID = 31
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -399,6 +487,11 @@ class CliffRightSignal:
 class ChargingSourcesAvailable:
     ID = 34
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (
+        ('is_home_base',        '(x&2)>0'),
+        ('is_internal_charger', '(x&1)>0'),
+    )
 
     def __init__(self):
         self.is_home_base = None  # boolean
@@ -421,19 +514,14 @@ class OIMode:
     """
     ID = 35
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('mode', '_oi_mode(x)'),)
 
     def __init__(self):
         self.mode = None  # int enum from the table above
 
     def decode(self,packet,ofs):
-        if packet[ofs]==0:
-            self.mode = (0,'Off')
-        elif packet[ofs]==1:
-            self.mode = (1,'Passive')
-        elif packet[ofs]==2:
-            self.mode = (2,'Safe')
-        elif packet[ofs]==3:
-            self.mode = (3,'Full')       
+        self.mode = _oi_mode(packet[ofs])
 
     def __repr__(self):
         return 'OIMode mode:'+str(self.mode)
@@ -441,6 +529,8 @@ class OIMode:
 class SongNumber:
     ID = 36
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('song', 'x'),)
 
     def __init__(self):
         self.song = None  # int 0 to 15
@@ -453,6 +543,8 @@ class SongNumber:
 class SongPlaying:
     ID = 37
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('is_playing', 'x==1'),)
 
     def __init__(self):
         self.is_playing = None  # boolean
@@ -466,6 +558,8 @@ class SongPlaying:
 class NumberStreamPackets:
     ID = 38
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('num_packets', 'x'),)
 
     def __init__(self):
         self.num_packets = None  # int 0 to 108
@@ -479,6 +573,8 @@ class NumberStreamPackets:
 class RequestedVelocity:
     ID = 39
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('requested_velocity', 'x'),)
 
     def __init__(self):
         self.requested_velocity = None  # int mm/s -500 to 500
@@ -492,6 +588,8 @@ class RequestedVelocity:
 class RequestedRadius:
     ID = 40
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('requested_radius', 'x'),)
 
     def __init__(self):
         self.requested_radius = None  # int mm -32768 to 32767
@@ -505,6 +603,8 @@ class RequestedRadius:
 class RequestedRightVelocity:
     ID = 41
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('requested_right_velocity', 'x'),)
 
     def __init__(self):
         self.requested_right_velocity = None  # int mm/s -500 to 500
@@ -518,6 +618,8 @@ class RequestedRightVelocity:
 class RequestedLeftVelocity:
     ID = 42
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('requested_left_velocity', 'x'),)
 
     def __init__(self):
         self.requested_left_velocity = None  # int mm/s -500 to 500
@@ -531,6 +633,8 @@ class RequestedLeftVelocity:
 class LeftEncoderCounts:
     ID = 43
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('count', 'x'),)
 
     def __init__(self):
         self.count = None  # int -32768 to 32767
@@ -544,6 +648,8 @@ class LeftEncoderCounts:
 class RightEncoderCounts:
     ID = 44
     SIZE = 2
+    FORMAT = 'h'
+    FIELDS = (('count', 'x'),)
 
     def __init__(self):
         self.count = None # int -32768 to 32767
@@ -557,6 +663,15 @@ class RightEncoderCounts:
 class LightBumper:
     ID = 45
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (
+        ('is_right',        '(x&32)>0'),
+        ('is_front_right',  '(x&16)>0'),
+        ('is_center_right', '(x&8)>0'),
+        ('is_center_left',  '(x&4)>0'),
+        ('is_front_left',   '(x&2)>0'),
+        ('is_left',         '(x&1)>0'),
+    )
 
     def __init__(self):
         self.is_right = None  # boolean
@@ -582,6 +697,8 @@ class LightBumper:
 class LightBumpLeftSignal:
     ID = 46
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -595,6 +712,8 @@ class LightBumpLeftSignal:
 class LightBumpFrontLeftSignal:
     ID = 47
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -608,6 +727,8 @@ class LightBumpFrontLeftSignal:
 class LightBumpCenterLeftSignal:
     ID = 48
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -621,6 +742,8 @@ class LightBumpCenterLeftSignal:
 class LightBumpCenterRightSignal:
     ID = 49
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -634,6 +757,8 @@ class LightBumpCenterRightSignal:
 class LightBumpFrontRightSignal:
     ID = 50
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -647,6 +772,8 @@ class LightBumpFrontRightSignal:
 class LightBumpRightSignal:
     ID = 51
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('signal', 'x'),)
 
     def __init__(self):
         self.signal = None  # int 0 to 4095
@@ -660,6 +787,8 @@ class LightBumpRightSignal:
 class InfraredCharacterLeft:
     ID = 52
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('character', 'x'),)
 
     def __init__(self):
         self.character = None  # int 0 to 255
@@ -673,6 +802,8 @@ class InfraredCharacterLeft:
 class InfraredCharacterRight:
     ID = 53
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (('character', 'x'),)
 
     def __init__(self):
         self.character = None  # int 0 to 255
@@ -686,6 +817,8 @@ class InfraredCharacterRight:
 class LeftMotorCurrent:
     ID = 54
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('current_ma', 'x'),)
 
     def __init__(self):
         self.current_ma = None  # int mA -32768 to 32767
@@ -699,6 +832,8 @@ class LeftMotorCurrent:
 class RightMotorCurrent:
     ID = 55
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('current_ma', 'x'),)
 
     def __init__(self):
         self.current_ma = None  # int mA -32768 to 32767
@@ -712,6 +847,8 @@ class RightMotorCurrent:
 class MainBrushMotorCurrent:
     ID = 56
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('current_ma', 'x'),)
 
     def __init__(self):
         self.current_ma = None  # int mA -32768 to 32767
@@ -725,6 +862,8 @@ class MainBrushMotorCurrent:
 class SideBrushMotorCurrent:
     ID = 57
     SIZE = 2
+    FORMAT = 'H'
+    FIELDS = (('current_ma', 'x'),)
 
     def __init__(self):
         self.current_ma = None  # int mA -32768 to 32767
@@ -738,6 +877,11 @@ class SideBrushMotorCurrent:
 class Stasis:
     ID = 58
     SIZE = 1
+    FORMAT = 'B'
+    FIELDS = (
+        ('is_disabled', '(x&2)>0'),
+        ('is_toggling', '(x&1)>0'),
+    )
 
     def __init__(self):
         self.is_disabled = None  # boolean
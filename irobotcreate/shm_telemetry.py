@@ -0,0 +1,316 @@
+"""
+Share the packet stream with other processes through shared memory.
+
+The process that owns the serial port adds a SharedTelemetryWriter as a stream
+consumer. Every frame goes into a named block of shared memory
+(multiprocessing.shared_memory) as the same bytes the robot sent -- the packet IDs
+and data laid out just as "sensor_packets.py" and "sensor_groups.py" describe them.
+Any number of other processes open the block by name with a SharedTelemetryReader and
+decode it with a CompiledDecoder. Readers take no lock and nothing is sent over a
+socket. A read copies the one slot it checks (the frame plus 24 bytes).
+
+  # The driver process
+  shm = SharedTelemetryWriter('robot1')
+  roomba.add_stream_consumer(shm)
+  roomba.start_packet_stream([sensor_groups.Group_100()])
+
+  # Any other process
+  reader = SharedTelemetryReader('robot1')
+  timestamp, packets = reader.read()
+  print(packets[0].bumpsAndWheelDrops.bump_left)
+
+The block holds the last "history" frames in a ring. Each slot is a seqlock: the
+writer makes the slot's sequence number odd, writes the frame, then makes it even. A
+reader copies the slot, checks the number before and after, and tries again if the
+writer got in the way (a few times, then it gives up and returns None). Readers never
+slow the writer down.
+
+On ARM (the Raspberry Pi) another CPU can see the writer's stores out of order, so
+a matching sequence number alone doesn't prove the slot is whole. Every slot also
+holds a CRC-32 of its timestamp and data, and the reader checks it against its copy.
+
+When the writer starts a new stream it makes the new block before it marks the old
+one closed. When it goes away for good, the read calls return None (and
+wait_for_frame keeps waiting) until a writer makes the block again.
+
+Timestamps are time.monotonic() in the writer, which is the same clock in every
+process on Linux. Linux only.
+"""
+
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import shared_memory
+
+from compiled_decoder import PACKET_CLASSES, CompiledDecoder
+
+_MAGIC = b'OISH'
+_VERSION = 2
+# magic, version, state, number of packet IDs, data size, history, frames written
+_HEADER = struct.Struct('<4sBBHIIQ')
+_COUNT_OFS = 16
+_IDS_OFS = _HEADER.size
+_SLOTS_OFS = _IDS_OFS + 256
+# sequence number, CRC-32 of everything from the timestamp on, timestamp (the frame
+# data follows)
+_SLOT_HEADER = struct.Struct('<QI4xd')
+_CRC_OFS = 8
+_TIMESTAMP_OFS = 16
+_SEQ = struct.Struct('<Q')
+_CRC = struct.Struct('<I')
+_TIMESTAMP = struct.Struct('<d')
+
+_LIVE = 1
+_CLOSED = 0
+
+# Times a read tries the newest slot before giving up (a writer that died in the
+# middle of a frame leaves it bad for good)
+_READ_TRIES = 100
+
+
+def _slot_size(data_size):
+    # Keep every slot 8-byte aligned
+    return _SLOT_HEADER.size + (data_size+7)//8*8
+
+
+class SharedTelemetryWriter:
+
+    def __init__(self, name, history=256):
+        """Create a writer. The shared memory is made when the stream starts.
+
+        Args:
+            name: name of the shared memory block
+            history: number of frames to keep
+        """
+        self.name = name
+        self.history = history
+        self._shm = None
+        self._buf = None
+        self._count = 0
+        # record runs on the input thread. bind and close may not.
+        self._lock = threading.Lock()
+
+    def bind(self, decoder):
+        """Make the shared memory for a stream's layout. Roomba calls this for you."""
+        with self._lock:
+            self._bind(decoder)
+
+    def _bind(self, decoder):
+        ids = [s.ID for s in decoder.sensor_objects]
+        old = self._shm
+        if old is not None:
+            # A new stream. Free the name, but keep the old block live until the new
+            # one is ready. Readers see it closed and open the new one.
+            old.unlink()
+        data_size = decoder.struct.size
+        size = _SLOTS_OFS + self.history*_slot_size(data_size)
+        try:
+            shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a process that died
+            stale = shared_memory.SharedMemory(self.name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        buf = shm.buf
+        buf[_IDS_OFS:_IDS_OFS+len(ids)] = bytes(ids)
+        _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, _LIVE, len(ids), data_size, self.history, 0)
+        if old is not None:
+            self._buf[5] = _CLOSED
+            self._buf = None
+            old.close()
+        self._struct = decoder.struct
+        self._slot_size = _slot_size(data_size)
+        self._count = 0
+        self._shm = shm
+        self._buf = buf
+
+    def record(self, values, timestamp=None):
+        """Publish one frame. Roomba calls this from the input thread."""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self._lock:
+            buf = self._buf
+            if buf is None:
+                # Closed
+                return
+            n = self._count
+            ofs = _SLOTS_OFS + (n % self.history)*self._slot_size
+            _SEQ.pack_into(buf, ofs, 2*n+1)
+            data = _TIMESTAMP.pack(timestamp) + self._struct.pack(*values)
+            buf[ofs+_TIMESTAMP_OFS:ofs+_TIMESTAMP_OFS+len(data)] = data
+            _CRC.pack_into(buf, ofs+_CRC_OFS, zlib.crc32(data))
+            _SEQ.pack_into(buf, ofs, 2*n+2)
+            self._count = n+1
+            _SEQ.pack_into(buf, _COUNT_OFS, n+1)
+
+    def close(self):
+        """Mark the block closed and remove it."""
+        with self._lock:
+            if self._shm is None:
+                return
+            self._buf[5] = _CLOSED
+            self._buf = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def _attach(name):
+    try:
+        # Python 3.13+: don't let this process's resource tracker remove the block
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedTelemetryReader:
+
+    def __init__(self, name, sensor_objects=None):
+        """Open a writer's shared memory.
+
+        Args:
+            name: name of the shared memory block
+            sensor_objects: objects to decode into. Defaults to new ones for the stream.
+        """
+        self.name = name
+        self._shm = None
+        self._objects = sensor_objects
+        self.open()
+
+    def open(self):
+        """(Re)open the block. read() does this for you when the writer starts a new stream.
+
+        Raises:
+            FileNotFoundError if there is no writer
+        """
+        if self._shm is not None:
+            self._buf = None
+            self.decoder = None
+            self._shm.close()
+            self._shm = None
+        self._shm = _attach(self.name)
+        buf = self._shm.buf
+        magic, version, state, num_ids, data_size, history, _ = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(self.name+' is not shared telemetry')
+        self.packet_ids = list(buf[_IDS_OFS:_IDS_OFS+num_ids])
+        self.history = history
+        self._data_size = data_size
+        self._slot_size = _slot_size(data_size)
+        objs = self._objects
+        if objs is None or [s.ID for s in objs] != self.packet_ids:
+            objs = [PACKET_CLASSES[i]() for i in self.packet_ids]
+        self.sensor_objects = objs
+        self.decoder = CompiledDecoder(objs, stream=True)
+        self._buf = buf
+
+    def close(self):
+        self._buf = None
+        self.decoder = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    @property
+    def count(self):
+        """Number of frames the writer has published (0 if there is no writer)."""
+        if self._buf is None:
+            return 0
+        return _SEQ.unpack_from(self._buf, _COUNT_OFS)[0]
+
+    def _read_slot(self, n, decode):
+        # Frame n, or None if it is being written, has been overwritten, or is torn
+        buf = self._buf
+        ofs = _SLOTS_OFS + (n % self.history)*self._slot_size
+        seq, crc, _ = _SLOT_HEADER.unpack_from(buf, ofs)
+        if seq != 2*n+2:
+            return None
+        raw = bytes(buf[ofs+_TIMESTAMP_OFS:ofs+_SLOT_HEADER.size+self._data_size])
+        if _SEQ.unpack_from(buf, ofs)[0] != seq or zlib.crc32(raw) != crc:
+            return None
+        return _TIMESTAMP.unpack_from(raw, 0)[0], decode(raw, _TIMESTAMP.size)
+
+    def _check_open(self):
+        # True if there is a live block to read
+        if self._buf is not None and self._buf[5] != _CLOSED:
+            return True
+        # The writer started a new stream (or went away)
+        try:
+            self.open()
+        except FileNotFoundError:
+            return False
+        return self._buf[5] != _CLOSED
+
+    def read(self):
+        """Decode the newest frame into the sensor objects.
+
+        Returns:
+            (timestamp, sensor objects), or None if nothing has been published (or
+            there is no writer)
+        """
+        got = self._read_newest(False)
+        if got is None:
+            return None
+        return got[1], self.sensor_objects
+
+    def read_values(self):
+        """The newest frame as a tuple of raw values (like CompiledDecoder.decode returns).
+
+        Returns:
+            (frame number, timestamp, values), or None if nothing has been published
+            (or there is no writer)
+        """
+        return self._read_newest(True)
+
+    def _read_newest(self, raw):
+        # (frame number, timestamp, values) of the newest frame, or None
+        for _ in range(_READ_TRIES):
+            if not self._check_open():
+                return None
+            count = self.count
+            if not count:
+                return None
+            decode = self.decoder.struct.unpack_from if raw else self.decoder.decode
+            got = self._read_slot(count-1, decode)
+            if got is not None and got[1] is not None:
+                return count-1, got[0], got[1]
+        return None
+
+    def read_history(self, num_frames):
+        """Up to num_frames of the newest frames as raw values, oldest first.
+
+        Returns:
+            list of (frame number, timestamp, values). Empty if there is no writer.
+        """
+        if not self._check_open():
+            return []
+        count = self.count
+        ret = []
+        for n in range(max(0, count-min(num_frames, self.history)), count):
+            got = self._read_slot(n, self.decoder.struct.unpack_from)
+            if got is not None:
+                ret.append((n, got[0], got[1]))
+        return ret
+
+    def wait_for_frame(self, after, timeout=None, poll=0.0005):
+        """Sleep until frame number "after" has been passed.
+
+        Args:
+            after: the last frame number you have seen (or -1)
+            timeout: seconds to wait or None to wait forever
+            poll: seconds between checks
+
+        Returns:
+            True if there is a newer frame, False on a timeout
+        """
+        end = None if timeout is None else time.monotonic()+timeout
+        while not self._check_open() or self.count <= after+1:
+            if end is not None and time.monotonic() > end:
+                return False
+            time.sleep(poll)
+        return True
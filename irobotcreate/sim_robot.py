@@ -0,0 +1,355 @@
+"""
+A simulated Create 2 for working on the driver without a robot.
+
+The simulator speaks the Open Interface on the robot side of a transport. It handles
+the opcodes the driver sends (7, 128-150, 173), drives two simulated wheels (with
+encoders, distance, and angle), answers sensor queries, and streams packets every
+15ms. Everything it sends is paced to the baud rate like a real serial line.
+
+  sim, transport = SimulatedCreate.on_memory()     # in-process
+  roomba = Roomba(transport=transport)
+
+  sim, port_name = SimulatedCreate.on_pty()        # a pseudo-terminal (Linux)
+  roomba = Roomba(port_name)
+
+  python sim_robot.py 9000                         # TCP server
+  roomba = Roomba(transport=SocketTransport('localhost', 9000))
+
+Set the hazard attributes (bump_left, cliff_front_right, drop_left, ...) to
+simulate the world. In "safe" mode a cliff or wheel drop stops the wheels and drops
+the OI to "passive" just like the real thing.
+"""
+
+import math
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tty
+
+import transports
+from compiled_decoder import PACKET_CLASSES, flatten_packets
+from odometry import WHEEL_BASE_MM, COUNTS_PER_MM
+from roomba import BAUD_RATES
+
+STREAM_PERIOD = 0.015
+
+# Fixed length opcodes: number of data bytes after the opcode
+_ARG_COUNTS = {
+    7: 0, 128: 0, 129: 1, 130: 0, 131: 0, 132: 0, 133: 0, 134: 0, 135: 0, 136: 0,
+    137: 4, 138: 1, 139: 3, 141: 1, 142: 1, 143: 0, 144: 3, 145: 4, 146: 4, 150: 1,
+    173: 0,
+}
+
+
+def _make_layouts():
+    # ID -> list of (packet ID, struct format) or (None, pad size)
+    ret = {}
+    for pid, cls in PACKET_CLASSES.items():
+        ret[pid] = [(p.ID, p.FORMAT) if p is not None else (None, size)
+                    for _, p, size in flatten_packets([cls()])]
+    return ret
+
+_LAYOUTS = _make_layouts()
+
+
+def _clamp(value, limit):
+    return max(-limit, min(limit, int(value)))
+
+
+class SimulatedCreate:
+
+    def __init__(self, transport):
+        """Run a simulated robot on the robot end of a transport.
+
+        Args:
+            transport: the transport (the driver uses the other end)
+        """
+        self._transport = transport
+        self._lock = threading.RLock()
+        self._out_lock = threading.Lock()
+        self._wire_free = 0.0
+        self._running = True
+
+        # Hazards -- set these to simulate the world
+        self.bump_left = False
+        self.bump_right = False
+        self.drop_left = False
+        self.drop_right = False
+        self.cliff_left = False
+        self.cliff_front_left = False
+        self.cliff_front_right = False
+        self.cliff_right = False
+
+        self.mode = 0  # Off
+        self.response_delay = 0.0  # Seconds to "think" before answering a query
+        self.battery_charge_mah = 2500
+        self.num_commands = 0
+        self._requested_velocity = 0
+        self._requested_radius = 0
+        self._left_mms = 0
+        self._right_mms = 0
+        self._left_counts = 0.0
+        self._right_counts = 0.0
+        self._distance_mm = 0.0
+        self._angle_deg = 0.0
+        self._song = 0
+        self._stream_ids = None
+        self._stream_paused = False
+
+        for target in (self._command_thread, self._tick_thread):
+            th = threading.Thread(target=target)
+            th.daemon = True
+            th.start()
+
+    @classmethod
+    def on_memory(cls, baud=115200):
+        """Run a simulator on an in-memory transport.
+
+        Returns:
+            (simulator, transport for the driver)
+        """
+        host, robot = transports.MemoryTransport.pair(baud)
+        return cls(robot), host
+
+    @classmethod
+    def on_pty(cls, baud=115200):
+        """Run a simulator on a pseudo-terminal (Linux).
+
+        Returns:
+            (simulator, port name for the driver to open)
+        """
+        master, slave = os.openpty()
+        tty.setraw(master)
+        sim = cls(transports.FdTransport(master, baud))
+        # Keep the slave open so the master never sees a hangup
+        sim._slave = slave
+        return sim, os.ttyname(slave)
+
+    def stop(self):
+        self._running = False
+
+    ##### Output
+
+    def _send(self, data):
+        # One byte is 10 bits on the wire (start, 8 data, stop). Hand the data over
+        # when the last byte would have arrived.
+        with self._out_lock:
+            now = time.monotonic()
+            start = max(now, self._wire_free)
+            self._wire_free = start + len(data)*10.0/self._transport.baudrate
+            delay = self._wire_free - now
+            if delay > 0:
+                time.sleep(delay)
+            self._transport.write(data)
+
+    ##### Sensors
+
+    def _value(self, pid):
+        # The raw value of a single packet
+        if pid == 7:
+            return self.bump_right | self.bump_left<<1 | self.drop_right<<2 | self.drop_left<<3
+        if pid in (9, 10, 11, 12):
+            return int((self.cliff_left, self.cliff_front_left, self.cliff_front_right, self.cliff_right)[pid-9])
+        if pid == 19:
+            ret = _clamp(self._distance_mm, 32767)
+            self._distance_mm -= ret
+            return ret
+        if pid == 20:
+            ret = _clamp(self._angle_deg, 32767)
+            self._angle_deg -= ret
+            return ret
+        if pid == 22:
+            return 16000  # mV
+        if pid == 23:
+            return -200 - (abs(self._left_mms)+abs(self._right_mms))  # mA
+        if pid == 24:
+            return 25
+        if pid == 25:
+            return self.battery_charge_mah
+        if pid == 26:
+            return 2700
+        if pid in (28, 29, 30, 31):
+            return 0 if self._value(pid-19) else 2000
+        if pid == 35:
+            return self.mode
+        if pid == 36:
+            return self._song
+        if pid == 38:
+            return len(self._stream_ids) if self._stream_ids else 0
+        if pid == 39:
+            return self._requested_velocity
+        if pid == 40:
+            return self._requested_radius
+        if pid == 41:
+            return self._right_mms
+        if pid == 42:
+            return self._left_mms
+        if pid == 43:
+            return (int(self._left_counts) + 32768) % 65536 - 32768
+        if pid == 44:
+            return (int(self._right_counts) + 32768) % 65536 - 32768
+        if pid in (54, 55):
+            return abs(self._left_mms if pid == 54 else self._right_mms) // 2
+        return 0
+
+    def _encode(self, pid):
+        data = bytearray()
+        for sub, fmt in _LAYOUTS[pid]:
+            if sub is None:
+                data += bytes(fmt)
+            else:
+                data += struct.pack('>'+fmt, self._value(sub))
+        return data
+
+    def _stream_frame(self):
+        data = bytearray([19, 0])
+        for pid in self._stream_ids:
+            data.append(pid)
+            data += self._encode(pid)
+        data[1] = len(data)-2
+        data.append((256 - (sum(data) & 255)) & 255)
+        return bytes(data)
+
+    ##### Motion
+
+    def _set_wheels(self, left_mms, right_mms):
+        if self.mode < 2:
+            # Motors only run in safe and full mode
+            return
+        self._left_mms = _clamp(left_mms, 500)
+        self._right_mms = _clamp(right_mms, 500)
+
+    def _drive(self, velocity, radius):
+        self._requested_velocity = velocity
+        self._requested_radius = radius
+        if radius in (32767, -32768) or velocity == 0:
+            self._set_wheels(velocity, velocity)
+        elif radius == -1:
+            self._set_wheels(velocity, -velocity)
+        elif radius == 1:
+            self._set_wheels(-velocity, velocity)
+        else:
+            half = WHEEL_BASE_MM / 2
+            self._set_wheels(velocity*(radius-half)/radius, velocity*(radius+half)/radius)
+
+    def _tick(self, dt):
+        with self._lock:
+            if self.mode == 2 and (self.drop_left or self.drop_right or self.cliff_left or
+                                   self.cliff_front_left or self.cliff_front_right or self.cliff_right):
+                # Safe mode protection
+                self._left_mms = self._right_mms = 0
+                self.mode = 1
+            left = self._left_mms * dt
+            right = self._right_mms * dt
+            self._left_counts += left * COUNTS_PER_MM
+            self._right_counts += right * COUNTS_PER_MM
+            self._distance_mm += (left + right) / 2
+            self._angle_deg += math.degrees((right - left) / WHEEL_BASE_MM)
+            if self._stream_ids and not self._stream_paused:
+                return self._stream_frame()
+        return None
+
+    ##### Threads
+
+    def _tick_thread(self):
+        next_tick = time.monotonic()
+        while self._running:
+            next_tick += STREAM_PERIOD
+            frame = self._tick(STREAM_PERIOD)
+            if frame is not None:
+                self._send(frame)
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind (the link is too slow for the stream). Don't try to catch up.
+                next_tick = time.monotonic()
+
+    def _read(self, size):
+        data = self._transport.read(size)
+        if len(data) < size:
+            raise EOFError()
+        return data
+
+    def _command_thread(self):
+        try:
+            while self._running:
+                op = self._read(1)[0]
+                if op == 140:
+                    head = self._read(2)
+                    args = head + self._read(head[1]*2)
+                elif op in (148, 149):
+                    count = self._read(1)
+                    args = count + self._read(count[0])
+                else:
+                    args = self._read(_ARG_COUNTS.get(op, 0))
+                self.num_commands += 1
+                reply = self._command(op, args)
+                if reply:
+                    if self.response_delay:
+                        time.sleep(self.response_delay)
+                    self._send(reply)
+        except EOFError:
+            self._running = False
+
+    def _command(self, op, args):
+        with self._lock:
+            if op == 7:
+                self.mode = 0
+                self._stream_ids = None
+                self._left_mms = self._right_mms = 0
+                return b'bl-start\r\nRoomba by iRobot!\r\n'
+            if op == 128 or op in (133, 134, 135, 136, 143):
+                self.mode = 1
+            elif op == 129:
+                # Answer at the old rate, then switch
+                rate = BAUD_RATES[args[0]]
+                with self._out_lock:
+                    self._transport.baudrate = rate
+            elif op in (130, 131):
+                self.mode = 2
+            elif op == 132:
+                self.mode = 3
+            elif op == 173:
+                self.mode = 0
+                self._stream_ids = None
+            elif op == 137:
+                self._drive(*struct.unpack('>hh', args))
+            elif op == 145:
+                right, left = struct.unpack('>hh', args)
+                self._set_wheels(left, right)
+            elif op == 146:
+                right, left = struct.unpack('>hh', args)
+                self._set_wheels(left*500/255, right*500/255)
+            elif op == 141:
+                self._song = args[0]
+            elif op == 142:
+                return self._encode(args[0])
+            elif op == 149:
+                return b''.join(self._encode(pid) for pid in args[1:])
+            elif op == 148:
+                self._stream_ids = list(args[1:])
+                self._stream_paused = False
+            elif op == 150:
+                self._stream_paused = not args[0]
+        return None
+
+
+def serve_tcp(port, host='127.0.0.1', baud=115200):
+    """Serve a fresh simulated robot to every TCP connection. Does not return."""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(4)
+    while True:
+        conn, addr = server.accept()
+        print('Simulated robot connected to', addr)
+        SimulatedCreate(transports.SocketTransport(conn, baud=baud))
+
+
+if __name__ == '__main__':
+
+    serve_tcp(int(sys.argv[1]) if len(sys.argv) > 1 else 9000)
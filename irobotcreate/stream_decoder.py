@@ -0,0 +1,115 @@
+"""
+Framing for the OI sensor stream (opcode 148).
+
+Once a stream is started the OI sends one frame every 15ms:
+
+  19, N, [packet ID, packet data ...] ..., checksum
+
+N is the number of bytes between N and the checksum. The checksum makes the 8-bit
+sum of every byte in the frame (19 and N included) come out to zero.
+
+The serial port hands us bytes in whatever chunks the OS has collected. The
+StreamDecoder collects those chunks in one reusable buffer and pulls complete
+frames out of it. Each frame is handed to the callback as (buffer, offset, size)
+where "offset" is the first byte after N. The buffer is only valid during the
+callback -- copy anything you need to keep.
+
+A 19 can show up anywhere in the packet data. A frame is only accepted if the
+header, the length (when we know what length to expect) and the checksum all
+agree. Anything else is treated as a false start: we step one byte past the 19
+and hunt for the next one.
+"""
+
+STREAM_HEADER = 19
+
+
+class StreamDecoder:
+
+    def __init__(self, frame_cb, expected_size=None):
+        """Create a new stream framer.
+
+        Args:
+            frame_cb: function(buffer, offset, size) called for every good frame
+            expected_size: the N every frame should have (or None to accept any)
+        """
+        self._frame_cb = frame_cb
+        self._buffer = bytearray()
+        self.reset(expected_size)
+
+    def reset(self, expected_size=None):
+        """Throw away any partial frame and zero the counters.
+
+        Args:
+            expected_size: the N every frame should have (or None to accept any)
+        """
+        del self._buffer[:]
+        self._expected_size = expected_size
+        self._in_sync = True
+        self.num_frames = 0         # Good frames handed to the callback
+        self.num_bad_checksums = 0  # Frames that failed the checksum
+        self.num_resyncs = 0        # Number of times we lost sync and had to hunt
+        self.num_dropped_bytes = 0  # Bytes thrown away while hunting
+
+    def discard(self):
+        """Throw away any partial frame. The counters are kept."""
+        del self._buffer[:]
+
+    def get_counters(self):
+        return {
+            'frames': self.num_frames,
+            'bad_checksums': self.num_bad_checksums,
+            'resyncs': self.num_resyncs,
+            'dropped_bytes': self.num_dropped_bytes,
+        }
+
+    def _drop(self, count):
+        if self._in_sync:
+            self._in_sync = False
+            self.num_resyncs += 1
+        self.num_dropped_bytes += count
+
+    def feed(self, data):
+        """Add bytes from the serial port and decode any complete frames.
+
+        Args:
+            data: bytes as read from the port (any length)
+        """
+        buf = self._buffer
+        buf += data
+        expected = self._expected_size
+        pos = 0
+        end = len(buf)
+        while True:
+            # Get in sync ... find the next 19
+            start = buf.find(STREAM_HEADER, pos)
+            if start < 0:
+                if pos < end:
+                    self._drop(end-pos)
+                pos = end
+                break
+            if start > pos:
+                self._drop(start-pos)
+            pos = start
+            if pos+1 >= end:
+                break
+            size = buf[pos+1]
+            if expected is not None and size != expected:
+                # Not a frame header. Just a 19 in the data.
+                self._drop(1)
+                pos += 1
+                continue
+            if pos+size+3 > end:
+                # Wait for the rest of the frame
+                break
+            if sum(buf[pos:pos+size+3]) & 255:
+                self.num_bad_checksums += 1
+                self._drop(1)
+                pos += 1
+                continue
+            self._in_sync = True
+            self.num_frames += 1
+            self._frame_cb(buf, pos+2, size)
+            pos += size+3
+        # Drop everything we have consumed. Deleting from the front of a bytearray
+        # does not move the data.
+        del buf[:pos]
@@ -0,0 +1,205 @@
+"""
+Hand the packet stream to any number of consumers without slowing the input thread.
+
+The stream_update_cb runs on the input thread. If it takes longer than 15ms (writing
+a log, pushing to a web page, ...) the frames back up in the serial port. The
+StreamHub is a stream consumer that does almost nothing on the input thread: for
+every frame it drops the (immutable) tuple of raw values into each subscriber's own
+bounded queue. The subscriber decodes the values into its own packet objects on its
+own time.
+
+  hub = StreamHub()
+  roomba.add_stream_consumer(hub)
+  roomba.start_packet_stream([sensor_groups.Group_100()])
+
+  # A callback on its own thread, every 10th frame, only ever the newest
+  hub.subscribe(show_on_screen, policy=LATEST_ONLY, decimation=10)
+
+  # Or pull frames yourself
+  sub = hub.subscribe(maxlen=100)
+  while True:
+      packets = sub.get()
+      ...
+
+When a queue is full the subscriber loses frames, never the input thread:
+
+  DROP_OLDEST  keep the newest "maxlen" frames (the default)
+  LATEST_ONLY  keep only the newest frame
+
+Every subscription counts what it delivered, dropped, and how long frames waited in
+its queue (see get_metrics).
+"""
+
+import threading
+import time
+from collections import deque
+
+from compiled_decoder import CompiledDecoder
+
+DROP_OLDEST = 'drop_oldest'
+LATEST_ONLY = 'latest_only'
+
+
+class Subscription:
+
+    def __init__(self, callback, maxlen, policy, decimation, sensor_objects):
+        if policy not in (DROP_OLDEST, LATEST_ONLY):
+            raise ValueError('Unknown overflow policy '+str(policy))
+        self.policy = policy
+        self.decimation = decimation
+        self.sensor_objects = sensor_objects
+        self.timestamp = None   # time.monotonic() the last frame returned by get arrived
+        self.seq = None         # the hub's number for that frame
+        self._callback = callback
+        self._queue = deque(maxlen=1 if policy == LATEST_ONLY else maxlen)
+        self._ready = threading.Condition()
+        self._closed = False
+        self._decoder = None
+        self._count = 0
+        self.num_delivered = 0
+        self.num_dropped = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self._lag_total = 0.0
+        if callback is not None:
+            th = threading.Thread(target=self._callback_thread)
+            th.daemon = True
+            th.start()
+
+    def _bind(self, decoder):
+        # A new stream. Decode into our own objects of the same types.
+        objs = self.sensor_objects
+        if objs is None or [type(s) for s in objs] != [type(s) for s in decoder.sensor_objects]:
+            objs = [type(s)() for s in decoder.sensor_objects]
+        with self._ready:
+            self._queue.clear()
+            self.sensor_objects = objs
+            self._decoder = CompiledDecoder(objs, stream=True)
+
+    def _offer(self, item):
+        # On the input thread. Never waits on the subscriber.
+        self._count += 1
+        if self._count < self.decimation:
+            return
+        self._count = 0
+        with self._ready:
+            if len(self._queue) == self._queue.maxlen:
+                self.num_dropped += 1
+            self._queue.append(item)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Wait for the next frame and decode it into this subscription's objects.
+
+        Args:
+            timeout: seconds to wait or None to wait forever
+
+        Returns:
+            the list of sensor objects, or None on a timeout or after close
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._queue or self._closed, timeout):
+                return None
+            if self._closed:
+                return None
+            values, timestamp, seq = self._queue.popleft()
+            decoder = self._decoder
+        decoder.apply(values)
+        lag = time.monotonic() - timestamp
+        self.lag_last = lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+        self._lag_total += lag
+        self.num_delivered += 1
+        self.timestamp = timestamp
+        self.seq = seq
+        return decoder.sensor_objects
+
+    def get_metrics(self):
+        """Counters for this subscription.
+
+        Returns:
+            dict with:
+              delivered: frames handed to get (or the callback)
+              dropped: frames pushed out of a full queue
+              queued: frames waiting now
+              lag_last: seconds the last delivered frame waited after arriving
+              lag_max: worst lag so far
+              lag_mean: average lag
+        """
+        return {
+            'delivered': self.num_delivered,
+            'dropped': self.num_dropped,
+            'queued': len(self._queue),
+            'lag_last': self.lag_last,
+            'lag_max': self.lag_max,
+            'lag_mean': self._lag_total/self.num_delivered if self.num_delivered else 0.0,
+        }
+
+    def close(self):
+        """Stop delivering. A waiting get returns None and the callback thread ends."""
+        with self._ready:
+            self._closed = True
+            self._queue.clear()
+            self._ready.notify_all()
+
+    def _callback_thread(self):
+        while True:
+            packets = self.get()
+            if packets is None:
+                return
+            self._callback(packets)
+
+
+class StreamHub:
+
+    def __init__(self):
+        self._subscriptions = []
+        self._decoder = None
+        self._seq = 0
+
+    def subscribe(self, callback=None, maxlen=8, policy=DROP_OLDEST, decimation=1, sensor_objects=None):
+        """Add a subscriber.
+
+        Args:
+            callback: function(packets) to call on a thread of its own for every frame,
+                or None to pull frames with Subscription.get
+            maxlen: frames the queue holds (DROP_OLDEST)
+            policy: DROP_OLDEST or LATEST_ONLY
+            decimation: pass on every Nth frame
+            sensor_objects: objects to decode into. Defaults to new objects of the
+                same types as the stream's.
+
+        Returns:
+            the Subscription
+        """
+        sub = Subscription(callback, maxlen, policy, decimation, sensor_objects)
+        if self._decoder is not None:
+            sub._bind(self._decoder)
+        self._subscriptions = self._subscriptions + [sub]
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = list(self._subscriptions)
+        subs.remove(sub)
+        self._subscriptions = subs
+        sub.close()
+
+    def bind(self, decoder):
+        """Roomba calls this when a stream starts."""
+        self._decoder = decoder
+        for sub in self._subscriptions:
+            sub._bind(decoder)
+
+    def record(self, values, timestamp=None):
+        """Roomba calls this from the input thread for every frame."""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._seq += 1
+        item = (values, timestamp, self._seq)
+        for sub in self._subscriptions:
+            sub._offer(item)
+
+    def get_metrics(self):
+        """List of get_metrics() for every subscription (in the order they were added)."""
+        return [sub.get_metrics() for sub in self._subscriptions]
@@ -0,0 +1,173 @@
+"""
+Fit the packets you want into what the serial link can carry.
+
+The robot sends a stream frame every 15ms. Every frame is a header byte, a count,
+an ID byte before each packet or group, the data, and a checksum. A serial byte is
+10 bits on the wire, so at 115200 baud a frame can be 172 bytes long; at 57600 it
+is 86 and at 19200 only 28. A longer frame is corrupted and the reader throws it
+away.
+
+plan_stream looks at the packets you want and the baud rate. It picks the groups
+and packets that carry them in the fewest bytes. If that fits in a frame you
+stream at 66 frames per second. If not, the packets are polled with queries
+instead (opcode 149). A query's answer is only the data -- no header, IDs, or
+checksum -- so it is the fastest way to move more than a frame holds.
+
+  want = [sensor_packets.Angle(), sensor_packets.Distance(), sensor_packets.OIMode()]
+  plan = plan_stream(want, roomba.roomba.baudrate)
+  print(plan)          # what it picked and how fast it will update
+  plan.start(roomba)
+  ...
+  print(plan.get(sensor_packets.Angle).since_last_deg)
+
+Streams are never split into several streams taking turns. The OI can only stream
+one list at a time, so taking turns means restarting the stream, and every packet
+would still carry its ID. Polling the same packets is always at least as fast.
+"""
+
+import itertools
+
+from compiled_decoder import PACKET_CLASSES, flatten_packets
+
+FRAME_PERIOD = 0.015
+
+# 19, the count, and the checksum around every stream frame
+FRAME_OVERHEAD = 3
+
+# Start, 8 data, and stop bits
+BITS_PER_BYTE = 10
+
+
+def frame_bytes(sensor_objects):
+    """Bytes on the wire for one stream frame of these packets/groups."""
+    return FRAME_OVERHEAD + sum(1+s.SIZE for s in sensor_objects)
+
+
+def answer_bytes(sensor_objects):
+    """Bytes on the wire for the answer to one query of these packets/groups."""
+    return sum(s.SIZE for s in sensor_objects)
+
+
+def slot_capacity(baud):
+    """Bytes the robot can send in one 15ms stream period."""
+    return baud*FRAME_PERIOD/BITS_PER_BYTE
+
+
+def packet_ids(sensor_objects):
+    """The IDs of every packet in a list of packets/groups (groups broken down)."""
+    return set(p.ID for _, p, _ in flatten_packets(sensor_objects) if p is not None)
+
+
+def _group_members():
+    # Group ID -> the packet IDs in it
+    ret = {}
+    for pid, cls in PACKET_CLASSES.items():
+        if not hasattr(cls, 'FORMAT'):
+            ret[pid] = packet_ids([cls()])
+    return ret
+
+_GROUP_MEMBERS = _group_members()
+
+
+def cover(wanted_ids):
+    """The packet/group IDs that carry every wanted packet in the fewest bytes.
+
+    Every packet/group costs an ID byte on top of its data: in the stream frame, or
+    in the query command.
+
+    Args:
+        wanted_ids: packet IDs
+
+    Returns:
+        sorted list of packet and group IDs
+    """
+    wanted = set(wanted_ids)
+    groups = [g for g, members in _GROUP_MEMBERS.items() if members & wanted]
+    best = None
+    # There are only a handful of groups. Try every combination.
+    for num in range(len(groups)+1):
+        for combo in itertools.combinations(groups, num):
+            covered = set()
+            for g in combo:
+                covered |= _GROUP_MEMBERS[g]
+            ids = list(combo) + sorted(wanted - covered)
+            cost = sum(1+PACKET_CLASSES[i].SIZE for i in ids)
+            if best is None or (cost, len(ids)) < best[0]:
+                best = ((cost, len(ids)), ids)
+    return sorted(best[1])
+
+
+class StreamPlan:
+    """How to get a list of packets over the link. Made by plan_stream.
+
+    Attributes:
+        mode: "stream" or "poll"
+        sensor_objects: the packets/groups to stream or query
+        bytes: bytes per frame (stream) or per answer (poll)
+        capacity: bytes the link carries in 15ms
+        rate_hz: updates per second you can expect
+        baud: the baud rate planned for
+    """
+
+    def __init__(self, mode, sensor_objects, baud):
+        self.mode = mode
+        self.sensor_objects = sensor_objects
+        self.baud = baud
+        self.capacity = slot_capacity(baud)
+        if mode == 'stream':
+            self.bytes = frame_bytes(sensor_objects)
+            self.rate_hz = 1/FRAME_PERIOD
+        else:
+            self.bytes = answer_bytes(sensor_objects)
+            # One query at a time: the command goes out, then the answer comes back
+            command = 2+len(sensor_objects)
+            wire = (command+self.bytes)*BITS_PER_BYTE/baud
+            self.rate_hz = 1/max(wire, FRAME_PERIOD)
+
+    def get(self, cls):
+        """The object of a packet or group class that the plan decodes into (or None)."""
+        for top, p, _ in flatten_packets(self.sensor_objects):
+            if isinstance(top, cls):
+                return top
+            if isinstance(p, cls):
+                return p
+        return None
+
+    def start(self, roomba, recorder=None):
+        """Start the stream or the polling on a Roomba."""
+        if self.mode == 'stream':
+            roomba.start_packet_stream(self.sensor_objects, recorder)
+        else:
+            roomba.start_packet_poll(self.sensor_objects, self.rate_hz, recorder)
+
+    def __repr__(self):
+        names = ', '.join(type(s).__name__ for s in self.sensor_objects)
+        if self.mode == 'stream':
+            how = '%d bytes per frame' % self.bytes
+        else:
+            how = 'too big to stream, %d bytes per query' % self.bytes
+        return '%s at %d baud: %s (%.1f fit in 15ms). %s at %.1f Hz' % (
+            names, self.baud, how, self.capacity, self.mode, self.rate_hz)
+
+
+def plan_stream(sensor_objects, baud):
+    """Plan how to get packets at a baud rate.
+
+    Args:
+        sensor_objects: the packets/groups you want. Objects the plan uses as they
+            are are kept; anything else is read out of new objects (see StreamPlan.get).
+        baud: the link's baud rate
+
+    Returns:
+        a StreamPlan
+    """
+    wanted = packet_ids(sensor_objects)
+    mine = {s.ID: s for s in sensor_objects}
+
+    def objects(ids):
+        return [mine[i] if i in mine else PACKET_CLASSES[i]() for i in ids]
+
+    objs = objects(cover(wanted))
+    if frame_bytes(objs) <= slot_capacity(baud):
+        return StreamPlan('stream', objs, baud)
+    return StreamPlan('poll', objs, baud)
@@ -0,0 +1,270 @@
+"""
+Capture the packet stream to disk and play it back later.
+
+A log is two files:
+
+  name.oilog      a small header then every stream frame exactly as it came off the
+                  wire (19, N, ..., checksum), back to back
+  name.oilog.idx  one 16-byte entry per frame: time.time() when the frame arrived
+                  (little-endian double) and the frame's offset in the log (uint64)
+
+Both files are only ever appended to. The reader memory-maps them, so opening a log
+of any size is instant and frames are read straight from the page cache.
+
+  log = TelemetryLogWriter('run1.oilog')
+  roomba.start_packet_stream([sensor_groups.Group_100()], log=log)
+  ...
+  log.close()
+
+The player runs the frames through the driver's own stream path (the StreamDecoder,
+the CompiledDecoder and your stream_update_cb) either at the recorded pace or as fast
+as the decode can go:
+
+  player = LogPlayer(TelemetryLog('run1.oilog'), stream_update_cb=got_stream_update)
+  player.play()              # real time
+  player.play(speed=None)    # flat out
+
+The header holds the stream's packet IDs. The player makes fresh sensor objects for
+them unless you hand it your own.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from compiled_decoder import PACKET_CLASSES
+from roomba import Roomba
+
+_MAGIC = b'OILG'
+_VERSION = 1
+# Magic, version, number of packet IDs (the IDs follow)
+_HEADER = struct.Struct('<4sBB')
+_INDEX_ENTRY = struct.Struct('<dQ')
+
+
+class TelemetryLogWriter:
+
+    def __init__(self, path):
+        """Open a log for writing. An existing log is appended to.
+
+        Args:
+            path: name of the log file (the index is this plus ".idx")
+        """
+        self.path = path
+        self.packet_ids = None
+        self.num_frames = 0
+        # The input thread writes frames while the owner may close the log
+        self._lock = threading.Lock()
+        self._closed = False
+        self._log = open(path, 'ab')
+        self._idx = open(path + '.idx', 'ab')
+        if self._log.tell():
+            # Appending. Pick up the packet IDs from the header.
+            with open(path, 'rb') as f:
+                self.packet_ids = _read_header(f.read(_HEADER.size + 255))
+
+    def begin(self, packet_ids):
+        """Set the stream's packet IDs. Roomba.start_packet_stream calls this for you.
+
+        Every frame in a log must have the same packets.
+
+        Args:
+            packet_ids: list of the IDs in the stream
+        """
+        packet_ids = list(packet_ids)
+        if self.packet_ids is None:
+            self._log.write(_HEADER.pack(_MAGIC, _VERSION, len(packet_ids)) + bytes(packet_ids))
+            self.packet_ids = packet_ids
+        elif packet_ids != self.packet_ids:
+            raise ValueError('Log '+self.path+' holds packets '+str(self.packet_ids)+' not '+str(packet_ids))
+
+    def write_frame(self, frame, timestamp=None):
+        """Add one frame.
+
+        Args:
+            frame: the whole frame from the 19 through the checksum
+            timestamp: time.time() of the frame (defaults to now)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._closed:
+                # The stream outlived the log. Nothing more to save.
+                return
+            self._idx.write(_INDEX_ENTRY.pack(timestamp, self._log.tell()))
+            self._log.write(frame)
+            self.num_frames += 1
+
+    def flush(self):
+        """Push everything written so far to the OS."""
+        with self._lock:
+            if not self._closed:
+                # The log first: an index entry is never ahead of its frame
+                self._log.flush()
+                self._idx.flush()
+
+    def close(self):
+        """Flush and close the files. Frames that arrive after this are not saved."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._log.close()
+            self._idx.close()
+
+
+def _read_header(data):
+    magic, version, count = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('Not a telemetry log')
+    return list(data[_HEADER.size:_HEADER.size+count])
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class TelemetryLog:
+    """A log opened for reading. Frames are indexed from 0."""
+
+    def __init__(self, path):
+        """Map a log and its index.
+
+        Args:
+            path: name of the log file (the index is this plus ".idx")
+        """
+        self.path = path
+        self._log = _map(path)
+        self._idx = _map(path + '.idx')
+        self.packet_ids = _read_header(self._log)
+        count = len(self._idx) // _INDEX_ENTRY.size
+        # A log that was being written when the power went out can end in the
+        # middle of a frame
+        while count and self._frame_end(count-1) > len(self._log):
+            count -= 1
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _frame_end(self, index):
+        ofs = self.offset(index)
+        if ofs+1 >= len(self._log):
+            return ofs+2
+        return ofs + self._log[ofs+1] + 3
+
+    def offset(self, index):
+        """Where frame "index" starts in the log file."""
+        return _INDEX_ENTRY.unpack_from(self._idx, index*_INDEX_ENTRY.size)[1]
+
+    def timestamp(self, index):
+        """The time.time() frame "index" arrived."""
+        return _INDEX_ENTRY.unpack_from(self._idx, index*_INDEX_ENTRY.size)[0]
+
+    def frame(self, index):
+        """The bytes of frame "index" (19 through the checksum)."""
+        return self._log[self.offset(index):self._frame_end(index)]
+
+    def find(self, timestamp):
+        """The index of the first frame at or after a time.time()."""
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo+hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    def make_sensor_objects(self):
+        """New sensor packet and sensor group objects for the logged stream."""
+        return [PACKET_CLASSES[i]() for i in self.packet_ids]
+
+    def close(self):
+        for m in (self._log, self._idx):
+            if m:
+                m.close()
+
+
+class LogPlayer(Roomba):
+    """Plays a log through the same stream decode path as a live robot."""
+
+    # Bytes handed to the decoder at a time when playing flat out
+    CHUNK_SIZE = 65536
+
+    def __init__(self, log, stream_update_cb=None):
+        """Create a player.
+
+        Args:
+            log: the TelemetryLog to play
+            stream_update_cb: function(packets) called for every frame
+        """
+        self._setup(stream_update_cb)
+        self.log = log
+
+    def _write(self, data):
+        # There is no robot to tell
+        pass
+
+    def play(self, sensor_objects=None, speed=1.0, start=0, stop=None, recorder=None):
+        """Play frames start to stop-1 through the stream callback.
+
+        Args:
+            sensor_objects: objects to decode into. Defaults to new ones from the log.
+            speed: 1.0 for real time, 2.0 for twice as fast, None for as fast as possible
+            start: first frame to play
+            stop: frame after the last one to play. Defaults to the end of the log.
+            recorder: optional TelemetryRecorder to fill
+
+        Returns:
+            the sensor objects (holding the last frame's values)
+        """
+        log = self.log
+        if sensor_objects is None:
+            sensor_objects = log.make_sensor_objects()
+        if stop is None:
+            stop = len(log)
+        self.start_packet_stream(sensor_objects, recorder)
+        if start >= stop:
+            return sensor_objects
+        if speed is None:
+            # The frames are back to back in the log. Hand them over in big pieces.
+            pos = log.offset(start)
+            end = log._frame_end(stop-1)
+            while pos < end:
+                self._process_input(log._log[pos:min(pos+self.CHUNK_SIZE, end)])
+                pos += self.CHUNK_SIZE
+            return sensor_objects
+        first = log.timestamp(start)
+        began = time.monotonic()
+        for i in range(start, stop):
+            delay = (log.timestamp(i)-first)/speed - (time.monotonic()-began)
+            if delay > 0:
+                time.sleep(delay)
+            self._process_input(log.frame(i))
+        return sensor_objects
+
+
+if __name__ == '__main__':
+
+    # python telemetry_log.py name.oilog
+    #   Print what is in a log and time a flat out replay through the decode path
+
+    log = TelemetryLog(sys.argv[1])
+    print('%s: packets %s  frames %d' % (log.path, log.packet_ids, len(log)))
+    if len(log):
+        secs = log.timestamp(len(log)-1) - log.timestamp(0)
+        print('recorded over %.1f seconds' % secs)
+        player = LogPlayer(log, stream_update_cb=lambda packets: None)
+        start = time.perf_counter()
+        player.play(speed=None)
+        secs = time.perf_counter() - start
+        print('replayed %d frames in %.3f seconds (%.0f frames/s)' % (len(log), secs, len(log)/secs))
+        print(player.get_stream_counters())
@@ -0,0 +1,127 @@
+"""
+Keep a history of the packet stream without making any python objects per frame.
+
+The stream callback gets the same packet objects every 15ms with new values. If you
+want history you have to copy it somewhere. The TelemetryRecorder is that somewhere:
+a fixed number of rows allocated up front, one column per packet value plus a
+timestamp column. When it fills up the oldest rows are overwritten.
+
+  rec = TelemetryRecorder(capacity=66*60*5)  # Five minutes at 15ms
+  roomba.start_packet_stream([sensor_groups.Group_100()], recorder=rec)
+  ...
+  older, newer = rec.window('LeftEncoderCounts')  # numpy views, no copies
+
+Columns are named for the packet class (a second copy of the same packet gets "_2"
+tacked on). They hold the raw value from the robot: bits packets are the whole byte,
+BatteryVoltage is mV, and so on. Use the FIELDS in "sensor_packets.py" to turn them
+into the decoded values.
+
+The columns are "array" module arrays. The numpy functions need numpy installed; the
+rest of the recorder does not. The rows are written by the input thread while you
+are reading them -- the newest row may be half written.
+"""
+
+import array
+import time
+
+# struct format to array type
+_ARRAY_TYPES = {'B': 'B', 'b': 'b', 'H': 'H', 'h': 'h'}
+
+
+class TelemetryRecorder:
+
+    def __init__(self, capacity):
+        """Create a recorder.
+
+        Args:
+            capacity: number of frames to keep
+        """
+        self.capacity = capacity
+        self.names = []
+        self.columns = {}
+        self.timestamps = array.array('d', bytes(8*capacity))
+        self._writers = []
+        self._next = 0
+        self.count = 0
+
+    def bind(self, decoder):
+        """Make the columns for a CompiledDecoder's values. This clears the history.
+
+        Roomba.start_packet_stream calls this for you.
+
+        Args:
+            decoder: the CompiledDecoder whose values will be recorded
+        """
+        self.names = []
+        self.columns = {}
+        self._writers = []
+        for index, (name, fmt) in enumerate(zip(decoder.value_names, decoder.value_formats)):
+            if name is None:
+                # The stream ID bytes
+                continue
+            col_name = name
+            n = 2
+            while col_name in self.columns:
+                col_name = name + '_' + str(n)
+                n += 1
+            typecode = _ARRAY_TYPES[fmt]
+            col = array.array(typecode, bytes(array.array(typecode).itemsize*self.capacity))
+            self.names.append(col_name)
+            self.columns[col_name] = col
+            self._writers.append((col, index))
+        self._next = 0
+        self.count = 0
+
+    def record(self, values, timestamp=None):
+        """Add one frame of values.
+
+        Args:
+            values: the tuple returned by CompiledDecoder.decode
+            timestamp: time.monotonic() of the frame (defaults to now)
+        """
+        i = self._next
+        self.timestamps[i] = time.monotonic() if timestamp is None else timestamp
+        for col, index in self._writers:
+            col[i] = values[index]
+        i += 1
+        if i == self.capacity:
+            i = 0
+        self._next = i
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _column(self, name):
+        if name == 'timestamp':
+            return self.timestamps
+        return self.columns[name]
+
+    def view(self, name):
+        """The whole column (all "capacity" rows in storage order) as a numpy array.
+
+        This is a view on the recorder's memory. It changes as new frames arrive.
+
+        Args:
+            name: column name or "timestamp"
+        """
+        import numpy
+        return numpy.frombuffer(self._column(name), dtype=self._column(name).typecode)
+
+    def window(self, name):
+        """The recorded rows in time order as two numpy views (older, newer).
+
+        Before the recorder wraps "older" is empty. numpy.concatenate the pair if you
+        need one array (that makes a copy).
+
+        Args:
+            name: column name or "timestamp"
+        """
+        data = self.view(name)
+        if self.count < self.capacity:
+            return data[:0], data[:self.count]
+        return data[self._next:], data[:self._next]
+
+    def latest(self, name):
+        """The most recent value of a column (or None if nothing is recorded yet)."""
+        if not self.count:
+            return None
+        return self._column(name)[self._next-1]
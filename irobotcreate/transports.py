@@ -0,0 +1,175 @@
+"""
+The byte pipes between the driver and a robot.
+
+Roomba only uses a handful of pyserial's methods. Anything with these can stand in
+for the serial port:
+
+  read(size)     block until "size" bytes arrive (fewer only if the pipe closes)
+  in_waiting     number of bytes that can be read without blocking
+  write(data)    send bytes
+  baudrate       link speed in bits/sec (settable)
+  close()
+
+  open_serial      a real serial port (pyserial)
+  SocketTransport  a TCP connection (a serial-to-network bridge or the simulator)
+  FdTransport      a raw file descriptor (like the master side of a pty)
+  MemoryTransport  an in-process pair of pipes (for the simulator and tests)
+"""
+
+import array
+import fcntl
+import os
+import socket
+import termios
+import threading
+
+
+def open_serial(port_name, baud):
+    """Open a serial port.
+
+    Args:
+        port_name: name of the port e.g. "COM4" or "/dev/ttyUSB0"
+        baud: baud rate of the interface
+    """
+    # Only needed for real ports
+    import serial
+    return serial.Serial(port_name, baud)
+
+
+def _fd_in_waiting(fd):
+    buf = array.array('i', [0])
+    fcntl.ioctl(fd, termios.FIONREAD, buf)
+    return buf[0]
+
+
+class FdTransport:
+    """A transport on an open file descriptor."""
+
+    def __init__(self, fd, baud=115200):
+        self._fd = fd
+        self.baudrate = baud
+
+    def fileno(self):
+        return self._fd
+
+    @property
+    def in_waiting(self):
+        return _fd_in_waiting(self._fd)
+
+    def read(self, size=1):
+        ret = b''
+        while len(ret) < size:
+            try:
+                d = os.read(self._fd, size-len(ret))
+            except OSError:
+                # A pty master reports EIO when the other side closes
+                break
+            if not d:
+                break
+            ret += d
+        return ret
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SocketTransport:
+    """A transport on a TCP connection."""
+
+    def __init__(self, host_or_socket, port=None, baud=115200):
+        """Connect to host:port, or wrap an already connected socket.
+
+        Args:
+            host_or_socket: host name or a connected socket
+            port: TCP port (when connecting)
+            baud: reported baud rate (the socket does not care)
+        """
+        if isinstance(host_or_socket, socket.socket):
+            self._sock = host_or_socket
+        else:
+            self._sock = socket.create_connection((host_or_socket, port))
+        # Commands are a few bytes. Send them now.
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.baudrate = baud
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    @property
+    def in_waiting(self):
+        if self._sock.fileno() < 0:
+            # Closed
+            return 0
+        return _fd_in_waiting(self._sock.fileno())
+
+    def read(self, size=1):
+        ret = b''
+        while len(ret) < size:
+            try:
+                d = self._sock.recv(size-len(ret))
+            except OSError:
+                # Reset by the other side, or closed under us
+                break
+            if not d:
+                break
+            ret += d
+        return ret
+
+    def write(self, data):
+        self._sock.sendall(data)
+
+    def close(self):
+        self._sock.close()
+
+
+class MemoryTransport:
+    """One end of an in-process pipe. Use MemoryTransport.pair() to make both ends.
+
+    Like a serial line, bytes sent when the two ends' baud rates differ arrive as junk.
+    """
+
+    def __init__(self, baud=115200):
+        self.baudrate = baud
+        self._inbox = bytearray()
+        self._ready = threading.Condition()
+        self._closed = False
+        self._peer = None
+
+    @classmethod
+    def pair(cls, baud=115200):
+        """Make two connected ends. What one writes the other reads."""
+        a = cls(baud)
+        b = cls(baud)
+        a._peer = b
+        b._peer = a
+        return a, b
+
+    @property
+    def in_waiting(self):
+        return len(self._inbox)
+
+    def read(self, size=1):
+        with self._ready:
+            self._ready.wait_for(lambda: len(self._inbox) >= size or self._closed)
+            ret = bytes(self._inbox[:size])
+            del self._inbox[:size]
+        return ret
+
+    def write(self, data):
+        peer = self._peer
+        if peer.baudrate != self.baudrate:
+            data = b'\xff'*len(data)
+        with peer._ready:
+            peer._inbox += data
+            peer._ready.notify_all()
+
+    def close(self):
+        for end in (self, self._peer):
+            with end._ready:
+                end._closed = True
+                end._ready.notify_all()
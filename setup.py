@@ -18,4 +18,8 @@ setup(name              = 'irobotcreate',
       install_requires  = [      
         'serial'
       ],    
+      extras_require    = {
+        'numpy': ['numpy'],  # TelemetryRecorder numpy views
+        'web': ['tornado']   # webcontrol/server.py
+      },
       packages          = find_packages())
\ No newline at end of file
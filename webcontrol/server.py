@@ -13,32 +13,416 @@ cd /home/pi/web
 /usr/bin/python server.py
   
 """
+import asyncio
+import json
+import os
+import re
+import struct
+import sys
+import time
+
 import tornado.ioloop
+import tornado.log
 import tornado.web
-import os
-mport IRobotCreate
-import IRobotCreate.roomba
+import tornado.websocket
+
+# The driver modules import each other by name
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'irobotcreate'))
+from async_roomba import AsyncRoomba
+from metrics import LatencyHistogram, LatencyMetrics, PrometheusText
+from motion import MotionExecutor
+from odometry import Odometry
+from reflexes import SafetyReflexes
+import sensor_groups
+
+# Telemetry frames per second pushed to the browsers (the robot streams at 66)
+TELEMETRY_HZ = 10
+
+# One telemetry frame (little-endian), sent as a binary websocket message:
+#   uint32  frame number
+#   uint8   BumpsAndWheelDrops (bit 0 bump right, 1 bump left, 2 drop right, 3 drop left)
+#   uint8   cliffs (bit 0 left, 1 front left, 2 front right, 3 right)
+#   uint8   ChargingState
+#   uint8   OIMode
+#   uint16  BatteryVoltage mV
+#   int16   BatteryCurrent mA
+#   uint16  BatteryCharge mAh
+#   uint16  BatteryCapacity mAh
+#   float32 x mm, y mm, heading radians, velocity mm/s
+TELEMETRY_FRAME = struct.Struct('<IBBBBHhHHffff')
+
+# The commands a browser may send: name -> (AsyncRoomba method, number of int args).
+# Nothing else on the robot can be reached from the web.
+COMMANDS = {
+    'drive':          ('set_drive', 2),          # velocity mm/s, radius mm
+    'drive_direct':   ('set_drive_direct', 2),   # left mm/s, right mm/s
+    'drive_straight': ('set_drive_straight', 1), # velocity mm/s
+    'spin_cw':        ('set_drive_spin_cw', 1),  # velocity mm/s
+    'spin_ccw':       ('set_drive_spin_ccw', 1), # velocity mm/s
+    'stop':           ('set_drive_stop', 0),
+    'seek_dock':      ('set_seek_dock', 0),
+    'clean':          ('set_clean_clean', 0),
+    'spot':           ('set_clean_spot', 0),
+    'mode_passive':   ('set_mode_passive', 0),
+    'mode_safe':      ('set_mode_safe', 0),
+    'mode_full':      ('set_mode_full', 0),
+}
+
+# The old "/robot?command=set_drive_straight(200)" form
+_METHOD_NAMES = {method: name for name, (method, _) in COMMANDS.items()}
+_CALL_RE = re.compile(r'^(\w+)\(\s*(-?\d+(?:\s*,\s*-?\d+)*)?\s*\)$')
+
+
+async def run_command(name, args):
+    """Run one command from the COMMANDS table. Raises ValueError if it isn't allowed."""
+    if not isinstance(name, str) or name not in COMMANDS:
+        raise ValueError('Unknown command '+repr(name))
+    method, num_args = COMMANDS[name]
+    if not isinstance(args, list) or len(args) != num_args:
+        raise ValueError(name+' takes '+str(num_args)+' arguments')
+    for arg in args:
+        if type(arg) is not int or not -32768 <= arg <= 32767:
+            raise ValueError('Arguments must be 16-bit integers')
+    if roomba is None:
+        raise ValueError('The robot is not connected yet')
+    if reflexes is not None and reflexes.tripped and method.startswith('set_drive') and name != 'stop':
+        raise ValueError('Stopped for a '+reflexes.tripped+'. Send release_safety when it is clear.')
+    await getattr(roomba, method)(*args)
+
+
+class ProgramRunner:
+    """Runs the "Program" mode scripts on the server.
+
+    The browser uploads the whole program at once. Every step is a closed-loop move
+    on the MotionExecutor, so it ends by the odometry (within a stream frame) instead
+    of a browser timer, and the program finishes even if the browser goes away.
+
+    A program is a list of steps like {"cmd": "forward"} or {"cmd": "spin_cw",
+    "amount": 45}. The amount is mm for drives and degrees for spins.
+    """
+
+    # cmd -> (move is a spin, direction, default amount, speed mm/s)
+    STEPS = {
+        'forward':  (False,  1, 400, 200),
+        'back':     (False, -1, 400, 200),
+        'spin_cw':  (True,  -1,  90, 100),
+        'spin_ccw': (True,   1,  90, 100),
+    }
+    MAX_AMOUNT = 5000
+
+    def __init__(self):
+        self.motion = None
+        self.task = None
+
+    def parse(self, steps):
+        # Check the whole program before moving. Returns [(spin, amount, speed)].
+        if not isinstance(steps, list):
+            raise ValueError('The program must be a list of steps')
+        ret = []
+        for step in steps:
+            if not isinstance(step, dict) or step.get('cmd') not in self.STEPS:
+                raise ValueError('Unknown program step '+repr(step))
+            spin, direction, amount, speed = self.STEPS[step['cmd']]
+            amount = step.get('amount', amount)
+            if type(amount) not in (int, float) or not 0 < amount <= self.MAX_AMOUNT:
+                raise ValueError('Bad amount in program step '+repr(step))
+            ret.append((spin, direction*amount, speed))
+        return ret
+
+    def start(self, steps, report):
+        """Start a program.
+
+        Args:
+            steps: the program (see above)
+            report: function(event dict) for the progress events
+        """
+        if self.motion is None:
+            raise ValueError('The robot is not connected yet')
+        if self.task is not None and not self.task.done():
+            raise ValueError('A program is already running')
+        moves = self.parse(steps)
+        self.task = asyncio.ensure_future(self._run(moves, report))
+
+    def stop(self):
+        if self.motion is not None:
+            # The running step's future is cancelled and _run reports "stopped"
+            self.motion.cancel_all()
+
+    async def _run(self, moves, report):
+        # Queue every step at once so the executor can run them back to back
+        futures = []
+        for spin, amount, speed in moves:
+            if spin:
+                futures.append(self.motion.turn_angle(amount, speed))
+            else:
+                futures.append(self.motion.drive_distance(amount, speed))
+        try:
+            for index, future in enumerate(futures):
+                report({'event': 'program', 'state': 'step', 'step': index})
+                await asyncio.wrap_future(future)
+            report({'event': 'program', 'state': 'finished'})
+        except asyncio.CancelledError:
+            report({'event': 'program', 'state': 'stopped'})
+        except Exception as e:
+            self.motion.cancel_all()
+            report({'event': 'program', 'state': 'failed', 'error': str(e)})
+
+
+class TelemetryBroadcaster:
+    """A stream consumer that packs every Nth frame once and sends it to every browser."""
+
+    def __init__(self, odometry, rate_hz):
+        self.odometry = odometry
+        self.decimation = max(1, round(66.0/rate_hz))
+        self.clients = set()
+        self.num_sent = 0
+        self.num_skipped = 0
+        self._count = 0
+        self.last_values = None
+
+    def bind(self, decoder):
+        names = decoder.value_names
+        self._names = names
+        self.last_values = None
+        self._index = [names.index(n) for n in (
+            'BumpsAndWheelDrops', 'CliffLeft', 'CliffFrontLeft', 'CliffFrontRight', 'CliffRight',
+            'ChargingState', 'OIMode', 'BatteryVoltage', 'BatteryCurrent', 'BatteryCharge',
+            'BatteryCapacity')]
 
-#roomba = irobot_create.Create('COM4')
-roomba = IRobotCreate.roomba.Roomba() # '/dev/ttyUSB0'
+    def get(self, name):
+        # A packet's raw value from the newest frame (for /metrics)
+        if self.last_values is None:
+            return None
+        return self.last_values[self._names.index(name)]
+
+    def record(self, values, timestamp=None):
+        # AsyncRoomba calls this on the event loop for every stream frame
+        self.last_values = values
+        self._count += 1
+        if self._count % self.decimation or not self.clients:
+            return
+        (bumps, cliff_l, cliff_fl, cliff_fr, cliff_r, charging, mode,
+         voltage, current, charge, capacity) = [values[i] for i in self._index]
+        pose = self.odometry.pose
+        frame = TELEMETRY_FRAME.pack(
+            self._count, bumps, cliff_l | cliff_fl<<1 | cliff_fr<<2 | cliff_r<<3,
+            charging, mode, voltage, current, charge, capacity,
+            pose.x_mm, pose.y_mm, pose.heading, pose.velocity_mms)
+        for client in list(self.clients):
+            if client.sending is not None and not client.sending.done():
+                # This browser hasn't taken the last one yet. It gets the next.
+                self.num_skipped += 1
+                continue
+            try:
+                client.sending = client.write_message(frame, binary=True)
+            except tornado.websocket.WebSocketClosedError:
+                self.clients.discard(client)
+                continue
+            self.num_sent += 1
+
+
+port_name = sys.argv[1] if len(sys.argv) > 1 else '/dev/ttyUSB0'
+odometry = Odometry()
+telemetry = TelemetryBroadcaster(odometry, TELEMETRY_HZ)
+programs = ProgramRunner()
+
+# The browsers on /control (for the safety events)
+control_clients = set()
+
+# The robot is opened on the event loop (see "connect" below). Nothing here blocks
+# the loop -- web requests are still answered while the robot changes modes.
+roomba = None
+reflexes = None
+
+def report_safety(reason):
+    # On the event loop, right after the reflex stopped the robot
+    for client in list(control_clients):
+        client.send({'event': 'safety', 'state': 'tripped', 'reason': reason})
+
+async def connect():
+    global roomba, reflexes
+    bot = await AsyncRoomba.open(port_name)
+    # Switch to control mode
+    await bot.set_mode_full()
+    #await bot.set_mode_safe()
+    # Full mode doesn't stop for cliffs or wheel drops. The driver does.
+    safety = SafetyReflexes(bot.nowait)
+    safety.add_listener(report_safety)
+    bot.add_stream_consumer(safety)
+    bot.enable_latency_metrics()
+    bot.add_stream_consumer(odometry)
+    bot.add_stream_consumer(telemetry)
+    await bot.start_packet_stream([sensor_groups.Group_100()])
+    programs.motion = MotionExecutor(bot.nowait, odometry)
+    # The handlers see the robot only once all of it is wired up
+    reflexes = safety
+    roomba = bot
 
-# Switch to control mode
-roomba.set_mode_full()
-#roomba.set_mode_safe()
-        
 class CGIHandler(tornado.web.RequestHandler):
-    def post(self):        
+    # Kept for old pages. The UI uses the /control websocket.
+    async def post(self):        
         cmd = self.get_argument('command')
         print(cmd)
-        eval("roomba."+cmd)
+        m = _CALL_RE.match(cmd)
+        try:
+            if not m or m.group(1) not in _METHOD_NAMES:
+                raise ValueError('Unknown command '+repr(cmd))
+            args = [int(a) for a in m.group(2).split(',')] if m.group(2) else []
+            await run_command(_METHOD_NAMES[m.group(1)], args)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+class ControlHandler(tornado.websocket.WebSocketHandler):
+    """Commands from the browser on one long-lived socket.
+
+    The browser sends JSON text messages:
+      {"seq": 17, "cmd": "drive_direct", "args": [200, 150]}
+
+    Commands run in the order they arrive. Each one is answered once it has been
+    written to the robot:
+      {"ack": 17}  or  {"ack": 17, "error": "Unknown command 'fly'"}
+
+    Programs are uploaded whole and run by the ProgramRunner:
+      {"seq": 18, "cmd": "run_program", "steps": [{"cmd": "forward"}, ...]}
+      {"seq": 19, "cmd": "stop_program"}
+    Progress comes back as events:
+      {"event": "program", "state": "step", "step": 0}
+      {"event": "program", "state": "finished"}   (or "stopped", or "failed")
+
+    When the robot stops itself for a cliff or a wheel drop every browser hears:
+      {"event": "safety", "state": "tripped", "reason": "cliff"}
+    Drive commands fail until one of them sends {"seq": 20, "cmd": "release_safety"}
+    (which fails while the hazard is still there).
+
+    If the socket drops while this browser has the robot moving, the robot stops.
+    """
+
+    def open(self):
+        self.driving = False
+        control_clients.add(self)
+
+    async def on_message(self, message):
+        seq = None
+        reply = {}
+        try:
+            msg = json.loads(message)
+            seq = msg.get('seq')
+            cmd = msg.get('cmd')
+            if cmd == 'run_program':
+                programs.start(msg.get('steps'), self.send)
+                return
+            if cmd == 'stop_program':
+                programs.stop()
+                return
+            if cmd == 'release_safety':
+                if reflexes is None or not reflexes.release():
+                    raise ValueError('The hazard is still there')
+                for client in list(control_clients):
+                    client.send({'event': 'safety', 'state': 'released'})
+                return
+            await run_command(cmd, msg.get('args', []))
+            self.driving = cmd in COMMANDS and COMMANDS[cmd][0].startswith('set_drive') and cmd != 'stop'
+        except (ValueError, TypeError, AttributeError) as e:
+            # A bad message gets an error reply. The socket stays open.
+            reply['error'] = str(e)
+        finally:
+            reply['ack'] = seq
+            self.send(reply)
+
+    def send(self, msg):
+        try:
+            self.write_message(json.dumps(msg))
+        except tornado.websocket.WebSocketClosedError:
+            # Programs keep running without the browser
+            pass
+
+    def on_close(self):
+        control_clients.discard(self)
+        if self.driving and roomba is not None:
+            tornado.ioloop.IOLoop.current().add_callback(roomba.set_drive_stop)
+
+class TelemetryHandler(tornado.websocket.WebSocketHandler):
+    def open(self):
+        self.sending = None
+        telemetry.clients.add(self)
+
+    def on_close(self):
+        telemetry.clients.discard(self)
+
+# Handler class name -> LatencyHistogram of its request times
+web_latency = {}
+
+def log_request(handler):
+    # Tornado calls this when a request finishes (in place of its own access log)
+    name = type(handler).__name__
+    hist = web_latency.get(name)
+    if hist is None:
+        hist = web_latency[name] = LatencyHistogram()
+    hist.add(handler.request.request_time())
+    # The same access log line tornado writes
+    status = handler.get_status()
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    request = handler.request
+    log_method('%d %s %s (%s) %.2fms', status, request.method, request.uri, request.remote_ip,
+               1000.0*request.request_time())
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """The robot's counters in the Prometheus text format.
+
+    Everything is counted as it happens (in the driver, the telemetry, and
+    log_request) and only formatted here, when a scraper asks.
+    """
+
+    def get(self):
+        page = PrometheusText()
+        page.add('create_up', 'gauge', 'The robot is connected', int(roomba is not None))
+        page.add('process_cpu_seconds_total', 'counter', 'CPU time used by the server', time.process_time())
+        if roomba is not None:
+            core = roomba.nowait
+            counters = roomba.get_stream_counters()
+            page.add('create_stream_packets_total', 'counter', 'Stream frames decoded and delivered', counters['packets'])
+            page.add('create_stream_frames_total', 'counter', 'Stream frames with a good length and checksum', counters['frames'])
+            page.add('create_stream_bad_checksums_total', 'counter', 'Stream frames dropped for a bad checksum', counters['bad_checksums'])
+            page.add('create_stream_resyncs_total', 'counter', 'Times the reader lost the stream framing', counters['resyncs'])
+            page.add('create_stream_dropped_bytes_total', 'counter', 'Bytes thrown away while finding the framing', counters['dropped_bytes'])
+            page.add('create_serial_bytes_total', 'counter', 'Bytes over the serial link',
+                     [({'direction': 'in'}, core.num_bytes_in), ({'direction': 'out'}, core.num_bytes_out)])
+            page.add('create_commands_total', 'counter', 'OI commands sent by opcode',
+                     [({'opcode': op}, n) for op, n in enumerate(core.command_counts) if n])
+            if core.latency is not None:
+                page.add_histogram('create_latency_seconds', 'Driver timings (see metrics.LatencyMetrics)',
+                                   [({'path': name}, getattr(core.latency, name)) for name in LatencyMetrics.NAMES])
+            page.add('create_safety_trips_total', 'counter', 'Times a safety reflex stopped the robot', reflexes.num_trips)
+        voltage = telemetry.get('BatteryVoltage')
+        if voltage is not None:
+            page.add('create_battery_voltage_volts', 'gauge', 'Battery voltage', voltage/1000.0)
+            page.add('create_battery_current_amps', 'gauge', 'Battery current (negative when discharging)', telemetry.get('BatteryCurrent')/1000.0)
+            page.add('create_battery_charge_mah', 'gauge', 'Battery charge', telemetry.get('BatteryCharge'))
+            page.add('create_battery_capacity_mah', 'gauge', 'Battery capacity', telemetry.get('BatteryCapacity'))
+            page.add('create_oi_mode', 'gauge', 'OI mode (0 off, 1 passive, 2 safe, 3 full)', telemetry.get('OIMode'))
+        page.add('create_telemetry_frames_total', 'counter', 'Telemetry frames for the browsers',
+                 [({'result': 'sent'}, telemetry.num_sent), ({'result': 'skipped'}, telemetry.num_skipped)])
+        page.add_histogram('web_request_duration_seconds', 'Web request times by handler',
+                           [({'handler': name}, hist) for name, hist in sorted(web_latency.items())])
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(page.render())
 
 root = os.path.join(os.path.dirname(__file__), "webroot")
 
 handlers = [
-    (r"/robot", CGIHandler),        
+    (r"/robot", CGIHandler),
+    (r"/control", ControlHandler),
+    (r"/telemetry", TelemetryHandler),
+    (r"/metrics", MetricsHandler),
     (r"/(.*)", tornado.web.StaticFileHandler, {"path": root, "default_filename": "index.html"}),
     ]
 
-app = tornado.web.Application(handlers)
+app = tornado.web.Application(handlers, log_function=log_request)
 app.listen(8888)
+tornado.ioloop.IOLoop.current().add_callback(connect)
 tornado.ioloop.IOLoop.current().start()
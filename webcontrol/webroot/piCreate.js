@@ -1,50 +1,53 @@
 var POWERstraight = 200
 var POWERspin     = 100
-var TIMEstraight  = 2000
-var TIMEspin      = 743
 
 var driving=true;
 
 var scriptCommands = [];
-var scriptCommandsPos = 0;
-var currentCom;
+var scriptCurrent = -1;
 var programRunning = false;
 
-var robotVersion = 0;
+// Program element -> step for the server's ProgramRunner
+var PROGRAM_STEPS = {
+	"img/forward.jpg": "forward",
+	"img/back.jpg":    "back",
+	"img/spinCW.jpg":  "spin_cw",
+	"img/spinCCW.jpg": "spin_ccw"
+};
 
 $(function() {	
 	
 	$("#btForward").bind("click", function() {
 		if(driving) {			
-			robotAjax("set_drive_straight("+POWERstraight+")");
+			robotCommand("drive_straight", [POWERstraight]);
 		} else {
 			addScriptElement("img/forward.jpg");
 		}
 	});					
 	$("#btSpinCCW").bind("click", function() {
 		if(driving) {
-			robotAjax("set_drive_spin_ccw("+POWERspin+")");
+			robotCommand("spin_ccw", [POWERspin]);
 		} else {
 			addScriptElement("img/spinCCW.jpg");
 		}
 	});					
 	$("#btStop").bind("click", function() {
 		if(driving) {
-			robotAjax("set_drive_stop()");	
+			robotCommand("stop");	
 		} else {
 			//nothing for now
 		}
 	});					
 	$("#btSpinCW").bind("click", function() {
 		if(driving) {
-			robotAjax("set_drive_spin_cw("+POWERspin+")");
+			robotCommand("spin_cw", [POWERspin]);
 		} else {
 			addScriptElement("img/spinCW.jpg");
 		}
 	});					
 	$("#btBack").bind("click", function() {
 		if(driving) {
-			robotAjax("set_drive_straight(-"+POWERstraight+")");
+			robotCommand("drive_straight", [-POWERstraight]);
 		} else {
 			addScriptElement("img/back.jpg");
 		}
@@ -69,10 +72,60 @@ $(function() {
 	});					
 	$("#btRunProg").bind("click", runScript);					
 	$("#btStopProg").bind("click", function() {
-		scriptCommandsPos = scriptCommands.length;
+		robotCommand("stop_program");
 	});				
 });
 
+// Live sensor data pushed by the server. See TELEMETRY_FRAME in server.py for the layout.
+
+var CHARGING_STATES = ["Not charging", "Reconditioning", "Full charging", "Trickle charging", "Waiting", "Charging fault"];
+var OI_MODES = ["Off", "Passive", "Safe", "Full"];
+
+$(connectTelemetry);
+
+function connectTelemetry() {
+	var ws = new WebSocket("ws://"+location.host+"/telemetry");
+	ws.binaryType = "arraybuffer";
+	ws.onmessage = function(e) {
+		showTelemetry(new DataView(e.data));
+	};
+	ws.onclose = function() {
+		// Server restarted or the Wi-Fi dropped. Keep trying.
+		setTimeout(connectTelemetry, 1000);
+	};
+}
+
+function bitNames(value, names) {
+	var ret = [];
+	for(var i=0;i<names.length;++i) {
+		if(value & (1<<i)) ret.push(names[i]);
+	}
+	return ret.length ? ret.join(" ") : "-";
+}
+
+function showTelemetry(d) {
+	var bumps    = d.getUint8(4);
+	var cliffs   = d.getUint8(5);
+	var charging = d.getUint8(6);
+	var mode     = d.getUint8(7);
+	var voltage  = d.getUint16(8, true);
+	var current  = d.getInt16(10, true);
+	var charge   = d.getUint16(12, true);
+	var capacity = d.getUint16(14, true);
+	var x        = d.getFloat32(16, true);
+	var y        = d.getFloat32(20, true);
+	var heading  = d.getFloat32(24, true);
+	var velocity = d.getFloat32(28, true);
+
+	$("#tmBumps").text(bitNames(bumps, ["bump-right", "bump-left", "drop-right", "drop-left"]));
+	$("#tmCliffs").text(bitNames(cliffs, ["left", "front-left", "front-right", "right"]));
+	$("#tmBattery").text((voltage/1000).toFixed(2)+"V "+current+"mA "+charge+"/"+capacity+"mAh "+
+		(CHARGING_STATES[charging] || charging));
+	$("#tmMode").text(OI_MODES[mode] || mode);
+	$("#tmPose").text("x:"+x.toFixed(0)+" y:"+y.toFixed(0)+" mm "+(heading*180/Math.PI).toFixed(0)+"\u00b0 "+
+		velocity.toFixed(0)+"mm/s");
+}
+
 function addScriptElement(type) {
 	// change cursor to NEXT
 	var cur = $(".cursor");
@@ -85,8 +138,64 @@ function addScriptElement(type) {
 	ne.after($("<img onclick='scriptClick(event)' class='cursor' height='75' src='img/cursor.jpg'>"));
 }
 
-function robotAjax(cmd,cb) {
-	$.post("/robot?command="+cmd,cb);
+// Commands go to the server on one websocket (see ControlHandler in server.py).
+// Every command gets a sequence number. The server answers each one with an "ack"
+// carrying that number once the command is on its way to the robot.
+
+var controlSocket = null;
+var controlSeq = 0;
+var controlPending = {};   // seq -> callback(error)
+var controlQueue = [];     // messages waiting for the socket to open
+
+$(connectControl);
+
+function connectControl() {
+	var ws = new WebSocket("ws://"+location.host+"/control");
+	ws.onopen = function() {
+		controlSocket = ws;
+		for(var i=0;i<controlQueue.length;++i) {
+			ws.send(controlQueue[i]);
+		}
+		controlQueue = [];
+	};
+	ws.onmessage = function(e) {
+		var reply = JSON.parse(e.data);
+		if(reply.event==="program") {
+			programEvent(reply);
+			return;
+		}
+		if(reply.event==="safety") {
+			safetyEvent(reply);
+			return;
+		}
+		var cb = controlPending[reply.ack];
+		delete controlPending[reply.ack];
+		if(reply.error) {
+			console.log("Command "+reply.ack+" failed: "+reply.error);
+		}
+		if(cb) cb(reply.error);
+	};
+	ws.onclose = function() {
+		controlSocket = null;
+		// The robot finishes the program without us, but we won't hear about it
+		if(programRunning) programDone();
+		setTimeout(connectControl, 1000);
+	};
+}
+
+function robotCommand(cmd,args,cb) {
+	robotSend({cmd: cmd, args: args || []}, cb);
+}
+
+function robotSend(msg,cb) {
+	msg.seq = ++controlSeq;
+	if(cb) controlPending[controlSeq] = cb;
+	msg = JSON.stringify(msg);
+	if(controlSocket) {
+		controlSocket.send(msg);
+	} else {
+		controlQueue.push(msg);
+	}
 }
 
 function scriptClick(e) {
@@ -111,49 +220,51 @@ function scriptClick(e) {
 	}
 }
 
-function nextScriptCommand() {
-	if(scriptCommandsPos==scriptCommands.length) {
-		robotAjax("stop",function() {
-			programRunning = false;
-			$("#glassPane").hide();
-			$("#btClear").prop("disabled",false);
-			$("#btRunProg").prop("disabled",false);
-			$("#btStopProg").prop("disabled",true);
-			$("#btDrive").prop("disabled",false);
-			$("#btProgram").prop("disabled",false);
+// The server stops the robot by itself on a cliff or a wheel drop. It won't drive
+// again until somebody says the robot has been moved somewhere safe.
+
+function safetyEvent(ev) {
+	if(ev.state!=="tripped") return;
+	if(confirm("The robot stopped for a "+ev.reason+". Move it somewhere safe, then press OK to drive again.")) {
+		robotCommand("release_safety",[],function(error) {
+			if(error) alert(error);
 		});
-		return;
 	}
-	var cmd = $(scriptCommands[scriptCommandsPos]);
-	++scriptCommandsPos;
-
-	var type = cmd.attr("src");
-	currentCom = cmd;
-	var i = type.indexOf(".jpg");
-	var orgSrc = type;
-	cmd.attr("src",type.substring(0,i)+"CUR"+type.substring(i));
-	var time = 0;
-	if(type==="img/forward.jpg") {
-		type = "set_drive_straight("+POWERstraight+")";
-		time = TIMEstraight;
-	} else if(type==="img/back.jpg") {
-		type = "set_drive_straight(-"+POWERstraight+")";
-		time = TIMEstraight;
-	} else if(type==="img/spinCW.jpg") {
-		type = "set_drive_spin_cw("+POWERspin+")";
-		time = TIMEspin;
-	} else if(type==="img/spinCCW.jpg") {
-		type = "set_drive_spin_ccw("+POWERspin+")"
-		time = TIMEspin[robotVersion];
-	} 
-
-	robotAjax(type,function() {
-		setTimeout(function() {
-			cmd.attr("src",orgSrc);
-			nextScriptCommand();
-		},time);
-	});
+}
+
+// The program runs on the server. It tells us when each step starts.
 
+function programEvent(ev) {
+	if(!programRunning) return;
+	if(ev.state==="step") {
+		highlightStep(ev.step);
+	} else {
+		if(ev.error) console.log("Program failed: "+ev.error);
+		programDone();
+	}
+}
+
+function highlightStep(index) {
+	if(scriptCurrent>=0) {
+		var old = $(scriptCommands[scriptCurrent]);
+		old.attr("src",old.attr("src").replace("CUR.jpg",".jpg"));
+	}
+	scriptCurrent = index;
+	if(index>=0) {
+		var cmd = $(scriptCommands[index]);
+		cmd.attr("src",cmd.attr("src").replace(".jpg","CUR.jpg"));
+	}
+}
+
+function programDone() {
+	highlightStep(-1);
+	programRunning = false;
+	$("#glassPane").hide();
+	$("#btClear").prop("disabled",false);
+	$("#btRunProg").prop("disabled",false);
+	$("#btStopProg").prop("disabled",true);
+	$("#btDrive").prop("disabled",false);
+	$("#btProgram").prop("disabled",false);
 }
 
 function runScript() {
@@ -166,6 +277,13 @@ function runScript() {
 	$("#btProgram").prop("disabled",true);
 
 	scriptCommands = $(".programElement");
-	scriptCommandsPos = 0;
-	nextScriptCommand();												
+	scriptCurrent = -1;
+	var steps = [];
+	scriptCommands.each(function() {
+		steps.push({cmd: PROGRAM_STEPS[$(this).attr("src")]});
+	});
+	// The whole program goes up at once
+	robotSend({cmd: "run_program", steps: steps}, function(error) {
+		if(error) programDone();
+	});
 }